@@ -0,0 +1,184 @@
+"""
+แปลง lung_disease_images_processed.csv (Pixel_0..Pixel_65535) เป็น uint8 memmap แทน pickle ของ list float
+
+- อ่าน CSV รูปทีละ chunk แล้ว append เป็นไบต์ uint8 ลง pixels.u8 → อ่านไฟล์ครั้งเดียว RAM คงที่
+- ข้อความ/โรคจาก lung_disease_clinical_texts_processed.csv จับคู่ทีละแถวแบบเดียวกับ Cell 5 (zip)
+  แล้วเก็บเป็น sidecar index.csv (row, output, disease)
+- meta.json เก็บ shape / dtype / จำนวนแถว
+- PixelMemmapDataset: __getitem__ คืน dict แบบเดิม {"instruction", "input", "output", "disease"}
+  แต่ "input" เป็น view (256, 256) uint8 ของ memmap (ไม่ copy, ไม่ต้อง unpickle จากต้นไฟล์)
+  → ส่งให้ OptimizedXrayDataset / train_test_split ได้เหมือน raw_dataset เดิม
+
+ขนาด: list ของ float 65,536 ตัว ≈ 2 MB ต่อรูป → uint8 256×256 = 64 KB ต่อรูป
+
+CLI:
+    python pixel_memmap.py <dataset_path>                       → ./xray_memmap/
+    python pixel_memmap.py <dataset_path> --out xray_memmap --chunk-rows 256
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+SIDE = 256
+N_PIXELS = SIDE * SIDE
+PIXEL_COLUMNS = [f"Pixel_{i}" for i in range(N_PIXELS)]
+INSTRUCTION = "<image> Describe the findings in this lung X-ray."
+
+PIXELS_NAME = "pixels.u8"
+INDEX_NAME = "index.csv"
+META_NAME = "meta.json"
+
+
+def _read_clinical(path: str) -> List[Dict[str, str]]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def convert(image_csv: str, clinical_csv: str, out_dir: str = "xray_memmap", chunk_rows: int = 256) -> str:
+    """
+    stream CSV รูป → out_dir/pixels.u8 (N × 256 × 256 uint8) + index.csv + meta.json
+    ค่าพิกเซลถูกตัดเป็น uint8 แบบเดียวกับ np.array(item["input"], dtype=np.uint8) ใน notebook
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    clinical = _read_clinical(clinical_csv)
+    pixels_path = os.path.join(out_dir, PIXELS_NAME)
+    tmp_path = pixels_path + ".tmp"
+
+    t0 = time.time()
+    n = 0
+    out_of_range = 0
+
+    def write_chunk(rows: List[List[str]], f) -> None:
+        nonlocal n, out_of_range
+        arr = np.array(rows, dtype=np.float32)
+        bad = (arr < 0) | (arr > 255)
+        if bad.any():
+            out_of_range += int(bad.sum())
+            np.clip(arr, 0, 255, out=arr)
+        f.write(arr.astype(np.uint8).tobytes())
+        n += len(arr)
+        print(f"\r[Convert] {n} rows ({n / max(time.time() - t0, 1e-9):.0f} rows/s)", end="", flush=True)
+
+    # csv.reader + np.array ต่อ chunk เร็วกว่า pandas หลายเท่ากับ CSV ที่มี 65k คอลัมน์
+    with open(image_csv, newline="", encoding="utf-8") as src, open(tmp_path, "wb") as f:
+        reader = csv.reader(src)
+        header = next(reader)
+        start = header.index(PIXEL_COLUMNS[0])
+        if header[start:start + N_PIXELS] != PIXEL_COLUMNS:
+            raise ValueError(f"{image_csv}: คอลัมน์ Pixel_0..Pixel_{N_PIXELS - 1} ไม่เรียงติดกัน")
+        rows: List[List[str]] = []
+        for row in reader:
+            if not row:
+                continue
+            rows.append(row[start:start + N_PIXELS])
+            if len(rows) >= chunk_rows:
+                write_chunk(rows, f)
+                rows = []
+        if rows:
+            write_chunk(rows, f)
+    print()
+    os.replace(tmp_path, pixels_path)
+
+    if len(clinical) != n:
+        # zip() ใน notebook ตัดตามไฟล์ที่สั้นกว่า — ทำแบบเดียวกันใน index
+        print(f"[WARN] clinical {len(clinical)} แถว แต่รูป {n} แถว → ใช้ {min(n, len(clinical))} แถวแรก")
+    n_rows = min(n, len(clinical))
+    with open(os.path.join(out_dir, INDEX_NAME), "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["row", "output", "disease"])
+        for i in range(n_rows):
+            w.writerow([i, clinical[i].get("clinical_text", "").strip(), clinical[i].get("disease", "")])
+
+    meta = {"rows": n_rows, "pixel_rows": n, "shape": [SIDE, SIDE], "dtype": "uint8",
+            "instruction": INSTRUCTION, "out_of_range_pixels": out_of_range}
+    with open(os.path.join(out_dir, META_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    size_mb = os.path.getsize(pixels_path) / 2**20
+    if out_of_range:
+        print(f"[WARN] พิกเซลนอกช่วง 0..255 จำนวน {out_of_range} ค่า (clip แล้ว)")
+    print(f"[Saved] {out_dir}: {n_rows} รูป, {size_mb:.1f} MB ใน {time.time() - t0:.1f}s")
+    return out_dir
+
+
+class PixelMemmapDataset:
+    """
+    Dataset แบบ map-style บน memmap (ใช้กับ DataLoader / Subset ได้)
+    indices=None → ทุกแถว; select()/train_test_split() คืนมุมมองใหม่ที่ใช้ memmap ก้อนเดิม
+    """
+
+    def __init__(self, root: str = "xray_memmap", indices: Optional[Sequence[int]] = None,
+                 _shared: Optional[tuple] = None):
+        self.root = root
+        if _shared is None:
+            with open(os.path.join(root, META_NAME), encoding="utf-8") as f:
+                meta = json.load(f)
+            pixels = np.memmap(os.path.join(root, PIXELS_NAME), dtype=np.uint8, mode="r",
+                               shape=(meta["pixel_rows"], *meta["shape"]))
+            index = pd.read_csv(os.path.join(root, INDEX_NAME), keep_default_na=False, dtype={"output": str, "disease": str})
+            _shared = (meta, pixels, index["output"].tolist(), index["disease"].tolist())
+        self._shared = _shared
+        self.meta, self.pixels, self._outputs, self._diseases = _shared
+        self.indices = np.arange(self.meta["rows"], dtype=np.int64) if indices is None \
+            else np.asarray(indices, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def image(self, i: int) -> np.ndarray:
+        """view (256, 256) uint8 — ไม่ copy"""
+        return self.pixels[self.indices[i]]
+
+    def __getitem__(self, i: int) -> Dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = int(self.indices[i])
+        return {
+            "instruction": self.meta.get("instruction", INSTRUCTION),
+            "input": self.pixels[row],
+            "output": self._outputs[row],
+            "disease": self._diseases[row],
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def diseases(self) -> np.ndarray:
+        return np.asarray(self._diseases, dtype=object)[self.indices]
+
+    def select(self, indices: Sequence[int]) -> "PixelMemmapDataset":
+        return PixelMemmapDataset(self.root, self.indices[np.asarray(indices, dtype=np.int64)], _shared=self._shared)
+
+    def train_test_split(self, test_size: float = 0.2, random_state: int = 42):
+        """สูตรเดียวกับ sklearn.model_selection.train_test_split (shuffle=True) → ได้ split เดิม"""
+        n = len(self)
+        n_test = math.ceil(test_size * n)
+        n_train = n - n_test
+        perm = np.random.RandomState(random_state).permutation(n)
+        return self.select(perm[n_test:n_test + n_train]), self.select(perm[:n_test])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the pixel CSV into a uint8 memmap with a text/disease index")
+    parser.add_argument("dataset_path", help="โฟลเดอร์จาก kagglehub.dataset_download(...)")
+    parser.add_argument("--out", default="xray_memmap")
+    parser.add_argument("--chunk-rows", type=int, default=256)
+    args = parser.parse_args()
+
+    convert(
+        os.path.join(args.dataset_path, "lung_disease_images_processed.csv"),
+        os.path.join(args.dataset_path, "lung_disease_clinical_texts_processed.csv"),
+        out_dir=args.out,
+        chunk_rows=args.chunk_rows,
+    )
@@ -0,0 +1,283 @@
+"""
+CaptionEvalCallback แบบ generate เป็น batch (แทนการ generate ทีละรูปใน qwen_optimize.ipynb)
+
+- generate_batched(): pad ซ้าย, เรียงตามความยาว prompt โดยประมาณ (พื้นที่ภาพ แล้วความยาวข้อความ)
+  แล้วตัดเป็น micro-batch → padding น้อย; ลำดับของ micro-batch สุ่มด้วย rng
+  เพื่อให้ subset ที่ได้ยังไม่เอียงไปทาง prompt สั้น เมื่อหมดงบเวลาแล้วหยุดก่อน
+- time_budget (วินาที): ไม่เริ่ม micro-batch ใหม่เมื่อเกินงบ; metric คำนวณจากแถวที่ทำเสร็จ
+- รายงาน samples/sec ทุกครั้งที่ eval (พิมพ์ [Eval] และใส่ลง metrics เป็น eval_caption_samples_per_sec)
+- prompt ใช้เฉพาะ turn ของ user (คำตอบของ assistant ใน val_ds ไม่หลุดเข้า prompt) และ decode เฉพาะ token ใหม่
+- ถ้าแถวไม่มี __class__ (เช่น ผ่าน convert_to_conversation แล้ว) จะอ่านคลาสจริงจากคำตอบ "Class: ..."
+- label_scorer (class_scoring.LabelScorer) → ทำนายคลาสจาก log-likelihood บนอินพุตชุดเดียวกัน แทน regex
+- prediction_store (prediction_store.PredictionStore) → เก็บผลต่อ (global_step, index ใน eval_dataset)
+  แถวที่ step นี้เคย generate แล้ว (เช่น eval ซ้ำหลัง resume) อ่านจาก store แทน; metric ใหม่คำนวณจาก store ได้ภายหลัง
+
+ใช้แทนของเดิมได้เลย:
+    trainer.add_callback(CaptionEvalCallback(eval_dataset=val_ds, tokenizer=tokenizer,
+                                             sample_size=128, max_new_tokens=96, batch_size=16, time_budget=120))
+"""
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+
+from caption_metrics import corpus_rouge_l
+from class_scoring import CLASS_LABELS, LABEL_TO_ID, LabelScorer, instruction
+
+LABEL_SET = set(CLASS_LABELS)
+
+
+def extract_pred_class(text: str) -> Optional[str]:
+    """
+    ดึงคลาสจากข้อความยาวของโมเดล:
+    รับมือกรณีมีช่องว่าง/เคส/บรรทัดสลับ/มีเครื่องหมายพิเศษ
+    """
+    m = re.search(r"(?i)class\s*:\s*([A-Za-z0-9_\- ]+)", text or "")
+    if not m:
+        return None
+    cand = m.group(1).strip().replace(" ", "_")
+    if cand in LABEL_TO_ID:
+        return cand
+    for c in CLASS_LABELS:
+        if cand.lower() == c.lower():
+            return c
+    return None
+
+
+def macro_f1_from_predictions(y_true: Sequence[int], y_pred: Sequence[int]) -> float:
+    """macro-F1 (นับ TP/FP/FN ด้วย bincount) ผลเท่ากับฟังก์ชันเดิมใน notebook"""
+    k = len(CLASS_LABELS)
+    y_true, y_pred = np.asarray(y_true, dtype=np.int64), np.asarray(y_pred, dtype=np.int64)
+    hit = y_true == y_pred
+    tp = np.bincount(y_true[hit], minlength=k)
+    fp = np.bincount(y_pred[~hit], minlength=k)
+    fn = np.bincount(y_true[~hit], minlength=k)
+    p = tp / np.maximum(1, tp + fp)
+    r = tp / np.maximum(1, tp + fn)
+    f1 = np.divide(2 * p * r, p + r, out=np.zeros(k), where=(p + r) > 0)
+    return float(f1.mean())
+
+
+# ---------- แยกข้อมูลจากแถว ----------
+
+def _content(turn: Dict) -> List:
+    return turn.get("content") or []
+
+
+def split_row(row: Dict[str, Any]) -> Tuple[List[Dict], Any, str, str]:
+    """
+    คืน (prompt_messages, image, ref_caption, true_cls)
+    รองรับทั้งแถวที่มี 'messages' และแถวแบบเก่า ('image' + 'text' + '__class__')
+    """
+    ref_caption = row.get("text", "") or ""
+    true_cls = row.get("__class__", "") or ""
+    image, answer = None, ""
+    if isinstance(row.get("messages"), list):
+        prompt = []
+        for turn in row["messages"]:
+            if turn.get("role") == "assistant":
+                answer = answer or next((c["text"] for c in _content(turn)
+                                         if isinstance(c, dict) and c.get("type") == "text" and c.get("text")), "")
+                continue
+            prompt.append(turn)
+            for c in _content(turn):
+                if image is None and isinstance(c, dict) and c.get("type") == "image":
+                    image = c.get("image")
+        if image is None:
+            image = row.get("image")
+    else:
+        image = row.get("image")
+        if image is None:
+            raise ValueError("No image found in row. Expected either 'messages' with an image content "
+                             "or an 'image' column.")
+        prompt = [{"role": "user", "content": [{"type": "text", "text": instruction},
+                                               {"type": "image", "image": image}]}]
+    ref_caption = ref_caption or answer
+    true_cls = true_cls or extract_pred_class(answer) or ""
+    return prompt, image, ref_caption, true_cls
+
+
+def _template_messages(messages: List[Dict]) -> List[Dict]:
+    """แทน {"type": "image", "image": PIL} ด้วย {"type": "image"} (ภาพส่งให้ processor แยก)"""
+    out = []
+    for turn in messages:
+        content = [{"type": "image"} if isinstance(c, dict) and c.get("type") == "image" else c
+                   for c in _content(turn)]
+        out.append({**turn, "content": content})
+    return out
+
+
+def _estimated_length(prompt: List[Dict], image) -> Tuple[int, int]:
+    area = image.size[0] * image.size[1] if hasattr(image, "size") and isinstance(image.size, tuple) else 0
+    text = sum(len(c.get("text", "")) for t in prompt for c in _content(t) if isinstance(c, dict))
+    return area, text
+
+
+# ---------- batched generate ----------
+
+@dataclass
+class GenerationStats:
+    requested: int
+    done: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+    padding_ratio: float = 0.0
+    stopped_early: bool = False
+
+    @property
+    def samples_per_sec(self) -> float:
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+
+@torch.no_grad()
+def generate_batched(
+    model,
+    processor,
+    rows: Sequence[Dict[str, Any]],
+    batch_size: int = 8,
+    max_new_tokens: int = 96,
+    time_budget: Optional[float] = None,
+    sort_by_length: bool = True,
+    rng: Optional[random.Random] = None,
+    label_scorer: Optional[LabelScorer] = None,
+    **generate_kwargs,
+) -> Tuple[List[Dict[str, Any]], GenerationStats]:
+    """
+    generate caption ของ rows เป็น micro-batch (pad ซ้าย, greedy)
+    คืน (ผลต่อแถวตามลำดับที่ทำเสร็จ, สถิติ) — ผลแต่ละแถวมี index, text, ref, true_cls, pred_cls
+    """
+    t0 = time.perf_counter()
+    tok = getattr(processor, "tokenizer", processor)
+    prepared = [split_row(r) for r in rows]
+    order = list(range(len(prepared)))
+    if sort_by_length:
+        order.sort(key=lambda i: _estimated_length(prepared[i][0], prepared[i][1]))
+    batches = [order[i:i + batch_size] for i in range(0, len(order), max(1, batch_size))]
+    if rng is not None:
+        rng.shuffle(batches)
+
+    pad_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+    stats = GenerationStats(requested=len(prepared))
+    results: List[Dict[str, Any]] = []
+    pad_tokens = total_tokens = 0
+    old_side = tok.padding_side
+    tok.padding_side = "left"
+    try:
+        for idx in batches:
+            if time_budget is not None and time.perf_counter() - t0 >= time_budget:
+                stats.stopped_early = True
+                break
+            texts = [processor.apply_chat_template(_template_messages(prepared[i][0]), tokenize=False,
+                                                   add_generation_prompt=True) for i in idx]
+            images = [prepared[i][1] for i in idx]
+            if all(im is not None for im in images) and tok is not processor:
+                enc = processor(images=images, text=texts, add_special_tokens=False, return_tensors="pt", padding=True)
+            else:
+                enc = tok(texts, add_special_tokens=False, return_tensors="pt", padding=True)
+            enc = {k: v.to(model.device) if hasattr(v, "to") else v for k, v in enc.items()}
+            mask = enc["attention_mask"]
+            pad_tokens += int((mask == 0).sum())
+            total_tokens += mask.numel()
+
+            out = model.generate(**enc, max_new_tokens=max_new_tokens, do_sample=False,
+                                 pad_token_id=pad_id, **generate_kwargs)
+            decoded = tok.batch_decode(out[:, enc["input_ids"].shape[1]:], skip_special_tokens=True)
+            scored = label_scorer.predict_labels(model, **enc) if label_scorer is not None else None
+
+            for j, i in enumerate(idx):
+                _, _, ref, true_cls = prepared[i]
+                pred = scored[j] if scored is not None else (extract_pred_class(decoded[j]) or "")
+                results.append({"index": i, "text": decoded[j], "ref": ref, "true_cls": true_cls, "pred_cls": pred})
+            stats.batches += 1
+    finally:
+        tok.padding_side = old_side
+
+    stats.done = len(results)
+    stats.elapsed = time.perf_counter() - t0
+    stats.padding_ratio = pad_tokens / total_tokens if total_tokens else 0.0
+    return results, stats
+
+
+def caption_eval_metrics(results: List[Dict[str, Any]]) -> Dict[str, float]:
+    """macro_f1 (เฉพาะแถวที่อ่านคลาสได้ทั้งสองฝั่ง แบบเดิม) + rougeL เฉลี่ย"""
+    pairs = [(LABEL_TO_ID[r["true_cls"]], LABEL_TO_ID[r["pred_cls"]]) for r in results
+             if r["true_cls"] in LABEL_SET and r["pred_cls"] in LABEL_SET]
+    macro_f1 = macro_f1_from_predictions(*zip(*pairs)) if pairs else 0.0
+    rouge = corpus_rouge_l([r["text"] for r in results], [r["ref"] or "" for r in results], processes=1)
+    return {"macro_f1": macro_f1, "rougeL": float(rouge.mean()) if len(rouge) else 0.0}
+
+
+# ==========================
+# Callback: ประเมิน cls + cap แล้ว "ล็อก" metric
+# ==========================
+class CaptionEvalCallback(TrainerCallback):
+    def __init__(self, eval_dataset, tokenizer, sample_size=256, max_new_tokens=96, seed=42,
+                 batch_size: int = 8, time_budget: Optional[float] = None,
+                 label_scorer: Optional[LabelScorer] = None, prediction_store=None):
+        self.eval_dataset = eval_dataset
+        self.tokenizer = tokenizer
+        self.sample_size = sample_size
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.label_scorer = label_scorer
+        self.prediction_store = prediction_store
+        self.rng = random.Random(seed)
+
+    @torch.no_grad()
+    def on_evaluate(self, args, state, control, model=None, **kwargs):
+        was_training = model.training
+        model.eval()
+
+        # ----- สุ่ม subset จาก val_ds เพื่อลดเวลา evaluate -----
+        n = len(self.eval_dataset)
+        idxs = list(range(n))
+        self.rng.shuffle(idxs)
+        idxs = idxs[:min(self.sample_size, n)]
+        cached = []
+        if self.prediction_store is not None:
+            stored = self.prediction_store.load([state.global_step])
+            cached = stored[stored["sample_id"].isin(idxs)].to_dict("records")
+            done = {r["sample_id"] for r in cached}
+            idxs = [i for i in idxs if i not in done]
+        rows = [self.eval_dataset[i] for i in idxs]
+
+        results, stats = generate_batched(
+            model, self.tokenizer, rows,
+            batch_size=self.batch_size,
+            max_new_tokens=self.max_new_tokens,
+            time_budget=self.time_budget,
+            rng=self.rng,
+            label_scorer=self.label_scorer,
+        )
+        if self.prediction_store is not None:
+            self.prediction_store.write(state.global_step, [{**r, "sample_id": idxs[r["index"]]} for r in results])
+        scores = caption_eval_metrics(results + cached)
+        if was_training:
+            model.train()
+
+        budget_note = " (หมดงบเวลา)" if stats.stopped_early else ""
+        budget_note += f" (จาก store {len(cached)})" if cached else ""
+        print(f"[Eval] step {state.global_step}: {stats.done}/{stats.requested} samples ใน {stats.elapsed:.1f}s "
+              f"({stats.samples_per_sec:.2f} samples/s, {stats.batches} batches, "
+              f"padding {stats.padding_ratio:.0%}){budget_note}  macro_f1={scores['macro_f1']:.4f} "
+              f"rougeL={scores['rougeL']:.4f}")
+
+        # ----- บันทึก metric แบบ IN-PLACE ให้มีทั้งคีย์ปกติและคีย์ eval_ -----
+        metrics = kwargs.get("metrics", None)
+        if metrics is not None:
+            extra = {
+                "macro_f1": scores["macro_f1"],
+                "rougeL": scores["rougeL"],
+                "caption_samples": stats.done + len(cached),
+                "caption_samples_per_sec": stats.samples_per_sec,
+            }
+            for k, v in extra.items():
+                metrics[k] = v
+                metrics[f"eval_{k}"] = v
+        return control
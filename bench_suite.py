@@ -0,0 +1,345 @@
+"""
+Benchmark แบบ offline ของเส้นทาง data-prep ทั้งหมด (ไม่เรียก Gemini จริง — ใช้ prepare_data/fake_genai.FakeClient)
+
+กรณีที่วัด (เลือกด้วย --only):
+- generate_disease / generate_stream / generate_user_input: generator แบบ async + GeminiScheduler
+  กับ fake client ที่สุ่ม latency, 429 และ response ถูกตัด (MAX_TOKENS) → items/s, latency ต่อ call
+- make_schema  : สร้างสคีมาของทั้ง 9 ontology (disease_template.make_schema)
+- render       : template_renderer.TemplateRenderer.render
+- split_csv    : ParagraphSplitter + ClassCsvWriter (stream ทีละ chunk ลง CSV)
+- quality_gate : quality_gate.QualityGate.check
+- augment      : image_balance.augment_batch บนรูปสังเคราะห์ 450×450
+- build_shards : dataset_builder.build_shards + อ่านกลับทุกแถวด้วย LazyConversationDataset
+
+ผลต่อกรณี: items, seconds, items_per_s, p50/p99 latency (ms ต่อหน่วยงานของกรณีนั้น: call / batch / chunk),
+peak RSS (MB) — แยกต่อกรณีด้วย /proc/self/clear_refs (Linux) ถ้าไม่ได้จะเป็นค่าสูงสุดของทั้ง process
+เขียนเป็น JSON (--out) และเทียบกับผลเก่า (--baseline): items/s ต่ำกว่าเดิมเกิน --tolerance → exit code 1
+
+CLI (รันจาก root ของ repo):
+    python bench_suite.py --out bench.json
+    python bench_suite.py --quick --only make_schema split_csv
+    python bench_suite.py --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# โมดูลใน prepare_data/ import กันเองด้วยชื่อตรง ๆ (รันจากในโฟลเดอร์นั้น) → ใส่ path ให้ import ได้จาก root
+sys.path.insert(0, str(Path(__file__).resolve().parent / "prepare_data"))
+
+CaseResult = Tuple[int, List[float]]      # (จำนวน item, latency ต่อหน่วยงานเป็นวินาที)
+
+
+# ---------- peak RSS ----------
+
+def _reset_peak_rss() -> bool:
+    """รีเซ็ต VmHWM ของ process (Linux ≥ 4.0) → peak ของแต่ละกรณีไม่ปนกัน"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _percentile_ms(values: Sequence[float], q: float) -> Optional[float]:
+    return round(float(np.percentile(values, q)) * 1e3, 3) if len(values) else None
+
+
+# ---------- generators (fake Gemini) ----------
+
+def _fake_client(seed: int):
+    from fake_genai import FakeClient
+
+    # ~5% โดน 429, ~2% โดน 503, ~2% stream ขาดกลางคัน, ขอเกิน 40 ข้อความ → ถูกตัด (MAX_TOKENS) ให้ scheduler ลดขนาด call
+    return FakeClient(latency=(0.005, 0.03), seed=seed, rate_limit_rate=0.05, error_rate=0.02, max_items=40,
+                      chunk_chars=256, stream_error_rate=0.02)
+
+
+def _scheduler(seed: int):
+    from scheduler import GeminiScheduler
+
+    return GeminiScheduler(rpm=60_000, base_delay=0.01, max_delay=0.05, seed=seed)
+
+
+def _call_latencies(results, target: int) -> CaseResult:
+    n = sum(r.n_parsed or 0 for r in results)
+    if n < target:      # gate ตัดทิ้งจน run_to_target เติมไม่ครบ (เช่น Normal ถูกตัดเพราะ negation)
+        raise RuntimeError(f"ได้ {n}/{target} รายการที่ผ่าน quality gate")
+    return n, [r.elapsed for r in results if r.ok]
+
+
+def case_generate_disease(scale: float, tmp: Path, seed: int) -> CaseResult:
+    import call_api_for_disease as gen
+    from disease_template import ALL_TEMPLATES
+
+    total = int(2000 * scale)
+    # คลาสจริง + quality gate: fake ตอบด้วยคำจาก ontology ของ Normal รวม term ปฏิเสธ ("No pleural effusion")
+    # ซึ่งผ่าน gate เพราะ Normal อยู่ใน quality_gate.NEGATION_ALLOWED — ถ้าถูกตัดจะได้ไม่ครบ target แล้ว raise
+    results = asyncio.run(gen.agenerate_batch_outputs(
+        gen.SYSTEM_INSTRUCTION_TEXT, gen.USER_CONTENT_TEMPLATE, ALL_TEMPLATES["normal"],
+        items_per_call=50, total_items=total, disease_name="Normal", out_root=str(tmp / "disease"),
+        client=_fake_client(seed), scheduler=_scheduler(seed), concurrency=16, quality_gate=True,
+    ))
+    return _call_latencies(results, total)
+
+
+def case_generate_stream(scale: float, tmp: Path, seed: int) -> CaseResult:
+    import call_api_for_disease as gen
+    from disease_template import ALL_TEMPLATES
+
+    total = int(2000 * scale)
+    results = asyncio.run(gen.agenerate_batch_outputs(
+        gen.SYSTEM_INSTRUCTION_TEXT, gen.USER_CONTENT_TEMPLATE, ALL_TEMPLATES["normal"],
+        items_per_call=50, total_items=total, disease_name="Normal", out_root=str(tmp / "stream"),
+        client=_fake_client(seed), scheduler=_scheduler(seed), concurrency=16, stream=True, quality_gate=True,
+    ))
+    return _call_latencies(results, total)
+
+
+def case_generate_user_input(scale: float, tmp: Path, seed: int) -> CaseResult:
+    import call_api_for_user_input as gen
+
+    total = int(1000 * scale)
+    # fake ตอบ 5–7 ประโยค แต่ sl5 ต้อง 5 พอดี → quality gate ตัดส่วนหนึ่งและ run_to_target ยิงเติมเฉพาะที่ขาด
+    results = asyncio.run(gen.agenerate_batch_outputs(
+        gen.SYSTEM_INSTRUCTION_TEXT, gen.USER_CONTENT_TEMPLATE, items_per_call=50, total_items=total,
+        sentences_long=5, out_root=str(tmp / "user_input"), clinical_text="<clinical text>",
+        client=_fake_client(seed), scheduler=_scheduler(seed), concurrency=16, quality_gate=True,
+    ))
+    return _call_latencies(results, total)
+
+
+# ---------- text ----------
+
+def case_make_schema(scale: float, tmp: Path, seed: int) -> CaseResult:
+    from disease_template import make_schema
+    from template_renderer import ONTOLOGIES
+
+    lat = []
+    for _ in range(max(1, int(50 * scale))):
+        for key, onto in ONTOLOGIES.items():
+            t0 = time.perf_counter()
+            make_schema(f"{key}_Template_Variations", onto)
+            lat.append(time.perf_counter() - t0)
+    return len(lat), lat
+
+
+def case_render(scale: float, tmp: Path, seed: int) -> CaseResult:
+    from template_renderer import ONTOLOGIES, TemplateRenderer
+
+    n, lat = 0, []
+    for k, onto in enumerate(ONTOLOGIES.values()):
+        renderer = TemplateRenderer(onto)
+        for b in range(max(1, int(10 * scale))):
+            t0 = time.perf_counter()
+            n += len(renderer.render(2000, seed=seed + 1000 * k + b))
+            lat.append(time.perf_counter() - t0)
+    return n, lat
+
+
+def _fake_stream_text(n_paragraphs: int, seed: int) -> str:
+    from fake_genai import _fake_paragraph
+
+    rng = random.Random(seed)
+    return "\n\n".join(_fake_paragraph(rng, i) for i in range(n_paragraphs))
+
+
+def case_split_csv(scale: float, tmp: Path, seed: int) -> CaseResult:
+    from stream_csv import ClassCsvWriter, ParagraphSplitter
+
+    text = _fake_stream_text(int(20000 * scale), seed)
+    n, lat = 0, []
+    with ClassCsvWriter(tmp / "split" / "Bench.csv", target=10**9) as writer:
+        splitter = ParagraphSplitter()
+        for start in range(0, len(text), 256):          # chunk ขนาดเดียวกับ stream ของ fake client
+            t0 = time.perf_counter()
+            for para in splitter.feed(text[start:start + 256]):
+                n += writer.append(para)
+            lat.append(time.perf_counter() - t0)
+        tail = splitter.flush()
+        if tail:
+            n += writer.append(tail)
+    return n, lat
+
+
+def case_quality_gate(scale: float, tmp: Path, seed: int) -> CaseResult:
+    from quality_gate import disease_gate
+
+    rows = _fake_stream_text(int(100_000 * scale), seed).split("\n\n")
+    gate = disease_gate("Chest_Changes")
+    lat = []
+    for start in range(0, len(rows), 20_000):
+        t0 = time.perf_counter()
+        gate.check(rows[start:start + 20_000])
+        lat.append(time.perf_counter() - t0)
+    return len(rows), lat
+
+
+# ---------- images ----------
+
+def _synthetic_images(n: int, seed: int, side: int = 450):
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:side, 0:side]
+    base = (128 + 60 * np.sin(xx / 37.0) * np.cos(yy / 53.0)).astype(np.float32)
+    return [Image.fromarray(np.clip(base + rng.normal(0, 20, base.shape), 0, 255).astype(np.uint8), "L")
+            for _ in range(n)]
+
+
+def case_augment(scale: float, tmp: Path, seed: int) -> CaseResult:
+    from image_balance import augment_batch, sample_plan
+
+    images = _synthetic_images(max(8, int(256 * scale)), seed)
+    rng = random.Random(seed)
+    n, lat = 0, []
+    for start in range(0, len(images), 32):
+        batch = images[start:start + 32]
+        plans = [sample_plan(rng) for _ in batch]
+        t0 = time.perf_counter()
+        n += len(augment_batch(batch, plans))
+        lat.append(time.perf_counter() - t0)
+    return n, lat
+
+
+def case_build_shards(scale: float, tmp: Path, seed: int) -> CaseResult:
+    import pandas as pd
+
+    from dataset_builder import LazyConversationDataset, build_shards
+
+    img_dir = tmp / "images"
+    img_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, im in enumerate(_synthetic_images(max(8, int(500 * scale)), seed)):
+        p = img_dir / f"img{i:05d}.jpg"
+        im.save(p, quality=90)
+        paths.append(p.as_posix())
+    meta = pd.DataFrame({"image_path": paths, "text": [f"caption {i}" for i in range(len(paths))],
+                         "__class__": "Normal"})
+    t0 = time.perf_counter()
+    build_shards(meta, tmp / "shards", rows_per_shard=200)
+    lat = [time.perf_counter() - t0]
+    ds = LazyConversationDataset.open(tmp / "shards")
+    for i in range(len(ds)):
+        t0 = time.perf_counter()
+        ds[i]
+        lat.append(time.perf_counter() - t0)
+    return len(paths), lat
+
+
+CASES: Dict[str, Callable[[float, Path, int], CaseResult]] = {
+    "generate_disease": case_generate_disease,
+    "generate_stream": case_generate_stream,
+    "generate_user_input": case_generate_user_input,
+    "make_schema": case_make_schema,
+    "render": case_render,
+    "split_csv": case_split_csv,
+    "quality_gate": case_quality_gate,
+    "augment": case_augment,
+    "build_shards": case_build_shards,
+}
+
+
+# ---------- harness ----------
+
+def run_case(name: str, scale: float = 1.0, seed: int = 0, quiet: bool = True) -> Dict:
+    fn = CASES[name]
+    isolated = _reset_peak_rss()
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as tmp:
+        out = io.StringIO()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+            items, lat = fn(scale, Path(tmp), seed)
+        seconds = time.perf_counter() - t0
+    return {
+        "items": int(items),
+        "seconds": round(seconds, 4),
+        "items_per_s": round(items / seconds, 2) if seconds > 0 else None,
+        "units": len(lat),
+        "p50_ms": _percentile_ms(lat, 50),
+        "p99_ms": _percentile_ms(lat, 99),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "rss_isolated": isolated,
+    }
+
+
+def run_suite(names: Sequence[str], scale: float = 1.0, seed: int = 0, quiet: bool = True) -> Dict:
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": scale,
+        "seed": seed,
+        "cases": {},
+    }
+    for name in names:
+        r = report["cases"][name] = run_case(name, scale, seed, quiet)
+        print(f"[Bench] {name:<20s} {r['items']:>8d} items  {r['seconds']:7.2f}s  {r['items_per_s'] or 0:>11,.1f}/s  "
+              f"p50 {r['p50_ms']} ms  p99 {r['p99_ms']} ms  peak {r['peak_rss_mb']} MB")
+    return report
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float = 0.25) -> List[str]:
+    """รายชื่อกรณีที่ items/s ต่ำกว่า baseline เกิน tolerance (เทียบเฉพาะกรณีและ scale เดียวกัน)"""
+    if baseline.get("scale") != report.get("scale"):
+        print(f"[WARN] baseline scale={baseline.get('scale')} ไม่ตรงกับ {report.get('scale')} → เทียบไม่ได้")
+        return []
+    slower = []
+    for name, r in report["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if not old or not old.get("items_per_s") or not r.get("items_per_s"):
+            continue
+        ratio = r["items_per_s"] / old["items_per_s"]
+        r["vs_baseline"] = round(ratio, 3)
+        if ratio < 1 - tolerance:
+            slower.append(name)
+            print(f"[Regression] {name}: {old['items_per_s']:,.1f}/s → {r['items_per_s']:,.1f}/s ({ratio:.0%})")
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark suite for the data-prep path (fake Gemini)")
+    parser.add_argument("--only", nargs="+", choices=sorted(CASES), help="รันเฉพาะกรณีที่เลือก")
+    parser.add_argument("--quick", action="store_true", help="ลดขนาดงานเหลือ 1/10 (scale=0.1)")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="เขียนผลเป็น JSON")
+    parser.add_argument("--baseline", default=None, help="JSON ผลเก่าสำหรับเทียบ")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--verbose", action="store_true", help="แสดง log ของแต่ละกรณี")
+    args = parser.parse_args()
+
+    report = run_suite(args.only or list(CASES), 0.1 if args.quick else args.scale, args.seed, not args.verbose)
+    slower = []
+    if args.baseline:
+        slower = compare(report, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.tolerance)
+        report["regressions"] = slower
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[Saved] {args.out}")
+    sys.exit(1 if slower else 0)
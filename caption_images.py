@@ -0,0 +1,397 @@
+"""
+caption รูป X-ray ใหม่แบบ offline เป็น batch (แทนการ copy cell model.generate ทีละรูปใน progress3_qwen.ipynb)
+
+- input: โฟลเดอร์ (หารูปแบบ recursive) หรือ manifest (.csv/.jsonl ที่มีคอลัมน์ image/path/file, หรือ .txt บรรทัดละ path)
+- generate ผ่าน batched_generation.generate_batched: pad ซ้าย, เรียงตามขนาดภาพ/ความยาว prompt แล้วตัดเป็น micro-batch
+  รูปที่ยังไม่มีผลถูกแบ่งเป็นก้อนละ chunk_size รูป → เปิดรูปทีละก้อน และผลของแต่ละก้อนลง cache ทันที
+- CaptionCache: key = hash ของ (ไบต์รูป, model id, prompt, generation params + การ preprocess รูป)
+  → รันโฟลเดอร์เดิมซ้ำ generate เฉพาะรูปใหม่/ไฟล์ที่เปลี่ยน; เปลี่ยน adapter/prompt/params/side/fit = key ใหม่ทั้งหมด
+  รูปเนื้อหาเดียวกันคนละชื่อไฟล์ generate ครั้งเดียว
+  เก็บเป็น JSONL append-only (captions.jsonl); บรรทัดที่เขียนค้างตอน process ตายจะถูกข้ามตอนเปิดใหม่
+  hash ของรูปจำตาม (path, size, mtime) → รอบถัดไปไม่ต้องอ่านไฟล์ที่ไม่เปลี่ยน
+- model_id(): ชื่อ base + hash ของไฟล์ในโฟลเดอร์ adapter (ไม่ใช่แค่ชื่อโฟลเดอร์) → save LoRA ทับที่เดิมก็ได้ key ใหม่
+- image_cache (image_cache.ImageCache) → ใช้รูปที่ preprocess แล้วแทนการ decode ใหม่
+
+CLI (รันจาก root ของ repo):
+    python caption_images.py new_xrays/ --base unsloth/Qwen2.5-VL-3B-Instruct-bnb-4bit \\
+        --adapter lora_model_20251005_175200 --out captions.csv
+    python caption_images.py manifest.csv --batch-size 8 --max-new-tokens 128 --image-cache lung8_image_cache
+    python caption_images.py --selftest     → GPT-2 จิ๋ว (สุ่มน้ำหนัก) บน CPU ตรวจว่ารอบซ้ำไม่ generate ใหม่
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+import torch
+from PIL import Image
+
+from batched_generation import extract_pred_class, generate_batched
+from class_scoring import instruction
+
+CACHE_NAME = "captions.jsonl"
+PATH_COLUMNS = ("image", "path", "image_path", "file", "filename")
+ADAPTER_SUFFIXES = {".json", ".safetensors", ".bin", ".model"}
+
+
+# ---------- key ----------
+
+def _digest(*parts: bytes) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        h.update(p)
+    return h.hexdigest()
+
+
+def model_id(base: str, adapter: Optional[str] = None) -> str:
+    """ชื่อ base (+ ชื่อ adapter @ hash ของ config/น้ำหนัก)"""
+    if not adapter:
+        return base
+    files = sorted(p for p in Path(adapter).rglob("*") if p.is_file() and p.suffix in ADAPTER_SUFFIXES)
+    if not files:
+        raise FileNotFoundError(f"{adapter}: ไม่พบ adapter_config.json / ไฟล์น้ำหนัก")
+    h = hashlib.blake2b(digest_size=8)
+    for p in files:
+        h.update(p.relative_to(adapter).as_posix().encode("utf-8"))
+        with p.open("rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return f"{base}+{Path(adapter).name}@{h.hexdigest()}"
+
+
+def cache_key(image_hash: str, model: str, prompt: str, params: Dict[str, Any]) -> str:
+    blob = json.dumps([image_hash, model, prompt, params], sort_keys=True, ensure_ascii=False)
+    return _digest(blob.encode("utf-8"))
+
+
+# ---------- cache ----------
+
+class CaptionCache:
+    """ผล caption ที่ generate แล้ว (JSONL append-only) + index key → record ในหน่วยความจำ"""
+
+    def __init__(self, root: Path = Path("caption_cache")):
+        self.path = Path(root) / CACHE_NAME
+        self.records: Dict[str, Dict] = {}
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+        self.skipped = 0
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        self.skipped += 1          # บรรทัดสุดท้ายที่เขียนไม่จบ
+                        continue
+                    self.records[rec["key"]] = rec
+                    self._hashes[(rec["path"], rec["size"], rec["mtime_ns"])] = rec["image_hash"]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.records
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.records.get(key)
+
+    def image_hash(self, path: Path) -> Tuple[str, int, int]:
+        """(hash ของไบต์ไฟล์, size, mtime_ns) — อ่านไฟล์เฉพาะเมื่อ (path, size, mtime) ไม่เคยเห็น"""
+        st = os.stat(path)
+        memo = (str(path), st.st_size, st.st_mtime_ns)
+        h = self._hashes.get(memo)
+        if h is None:
+            h = self._hashes[memo] = _digest(Path(path).read_bytes())
+        return h, st.st_size, st.st_mtime_ns
+
+    def put(self, records: Sequence[Dict]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                self.records[rec["key"]] = rec
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# ---------- input ----------
+
+def _column(df: pd.DataFrame, source: Path) -> str:
+    for c in df.columns:
+        if str(c).lower() in PATH_COLUMNS:
+            return c
+    raise ValueError(f"{source}: ไม่พบคอลัมน์ path ของรูป (ต้องเป็นหนึ่งใน {', '.join(PATH_COLUMNS)})")
+
+
+def read_inputs(source: Path) -> List[Path]:
+    """โฟลเดอร์ → รูปทั้งหมด (recursive); manifest → path ตามลำดับในไฟล์ (path สัมพัทธ์นับจากโฟลเดอร์ของ manifest)"""
+    source = Path(source)
+    if source.is_dir():
+        from image_balance import list_images
+
+        return list_images(source)
+    if source.suffix.lower() == ".csv":
+        df = pd.read_csv(source)
+        names = df[_column(df, source)].astype(str).tolist()
+    elif source.suffix.lower() in (".jsonl", ".json"):
+        df = pd.read_json(source, lines=source.suffix.lower() == ".jsonl")
+        names = df[_column(df, source)].astype(str).tolist()
+    else:
+        names = [ln.strip() for ln in source.read_text(encoding="utf-8").splitlines() if ln.strip()]
+    return [p if p.is_absolute() else source.parent / p for p in map(Path, names)]
+
+
+def _image_params(image_cache=None) -> Any:
+    """การ preprocess รูปที่โมเดลเห็น (ส่วนหนึ่งของ key): side/fit ของ image_cache หรือ "raw" (decode เป็น L เฉย ๆ)"""
+    if image_cache is None:
+        return "raw"
+    return {"side": image_cache.side, "fit": image_cache.fit}
+
+
+def _load_image(path: Path, image_cache=None) -> Image.Image:
+    if image_cache is not None:
+        return image_cache.get_path(path)
+    with Image.open(path) as im:
+        return im.convert("L")
+
+
+# ---------- caption ----------
+
+def caption_paths(
+    model,
+    processor,
+    paths: Sequence[Path],
+    cache: CaptionCache,
+    model_name: str,
+    prompt: str = instruction,
+    batch_size: int = 8,
+    max_new_tokens: int = 128,
+    chunk_size: int = 256,
+    image_cache=None,
+    **generate_kwargs,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    caption ทุก path (ใช้ผลใน cache ถ้ามี) คืน (ผลต่อรูปตามลำดับ paths, สถิติ)
+    ผลแต่ละรูป: path, image_hash, text, pred_cls, cached
+    """
+    t0 = time.perf_counter()
+    params = {"max_new_tokens": max_new_tokens, "do_sample": False, **generate_kwargs,
+              "image": _image_params(image_cache)}
+    entries, todo = [], {}
+    for path in map(Path, paths):
+        image_hash, size, mtime_ns = cache.image_hash(path)
+        key = cache_key(image_hash, model_name, prompt, params)
+        entries.append((path, key, key in cache))
+        if key not in cache and key not in todo:
+            todo[key] = (path, image_hash, size, mtime_ns)
+    hash_s = time.perf_counter() - t0
+
+    pending = list(todo.items())
+    generated, gen_s, batches = 0, 0.0, 0
+    for start in range(0, len(pending), max(1, chunk_size)):
+        chunk = pending[start:start + chunk_size]
+        rows = [{"messages": [{"role": "user", "content": [
+            {"type": "image", "image": _load_image(path, image_cache)},
+            {"type": "text", "text": prompt},
+        ]}]} for _, (path, *_rest) in chunk]
+        results, stats = generate_batched(model, processor, rows, batch_size=batch_size,
+                                          max_new_tokens=max_new_tokens, **generate_kwargs)
+        cache.put([{
+            "key": key,
+            "path": str(path),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "image_hash": image_hash,
+            "model": model_name,
+            "prompt": prompt,
+            "params": params,
+            "text": r["text"],
+            "pred_cls": r["pred_cls"],
+            "ts": time.time(),
+        } for r in results for key, (path, image_hash, size, mtime_ns) in [chunk[r["index"]]]])
+        generated += stats.done
+        gen_s += stats.elapsed
+        batches += stats.batches
+        print(f"[Caption] {generated}/{len(pending)} รูปใหม่ ({stats.samples_per_sec:.2f} รูป/s, "
+              f"{stats.batches} batches, padding {stats.padding_ratio:.0%})")
+
+    out = []
+    for path, key, hit in entries:
+        rec = cache.get(key)
+        out.append({"path": str(path), "image_hash": rec["image_hash"], "text": rec["text"],
+                    "pred_cls": rec.get("pred_cls") or extract_pred_class(rec["text"]) or "", "cached": hit})
+    summary = {
+        "images": len(entries),
+        "cached": sum(hit for _, _, hit in entries),
+        "generated": generated,
+        "batches": batches,
+        "hash_s": hash_s,
+        "generate_s": gen_s,
+        "elapsed": time.perf_counter() - t0,
+    }
+    print(f"[Done] {summary['images']} รูป: cache {summary['cached']}, generate {generated} "
+          f"ใน {gen_s:.1f}s (hash {hash_s:.2f}s, รวม {summary['elapsed']:.1f}s)")
+    return out, summary
+
+
+def load_model(base: str, adapter: Optional[str] = None, device_map: str = "auto", unsloth: bool = False):
+    """
+    โหลด base (+ LoRA adapter ผ่าน peft) สำหรับ inference
+    unsloth=True → FastVisionModel.from_pretrained + for_inference แบบเดียวกับ progress3_qwen.ipynb
+    """
+    if unsloth:
+        from unsloth import FastVisionModel
+
+        model, tokenizer = FastVisionModel.from_pretrained(base, load_in_4bit="bnb-4bit" in base)
+        if adapter:
+            model.load_adapter(adapter)
+        FastVisionModel.for_inference(model)
+        model.eval()
+        return model, tokenizer
+
+    from transformers import AutoModelForImageTextToText, AutoProcessor
+
+    model = AutoModelForImageTextToText.from_pretrained(base, torch_dtype="auto", device_map=device_map)
+    if adapter:
+        model.load_adapter(adapter)
+    model.eval()
+    return model, AutoProcessor.from_pretrained(base)
+
+
+def write_results(results: List[Dict[str, Any]], out: Path) -> None:
+    df = pd.DataFrame(results, columns=["path", "image_hash", "text", "pred_cls", "cached"])
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    if out.suffix.lower() == ".jsonl":
+        df.to_json(out, orient="records", lines=True, force_ascii=False)
+    else:
+        df.to_csv(out, index=False, encoding="utf-8")
+    print(f"[Saved] {out}  ({len(df)} แถว)")
+
+
+# ---------- self-test บน CPU ----------
+
+class _ByteChatTokenizer:
+    """tokenizer ระดับไบต์ + chat template แบบง่าย (ไม่ต้องโหลดไฟล์) สำหรับ self-test ของ generate_batched"""
+    pad_token_id = 0
+    eos_token_id = 0
+    padding_side = "right"
+
+    def apply_chat_template(self, messages, tokenize: bool = False, add_generation_prompt: bool = True) -> str:
+        text = "".join(f"{t['role']}: " + " ".join(c.get("text", "<image>") for c in t["content"]) + "\n"
+                       for t in messages)
+        return text + ("assistant: " if add_generation_prompt else "")
+
+    def __call__(self, texts, add_special_tokens: bool = False, return_tensors: str = "pt", padding: bool = True):
+        rows = [[b + 1 for b in t.encode("utf-8")] for t in texts]
+        width = max(map(len, rows))
+        ids = torch.zeros(len(rows), width, dtype=torch.long)
+        mask = torch.zeros_like(ids)
+        for i, r in enumerate(rows):
+            sl = slice(width - len(r), width) if self.padding_side == "left" else slice(0, len(r))
+            ids[i, sl] = torch.tensor(r)
+            mask[i, sl] = 1
+        return {"input_ids": ids, "attention_mask": mask}
+
+    def batch_decode(self, ids, skip_special_tokens: bool = True) -> List[str]:
+        return [bytes(t - 1 for t in row.tolist() if 0 < t <= 256).decode("utf-8", "replace") for row in ids]
+
+
+def tiny_model(seed: int = 0):
+    """GPT-2 จิ๋ว (สุ่มน้ำหนัก) + tokenizer ระดับไบต์ ใช้แทน (model, processor) ตอนทดสอบบน CPU (ไม่ดูภาพ)"""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=257, n_positions=512, n_embd=32, n_layer=2, n_head=2,
+                                       bos_token_id=0, eos_token_id=0)).eval()
+    return model, _ByteChatTokenizer()
+
+
+def _selftest(n_images: int = 12, batch_size: int = 4, max_new_tokens: int = 16, seed: int = 0) -> Dict[str, Any]:
+    import numpy as np
+
+    model, tok = tiny_model(seed)
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp) / "xrays"
+        folder.mkdir()
+        for i in range(n_images):
+            side = int(rng.integers(32, 96))
+            Image.fromarray(rng.integers(0, 256, (side, side), dtype=np.uint8), "L").save(folder / f"{i:03d}.png")
+        # รูปซ้ำคนละชื่อ → generate ครั้งเดียว
+        (folder / "dup.png").write_bytes((folder / "000.png").read_bytes())
+
+        def run(**kw):
+            cache = CaptionCache(Path(tmp) / "cache")
+            return caption_paths(model, tok, read_inputs(folder), cache, model_name="tiny-gpt2",
+                                 batch_size=batch_size, **{"max_new_tokens": max_new_tokens, **kw})[1]
+
+        first = run()
+        second = run()
+        Image.fromarray(rng.integers(0, 256, (40, 40), dtype=np.uint8), "L").save(folder / "005.png")
+        changed = run()
+        new_params = run(max_new_tokens=max_new_tokens + 1)
+        from image_cache import ImageCache
+
+        # รูปที่ผ่าน image cache (letterbox เป็น side×side) ไม่ใช่รูปเดียวกับที่โมเดลเห็นตอน raw → key ใหม่
+        resized = run(image_cache=ImageCache(Path(tmp) / "image_cache", side=56, max_mb=4))
+        # เปิดซ้ำแบบ CLI (--image-cache): ใช้ side/fit ตาม meta.json, รูปยังอยู่ครบ → key เดิม ไม่ generate ใหม่
+        reopened_cache = ImageCache.open(Path(tmp) / "image_cache")
+        reopened = run(image_cache=reopened_cache)
+
+    assert first["generated"] == n_images and first["cached"] == 0, first
+    assert second["generated"] == 0 and second["cached"] == n_images + 1, second
+    assert changed["generated"] == 1, changed
+    assert new_params["generated"] == n_images, new_params
+    assert resized["generated"] == n_images, resized
+    assert reopened_cache.side == 56 and len(reopened_cache) == n_images and reopened["generated"] == 0, reopened
+    print(f"[SelfTest] ok: รอบแรก generate {first['generated']} ({first['generate_s']:.2f}s), "
+          f"รอบซ้ำ 0 ({second['elapsed']:.3f}s), ไฟล์เปลี่ยน 1, params เปลี่ยน {new_params['generated']}, "
+          f"image cache {resized['generated']}")
+    return {"first": first, "second": second, "changed": changed, "new_params": new_params, "resized": resized}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caption X-ray images in batches with a result cache")
+    parser.add_argument("source", nargs="?", help="โฟลเดอร์รูป หรือ manifest (.csv / .jsonl / .txt)")
+    parser.add_argument("--base", default="unsloth/Qwen2.5-VL-3B-Instruct-bnb-4bit")
+    parser.add_argument("--adapter", default=None, help="โฟลเดอร์ LoRA เช่น lora_model_20251005_175200")
+    parser.add_argument("--unsloth", action="store_true", help="โหลดผ่าน FastVisionModel แทน transformers")
+    parser.add_argument("--prompt", default=instruction)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--chunk-size", type=int, default=256, help="จำนวนรูปที่เปิดพร้อมกัน/เขียนลง cache ต่อรอบ")
+    parser.add_argument("--cache", default="caption_cache")
+    parser.add_argument("--image-cache", default=None, help="โฟลเดอร์ ImageCache ที่ warm ไว้แล้ว (ใช้ side/fit ตาม meta.json ของ cache)")
+    parser.add_argument("--out", default="captions.csv", help=".csv หรือ .jsonl")
+    parser.add_argument("--selftest", action="store_true")
+    args = parser.parse_args()
+
+    if args.selftest:
+        _selftest()
+    elif args.source is None:
+        parser.print_help()
+    else:
+        image_cache = None
+        if args.image_cache:
+            from image_cache import ImageCache
+
+            # side/fit ตามที่ warm ไว้ — ImageCache(...) ด้วยค่าเริ่มต้นจะล้าง cache ที่สร้างด้วย --side อื่น
+            image_cache = ImageCache.open(Path(args.image_cache))
+        model, processor = load_model(args.base, args.adapter, unsloth=args.unsloth)
+        results, _ = caption_paths(
+            model, processor, read_inputs(Path(args.source)), CaptionCache(args.cache),
+            model_name=model_id(args.base, args.adapter),
+            prompt=args.prompt,
+            batch_size=args.batch_size,
+            max_new_tokens=args.max_new_tokens,
+            chunk_size=args.chunk_size,
+            image_cache=image_cache,
+        )
+        if image_cache is not None:
+            image_cache.flush()
+        write_results(results, Path(args.out))
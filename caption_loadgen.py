@@ -0,0 +1,142 @@
+"""
+load generator ของ caption_server.py: วัด throughput และ tail latency
+
+- closed loop (--concurrency N): N client ยิงต่อเนื่อง (ได้ผลแล้วยิงใหม่ทันที) → throughput สูงสุดของ server
+- open loop (--rate R): ยิงตามเวลาแบบ Poisson R request/s ไม่สนว่าคำตอบกลับหรือยัง
+  → latency ที่ได้ไม่ถูกกดด้วยความช้าของ client เอง (coordinated omission) ใช้ดู p99 ที่โหลดจริง
+- รูป: --images <โฟลเดอร์> หรือรูปสุ่มขนาดต่าง ๆ (PNG gray)
+- 503 (คิวเต็ม) / 504 (timeout) นับแยก ไม่ retry → เห็นว่า backpressure ทำงานตอนไหน (retry_after_s = Retry-After สูงสุด)
+- รายงาน: req/s, p50/p95/p99/max latency (ms), ขนาด batch เฉลี่ยจาก /stats ของ server; --out เขียน JSON
+
+CLI (รันจาก root ของ repo):
+    python caption_server.py --tiny --port 8080 &
+    python caption_loadgen.py --url http://127.0.0.1:8080 --concurrency 32 --requests 500
+    python caption_loadgen.py --rate 50 --duration 20 --out load.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image
+
+
+def synthetic_images(n: int = 16, seed: int = 0) -> List[bytes]:
+    rng = np.random.default_rng(seed)
+    out = []
+    for _ in range(n):
+        side = int(rng.integers(64, 256))
+        buf = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (side, side), dtype=np.uint8), "L").save(buf, format="PNG")
+        out.append(buf.getvalue())
+    return out
+
+
+def folder_images(folder: Path, limit: int = 64) -> List[bytes]:
+    from image_balance import list_images
+
+    return [p.read_bytes() for p in list_images(Path(folder))[:limit]]
+
+
+async def _one(client: httpx.AsyncClient, url: str, body: bytes, latencies: List[float], codes: Dict[int, int],
+               retry_after: List[float]) -> None:
+    t0 = time.perf_counter()
+    try:
+        resp = await client.post(url, content=body, headers={"Content-Type": "image/png"})
+        status = resp.status_code
+    except httpx.HTTPError:
+        status = 0
+    codes[status] = codes.get(status, 0) + 1
+    if status == 200:
+        latencies.append(time.perf_counter() - t0)
+    elif status == 503 and "retry-after" in resp.headers:
+        retry_after.append(float(resp.headers["retry-after"]))
+
+
+async def run_load(url: str, images: List[bytes], concurrency: Optional[int] = None, rate: Optional[float] = None,
+                   requests: int = 200, duration: Optional[float] = None, seed: int = 0,
+                   timeout: float = 120) -> Dict:
+    """ยิง /caption แบบ closed loop (concurrency) หรือ open loop (rate) คืนสรุปผล"""
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    codes: Dict[int, int] = {}
+    retry_after: List[float] = []
+    limits = httpx.Limits(max_connections=concurrency or 1000, max_keepalive_connections=concurrency or 1000)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        before = (await client.get("/stats")).json()
+        t0 = time.perf_counter()
+        if rate:
+            tasks = []
+            stop_at = t0 + duration if duration else None
+            sent = 0
+            while (sent < requests) if stop_at is None else (time.perf_counter() < stop_at):
+                tasks.append(asyncio.create_task(
+                    _one(client, "/caption", rng.choice(images), latencies, codes, retry_after)))
+                sent += 1
+                await asyncio.sleep(rng.expovariate(rate))
+            await asyncio.gather(*tasks)
+        else:
+            left = iter(range(requests))
+            stop_at = t0 + duration if duration else None
+
+            async def worker():
+                while stop_at is None or time.perf_counter() < stop_at:
+                    if stop_at is None and next(left, None) is None:
+                        return
+                    await _one(client, "/caption", rng.choice(images), latencies, codes, retry_after)
+
+            await asyncio.gather(*(worker() for _ in range(concurrency or 1)))
+        elapsed = time.perf_counter() - t0
+        after = (await client.get("/stats")).json()
+
+    lat_ms = np.asarray(latencies) * 1000
+    batches = after["batches"] - before["batches"]
+    summary = {
+        "mode": f"rate={rate}/s" if rate else f"concurrency={concurrency}",
+        "sent": sum(codes.values()),
+        "ok": codes.get(200, 0),
+        "rejected_503": codes.get(503, 0),
+        "timeout_504": codes.get(504, 0),
+        "errors": sum(v for k, v in codes.items() if k not in (200, 503, 504)),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(codes.get(200, 0) / elapsed, 2) if elapsed else 0.0,
+        "mean_batch": round((after["batched_items"] - before["batched_items"]) / batches, 2) if batches else 0.0,
+        "retry_after_s": max(retry_after) if retry_after else None,
+    }
+    if len(lat_ms):
+        for q in (50, 95, 99):
+            summary[f"p{q}_ms"] = round(float(np.percentile(lat_ms, q)), 1)
+        summary["max_ms"] = round(float(lat_ms.max()), 1)
+    print(f"[Load] {summary['mode']}: ok {summary['ok']}/{summary['sent']} "
+          f"(503 {summary['rejected_503']}, 504 {summary['timeout_504']}, error {summary['errors']}) "
+          f"ใน {summary['seconds']:.1f}s → {summary['throughput_rps']:.1f} req/s, batch เฉลี่ย {summary['mean_batch']}"
+          + (f", p50 {summary['p50_ms']} / p95 {summary['p95_ms']} / p99 {summary['p99_ms']} ms" if len(lat_ms) else ""))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for caption_server.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--concurrency", type=int, default=16, help="closed loop: จำนวน client พร้อมกัน")
+    parser.add_argument("--rate", type=float, default=None, help="open loop: request/s (Poisson) แทน --concurrency")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=None, help="วินาที (แทน --requests)")
+    parser.add_argument("--images", default=None, help="โฟลเดอร์รูป (ไม่ใส่ = รูปสุ่ม)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="เขียนสรุปเป็น JSON")
+    args = parser.parse_args()
+
+    images = folder_images(Path(args.images)) if args.images else synthetic_images(seed=args.seed)
+    summary = asyncio.run(run_load(args.url, images, concurrency=None if args.rate else args.concurrency,
+                                   rate=args.rate, requests=args.requests, duration=args.duration,
+                                   seed=args.seed, timeout=args.timeout))
+    if args.out:
+        Path(args.out).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        print(f"[Saved] {args.out}")
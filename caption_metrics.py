@@ -0,0 +1,277 @@
+"""
+เมตริก caption แบบเร็ว (ไม่พึ่ง evaluate / external lib) สำหรับ CaptionEvalCallback และ compute_metrics
+
+- rouge_l_f1(pred, ref): ผลเท่ากับ rouge_l_f1 เดิมใน qwen_optimize.ipynb แต่หา LCS แบบ bit-parallel
+  (Hyyrö: ตำแหน่งคำของฝั่งที่ยาวกว่าเก็บเป็นบิตของ int ตัวเดียว → วนแค่ตามคำของอีกฝั่ง, ไม่ต้องสร้างตาราง DP)
+- corpus_rouge_l / corpus_bleu: ให้คะแนนทั้งชุด eval ทีเดียว
+  BLEU เก็บสถิติแบบบวกกันได้ (matches / possible ต่อ n-gram + ความยาว) → แบ่ง chunk ไปหลาย process แล้วรวม
+  สูตร BLEU เดียวกับ evaluate.load("bleu") (max_order=4, brevity penalty, smooth=False) แต่ตัดคำด้วย whitespace
+  ไม่ใช่ tokenizer 13a ของ evaluate (ไม่แยกเครื่องหมายวรรคตอน) → ตัวเลขไม่เท่ากับ evaluate ถ้าข้อความมีวรรคตอน
+- ชุดใหญ่ (>= min_parallel คู่) จะใช้ ProcessPoolExecutor อัตโนมัติ
+- benchmark(): เทียบกับ DP เดิมบน caption จริงจาก prepare_data/disease_output/csv
+
+CLI:
+    python caption_metrics.py --bench                 → เวลา/ความเร็ว เทียบ rouge_l_f1 เดิม
+    python caption_metrics.py --bench --pairs 5000 --processes 8
+"""
+import argparse
+import math
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+Refs = Union[str, Sequence[str]]
+
+
+def tokenize(s: str, lower: bool = True) -> List[str]:
+    """แปลงเป็น token ระดับคำแบบหยาบ ๆ (เหมือน tok ใน rouge_l_f1 เดิม)"""
+    if lower:
+        s = s.lower()
+    return s.split()
+
+
+# ---------- ROUGE-L ----------
+
+def lcs_length(x: Sequence[str], y: Sequence[str]) -> int:
+    """
+    ความยาว LCS แบบ bit-parallel: บิต i ของ match[w] = 1 ถ้า x[i] == w
+    ทุกคำของ y ทำแค่ and / บวก / ลบ / or บน int ของ Python ไม่กี่ครั้ง
+    """
+    if not x or not y:
+        return 0
+    if len(x) < len(y):
+        x, y = y, x  # ให้ x ยาวกว่า → วนรอบน้อยกว่า
+    match: Dict[str, int] = {}
+    for i, w in enumerate(x):
+        match[w] = match.get(w, 0) | (1 << i)
+    mask = (1 << len(x)) - 1
+    v = mask
+    for w in y:
+        u = v & match.get(w, 0)
+        v = ((v + u) | (v - u)) & mask
+    return len(x) - bin(v).count("1")
+
+
+def _f1(lcs: int, m: int, n: int) -> float:
+    if lcs == 0:
+        return 0.0
+    prec = lcs / max(1, m)
+    rec = lcs / max(1, n)
+    return 2 * prec * rec / (prec + rec)
+
+
+def rouge_l_f1(pred: str, ref: str) -> float:
+    """
+    ROUGE-L F1 แบบเรียบง่าย (ไม่พึ่ง external lib) ในช่วง [0,1]
+    ใช้เป็น proxy ของคุณภาพ captioning เมื่อยังไม่มี CIDEr
+    """
+    x, y = tokenize(pred), tokenize(ref)
+    if not x or not y:
+        return 0.0
+    return _f1(lcs_length(x, y), len(x), len(y))
+
+
+def _rouge_chunk(pairs: List[Tuple[str, str]]) -> np.ndarray:
+    return np.fromiter((rouge_l_f1(p, r) for p, r in pairs), dtype=np.float64, count=len(pairs))
+
+
+# ---------- BLEU ----------
+
+def _ngram_counts(tokens: List[str], max_order: int) -> Counter:
+    counts: Counter = Counter()
+    for order in range(1, max_order + 1):
+        counts.update(zip(*(tokens[i:] for i in range(order))))
+    return counts
+
+
+def bleu_stats(pairs: List[Tuple[str, Refs]], max_order: int = 4, lower: bool = False) -> np.ndarray:
+    """
+    สถิติที่บวกกันข้าม chunk ได้: [matches(1..N), possible(1..N), hyp_len, ref_len]
+    ref_len ใช้ ref ที่สั้นที่สุด (แบบเดียวกับ evaluate/bleu)
+    """
+    stats = np.zeros(2 * max_order + 2, dtype=np.int64)
+    matches, possible = stats[:max_order], stats[max_order:2 * max_order]
+    for pred, refs in pairs:
+        refs = [refs] if isinstance(refs, str) else list(refs)
+        ref_toks = [tokenize(r, lower) for r in refs]
+        hyp = tokenize(pred, lower)
+        stats[-2] += len(hyp)
+        stats[-1] += min((len(r) for r in ref_toks), default=0)
+        if len(ref_toks) == 1:
+            max_ref = _ngram_counts(ref_toks[0], max_order)
+        else:
+            max_ref = Counter()
+            for r in ref_toks:
+                max_ref |= _ngram_counts(r, max_order)
+        overlap = _ngram_counts(hyp, max_order) & max_ref
+        for ngram, c in overlap.items():
+            matches[len(ngram) - 1] += c
+        for order in range(1, max_order + 1):
+            possible[order - 1] += max(0, len(hyp) - order + 1)
+    return stats
+
+
+def bleu_from_stats(stats: np.ndarray, max_order: int = 4, smooth: bool = False) -> Dict[str, float]:
+    matches = stats[:max_order].astype(np.float64)
+    possible = stats[max_order:2 * max_order].astype(np.float64)
+    hyp_len, ref_len = float(stats[-2]), float(stats[-1])
+    if smooth:
+        precisions = (matches + 1.0) / (possible + 1.0)
+    else:
+        precisions = np.divide(matches, possible, out=np.zeros_like(matches), where=possible > 0)
+    geo_mean = math.exp(float(np.log(precisions).mean())) if precisions.min() > 0 else 0.0
+    ratio = hyp_len / ref_len if ref_len else 0.0
+    bp = 1.0 if ratio > 1.0 else (math.exp(1 - 1.0 / ratio) if ratio > 0 else 0.0)
+    return {"bleu": geo_mean * bp, "precisions": precisions.tolist(), "brevity_penalty": bp,
+            "length_ratio": ratio, "translation_length": int(hyp_len), "reference_length": int(ref_len)}
+
+
+# ---------- ทั้งชุด ----------
+
+def _chunks(items: List, n: int) -> List[List]:
+    size = max(1, math.ceil(len(items) / n))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _workers(n_pairs: int, processes: Optional[int], min_parallel: int) -> int:
+    if processes is None:
+        processes = os.cpu_count() or 1
+    return processes if processes > 1 and n_pairs >= min_parallel else 1
+
+
+def corpus_rouge_l(preds: Sequence[str], refs: Sequence[str], processes: Optional[int] = None,
+                   min_parallel: int = 5000) -> np.ndarray:
+    """ROUGE-L F1 รายคู่ (np.ndarray) — ชุดใหญ่แบ่งไปหลาย process"""
+    pairs = list(zip(preds, refs))
+    workers = _workers(len(pairs), processes, min_parallel)
+    if workers == 1:
+        return _rouge_chunk(pairs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return np.concatenate(list(pool.map(_rouge_chunk, _chunks(pairs, workers * 4))))
+
+
+def _bleu_chunk(args) -> np.ndarray:
+    pairs, max_order, lower = args
+    return bleu_stats(pairs, max_order, lower)
+
+
+def corpus_bleu(preds: Sequence[str], refs: Sequence[Refs], max_order: int = 4, smooth: bool = False,
+                lower: bool = False, processes: Optional[int] = None, min_parallel: int = 5000) -> Dict[str, float]:
+    """corpus BLEU (ตัดคำด้วย whitespace) ของทั้งชุด (refs แต่ละตัวเป็น str หรือ list ของ str)"""
+    pairs = list(zip(preds, refs))
+    workers = _workers(len(pairs), processes, min_parallel)
+    if workers == 1:
+        stats = bleu_stats(pairs, max_order, lower)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(_bleu_chunk, [(c, max_order, lower) for c in _chunks(pairs, workers * 4)])
+            stats = np.sum(list(parts), axis=0)
+    return bleu_from_stats(stats, max_order, smooth)
+
+
+def caption_scores(preds: Sequence[str], refs: Sequence[str], processes: Optional[int] = None,
+                   min_parallel: int = 5000) -> Dict[str, float]:
+    """{"rougeL": ค่าเฉลี่ย ROUGE-L F1, "bleu": corpus BLEU} — ใช้แทน loop rouge_l_f1 + evaluate.load("bleu")"""
+    rouge = corpus_rouge_l(preds, refs, processes, min_parallel)
+    bleu = corpus_bleu(preds, refs, processes=processes, min_parallel=min_parallel)
+    return {"rougeL": float(rouge.mean()) if len(rouge) else 0.0, "bleu": bleu["bleu"]}
+
+
+# ---------- benchmark ----------
+
+def _rouge_l_f1_dp(pred: str, ref: str) -> float:
+    """rouge_l_f1 เดิมจาก qwen_optimize.ipynb (ตาราง DP เต็ม) — ใช้เป็นฐานของ benchmark"""
+    def tok(s):
+        return [w for w in s.strip().split() if w]
+    x, y = tok(pred.lower()), tok(ref.lower())
+    if not x or not y:
+        return 0.0
+    m, n = len(x), len(y)
+    dp = [[0] * (n + 1) for _ in range(m + 1)]
+    for i in range(m):
+        for j in range(n):
+            if x[i] == y[j]:
+                dp[i + 1][j + 1] = dp[i][j] + 1
+            else:
+                dp[i + 1][j + 1] = max(dp[i][j + 1], dp[i + 1][j])
+    lcs = dp[m][n]
+    prec = lcs / max(1, m)
+    rec = lcs / max(1, n)
+    if prec + rec == 0:
+        return 0.0
+    return 2 * prec * rec / (prec + rec)
+
+
+def _load_captions(csv_root: Path) -> List[str]:
+    import pandas as pd
+
+    texts: List[str] = []
+    for p in sorted(Path(csv_root).glob("*.csv")):
+        texts.extend(pd.read_csv(p)["text"].dropna().astype(str).tolist())
+    return texts
+
+
+def benchmark(n_pairs: int = 2000, processes: Optional[int] = None, seed: int = 0,
+              csv_root: Path = Path("prepare_data/disease_output/csv")) -> Dict[str, float]:
+    texts = _load_captions(csv_root)
+    if not texts:
+        raise RuntimeError(f"ไม่พบ caption ใน {csv_root}")
+    rng = random.Random(seed)
+    preds = [rng.choice(texts) for _ in range(n_pairs)]
+    refs = [rng.choice(texts) for _ in range(n_pairs)]
+
+    t0 = time.perf_counter()
+    base = [_rouge_l_f1_dp(p, r) for p, r in zip(preds, refs)]
+    t_dp = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    fast = corpus_rouge_l(preds, refs, processes=1)
+    t_bit = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    corpus_rouge_l(preds, refs, processes=processes, min_parallel=0)
+    t_par = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    bleu = corpus_bleu(preds, refs, processes=1)
+    t_bleu = time.perf_counter() - t0
+
+    max_diff = float(np.max(np.abs(np.asarray(base) - fast)))
+    out = {
+        "pairs": n_pairs,
+        "rouge_dp_s": t_dp,
+        "rouge_bitparallel_s": t_bit,
+        "rouge_parallel_s": t_par,
+        "bleu_s": t_bleu,
+        "speedup": t_dp / t_bit if t_bit else float("inf"),
+        "speedup_parallel": t_dp / t_par if t_par else float("inf"),
+        "max_abs_diff": max_diff,
+        "bleu": bleu["bleu"],
+    }
+    print(f"[Bench] {n_pairs} pairs")
+    print(f"  rouge_l_f1 (DP เดิม)      {t_dp:8.3f}s  {n_pairs / t_dp:10.0f} pairs/s")
+    print(f"  rouge_l_f1 (bit-parallel) {t_bit:8.3f}s  {n_pairs / t_bit:10.0f} pairs/s  x{out['speedup']:.1f}")
+    print(f"  corpus_rouge_l (pool)     {t_par:8.3f}s  {n_pairs / t_par:10.0f} pairs/s  x{out['speedup_parallel']:.1f}")
+    print(f"  corpus_bleu               {t_bleu:8.3f}s  {n_pairs / t_bleu:10.0f} pairs/s  (bleu={bleu['bleu']:.4f})")
+    print(f"  max |DP - bit-parallel| = {max_diff:.2e}")
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fast ROUGE-L / BLEU for caption evaluation")
+    parser.add_argument("--bench", action="store_true", help="เทียบความเร็วกับ rouge_l_f1 เดิม")
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--csv-root", default="prepare_data/disease_output/csv")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark(args.pairs, args.processes, csv_root=Path(args.csv_root))
+    else:
+        parser.print_help()
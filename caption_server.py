@@ -0,0 +1,344 @@
+"""
+HTTP server สำหรับ caption "Class: … / Explanation: …" (แทน cell inference ทีละรูปใน progress3_qwen.ipynb)
+
+- request เข้าคิว asyncio (MicroBatcher) → worker ตัวเดียวดึงเป็น micro-batch แล้ว generate ใน thread
+  (event loop ยังรับ request ต่อได้ระหว่างโมเดลทำงาน, โมเดลไม่ถูกเรียกซ้อนกัน)
+- dynamic batching: รอจนได้ max_batch รูป หรือจน request ที่เก่าที่สุดรอครบ max_wait_ms แล้วยิงทันที
+  → โหลดต่ำ latency เพิ่มไม่เกิน max_wait_ms, โหลดสูงได้ batch เต็ม
+- generate ผ่าน batched_generation.generate_batched (pad ซ้าย, เรียงตามขนาดภาพใน batch)
+- backpressure: คิวจำกัดที่ max_queue → เต็มแล้วตอบ 503 + Retry-After ทันที (ไม่กองงานจน timeout ทั้งหมด)
+  Retry-After = เวลาที่คิวตอนนี้จะหมด: จำนวน batch ที่ค้าง × เวลาต่อ batch ที่วัดได้ (busy_s / batches)
+  request ที่รอเกิน request_timeout ตอบ 504 และถูกข้ามตอนประกอบ batch (ไม่เสียเวลา generate ให้)
+- HTTP/1.1 keep-alive แบบเล็ก ๆ บน asyncio.start_server (ไม่ต้องมี web framework)
+
+endpoint:
+    POST /caption   body = ไบต์รูป (image/*) หรือ JSON {"image": <base64>, "prompt": "..."}
+                    → {"text", "pred_cls", "batch_size", "queue_ms", "latency_ms"}
+    GET  /health    → {"ok": true}
+    GET  /stats     → จำนวน request / batch, ขนาด batch เฉลี่ย, ความยาวคิว, 503/504
+
+CLI (รันจาก root ของ repo):
+    python caption_server.py --base unsloth/Qwen2.5-VL-3B-Instruct-bnb-4bit \\
+        --adapter lora_model_20251005_175200 --unsloth --max-batch 8 --max-wait-ms 20
+    python caption_server.py --tiny --port 8080        → GPT-2 จิ๋วบน CPU (ทดสอบคิว/batching)
+    python caption_loadgen.py --url http://127.0.0.1:8080 --concurrency 32 --requests 500
+    python caption_server.py --selftest                → port 0 + GPT-2 จิ๋ว: batching, 503, Retry-After
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from batched_generation import generate_batched
+from class_scoring import instruction
+
+MAX_BODY = 32 * 2**20
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class CaptionRequest:
+    image: Image.Image
+    prompt: str
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+# ---------- คิว + micro-batch ----------
+
+class MicroBatcher:
+    """
+    คิว request → micro-batch ตามเส้นตาย max_wait_ms ของ request ที่เก่าที่สุด
+    run_batch(list[CaptionRequest]) -> list[dict] ถูกเรียกใน thread ทีละ batch
+    """
+
+    def __init__(self, run_batch: Callable[[List[CaptionRequest]], List[Dict[str, Any]]],
+                 max_batch: int = 8, max_wait_ms: float = 20, max_queue: int = 64,
+                 request_timeout: Optional[float] = 60):
+        self.run_batch = run_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.request_timeout = request_timeout
+        self.queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._running_since: Optional[float] = None
+        self.stats = {"requests": 0, "served": 0, "rejected": 0, "timeouts": 0, "errors": 0,
+                      "batches": 0, "batched_items": 0, "busy_s": 0.0}
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, image: Image.Image, prompt: str = instruction) -> Dict[str, Any]:
+        """เข้าคิวแล้วรอผล; คิวเต็ม → QueueFull, รอเกิน request_timeout → asyncio.TimeoutError"""
+        self.stats["requests"] += 1
+        req = CaptionRequest(image, prompt, asyncio.get_running_loop().create_future())
+        try:
+            self.queue.put_nowait(req)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise QueueFull from None
+        try:
+            return await asyncio.wait_for(asyncio.shield(req.future), self.request_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            req.future.cancel()
+            raise
+
+    async def _collect(self) -> List[CaptionRequest]:
+        first = await self.queue.get()
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return [r for r in batch if not r.future.done()]      # ข้าม request ที่หมดเวลา/ถูกยกเลิกไปแล้ว
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            t0 = self._running_since = time.perf_counter()
+            try:
+                outputs = await asyncio.to_thread(self.run_batch, batch)
+            except Exception as e:
+                self.stats["errors"] += len(batch)
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                continue
+            finally:
+                self._running_since = None
+            done = time.perf_counter()
+            self.stats["busy_s"] += done - t0
+            self.stats["batches"] += 1
+            self.stats["batched_items"] += len(batch)
+            for r, out in zip(batch, outputs):
+                if not r.future.done():
+                    self.stats["served"] += 1
+                    r.future.set_result({**out, "batch_size": len(batch),
+                                         "queue_ms": round((t0 - r.enqueued) * 1000, 2),
+                                         "latency_ms": round((done - r.enqueued) * 1000, 2)})
+
+    def retry_after(self) -> int:
+        """วินาทีจนคิวที่ค้างอยู่หมด: batch ที่ค้าง (+ batch ที่กำลังรัน) × เวลาต่อ batch ที่วัดได้"""
+        s = self.stats
+        per_batch = s["busy_s"] / s["batches"] if s["batches"] else self.max_wait
+        if self._running_since is not None:     # batch ที่รันอยู่นานกว่าค่าเฉลี่ยแล้ว (หรือยังไม่มี batch ไหนเสร็จ)
+            per_batch = max(per_batch, time.perf_counter() - self._running_since)
+        pending = -(-self.queue.qsize() // self.max_batch) + 1
+        return max(1, math.ceil(pending * per_batch + self.max_wait))
+
+    def report(self) -> Dict[str, Any]:
+        s = self.stats
+        return {**s, "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "mean_batch": s["batched_items"] / s["batches"] if s["batches"] else 0.0,
+                "max_batch": self.max_batch, "max_wait_ms": self.max_wait * 1000, "max_queue": self.max_queue}
+
+
+def model_runner(model, processor, max_new_tokens: int = 128, **generate_kwargs):
+    """run_batch สำหรับ MicroBatcher: ทั้ง batch เป็น micro-batch เดียวของ generate_batched"""
+
+    def run_batch(batch: Sequence[CaptionRequest]) -> List[Dict[str, Any]]:
+        rows = [{"messages": [{"role": "user", "content": [
+            {"type": "image", "image": r.image},
+            {"type": "text", "text": r.prompt},
+        ]}]} for r in batch]
+        results, _ = generate_batched(model, processor, rows, batch_size=len(rows),
+                                      max_new_tokens=max_new_tokens, **generate_kwargs)
+        by_index = {r["index"]: r for r in results}
+        return [{"text": by_index[i]["text"], "pred_cls": by_index[i]["pred_cls"]} for i in range(len(rows))]
+
+    return run_batch
+
+
+# ---------- HTTP ----------
+
+def _decode_body(headers: Dict[str, str], body: bytes) -> Tuple[Image.Image, str]:
+    prompt = instruction
+    if headers.get("content-type", "").startswith("application/json"):
+        payload = json.loads(body)
+        data = base64.b64decode(payload["image"])
+        prompt = payload.get("prompt") or prompt
+    else:
+        data = body
+    with Image.open(io.BytesIO(data)) as im:
+        return im.convert("L"), prompt
+
+
+class CaptionServer:
+    def __init__(self, batcher: MicroBatcher, host: str = "127.0.0.1", port: int = 8080):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self) -> None:
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"[Serve] http://{self.host}:{self.port}  (max_batch {self.batcher.max_batch}, "
+              f"max_wait {self.batcher.max_wait * 1000:.0f} ms, max_queue {self.batcher.max_queue})")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def _route(self, method: str, path: str, headers: Dict[str, str],
+                     body: bytes) -> Tuple[int, Dict, Dict[str, str]]:
+        if method == "GET" and path == "/health":
+            return 200, {"ok": True}, {}
+        if method == "GET" and path == "/stats":
+            return 200, self.batcher.report(), {}
+        if path != "/caption" or method != "POST":
+            return 404, {"error": f"{method} {path}"}, {}
+        try:
+            image, prompt = _decode_body(headers, body)
+        except Exception as e:
+            return 400, {"error": f"อ่านรูปไม่ได้: {e}"}, {}
+        try:
+            return 200, await self.batcher.submit(image, prompt), {}
+        except QueueFull:
+            return 503, {"error": "queue full"}, {"Retry-After": str(self.batcher.retry_after())}
+        except asyncio.TimeoutError:
+            return 504, {"error": "timeout"}, {}
+        except Exception as e:
+            return 500, {"error": repr(e)}, {}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                size = int(headers.get("content-length", 0))
+                if size > MAX_BODY:
+                    status, payload, extra = 413, {"error": f"body > {MAX_BODY} bytes"}, {"Connection": "close"}
+                else:
+                    body = await reader.readexactly(size) if size else b""
+                    status, payload, extra = await self._route(method, target.split("?", 1)[0], headers, body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                close = headers.get("connection", "").lower() == "close" or extra.get("Connection") == "close"
+                head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Content-Type: application/json",
+                        f"Content-Length: {len(data)}", f"Connection: {'close' if close else 'keep-alive'}"]
+                head += [f"{k}: {v}" for k, v in extra.items() if k != "Connection"]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def _selftest(max_new_tokens: int = 8, slow_s: float = 0.5) -> Dict[str, Any]:
+    """port 0 + GPT-2 จิ๋ว: โหลดพร้อมกันต้องรวมเป็น batch > 1, คิวล้นต้องได้ 503 + Retry-After จากเวลาต่อ batch"""
+    from caption_images import tiny_model
+    from caption_loadgen import run_load, synthetic_images
+
+    model, processor = tiny_model()
+    run_batch = model_runner(model, processor, max_new_tokens)
+    images = synthetic_images(8)
+
+    def slow_batch(batch):
+        time.sleep(slow_s)          # generate ช้ากว่า max_wait มาก → Retry-After ต้องมาจากเวลาที่วัดได้
+        return run_batch(batch)
+
+    async def serve(batcher: MicroBatcher, **load) -> Dict[str, Any]:
+        server = CaptionServer(batcher, port=0)
+        await server.start()
+        try:
+            return await run_load(f"http://127.0.0.1:{server.port}", images, **load)
+        finally:
+            await server.stop()
+
+    batched = asyncio.run(serve(MicroBatcher(run_batch, max_batch=8, max_wait_ms=20), concurrency=16, requests=64))
+    overfilled = asyncio.run(serve(MicroBatcher(slow_batch, max_batch=2, max_wait_ms=5, max_queue=4),
+                                   concurrency=32, duration=4 * slow_s))
+    assert batched["ok"] == batched["sent"] and batched["mean_batch"] > 1, batched
+    assert overfilled["rejected_503"] > 0 and overfilled["ok"] > 0, overfilled
+    # คิว 4 / batch 2 → ค้าง 2 batch + 1 ที่กำลังรัน × ≥ slow_s ต่อ batch
+    assert overfilled["retry_after_s"] >= math.ceil(3 * slow_s), overfilled
+    print(f"[SelfTest] ok: batch เฉลี่ย {batched['mean_batch']}, คิวล้น 503 × {overfilled['rejected_503']} "
+          f"(Retry-After {overfilled['retry_after_s']:.0f}s)")
+    return {"batched": batched, "overfilled": overfilled}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caption server with dynamic micro-batching")
+    parser.add_argument("--base", default="unsloth/Qwen2.5-VL-3B-Instruct-bnb-4bit")
+    parser.add_argument("--adapter", default=None, help="โฟลเดอร์ LoRA เช่น lora_model_20251005_175200")
+    parser.add_argument("--unsloth", action="store_true", help="โหลดผ่าน FastVisionModel.for_inference")
+    parser.add_argument("--tiny", action="store_true", help="GPT-2 จิ๋วบน CPU แทนโมเดลจริง")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60, help="วินาทีที่ request รอได้ก่อนตอบ 504")
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--selftest", action="store_true")
+    args = parser.parse_args()
+
+    if args.selftest:
+        _selftest()
+        raise SystemExit
+    from caption_images import load_model, tiny_model
+
+    model, processor = tiny_model() if args.tiny else load_model(args.base, args.adapter, unsloth=args.unsloth)
+    batcher = MicroBatcher(model_runner(model, processor, args.max_new_tokens), max_batch=args.max_batch,
+                           max_wait_ms=args.max_wait_ms, max_queue=args.max_queue, request_timeout=args.timeout)
+    try:
+        asyncio.run(CaptionServer(batcher, args.host, args.port).serve_forever())
+    except KeyboardInterrupt:
+        print(f"[Serve] หยุด: {json.dumps(batcher.report(), ensure_ascii=False)}")
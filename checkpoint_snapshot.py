@@ -0,0 +1,440 @@
+"""
+snapshot ของโมเดลที่ merge LoRA แล้ว (แทนการ from_pretrained base 4-bit + get_peft_model/load_adapter ทุก session)
+
+- save_snapshot(): merge adapter ลงน้ำหนัก base (W += scale · B @ A, scale = alpha / r หรือ alpha / √r ถ้า use_rslora)
+  แล้วเขียนเป็น safetensors แบ่ง shard + model.safetensors.index.json (layout เดียวกับ HF)
+  → from_pretrained(snapshot) ได้ตรง ๆ, safetensors ถูก mmap ตอนโหลด ไม่ต้อง unpickle/ไม่ต้องมี peft
+  + config / processor / snapshot.json (base, adapter id, dtype, เวลาที่สร้าง)
+  base ที่เป็น bnb-4bit merge ไม่ได้ → ใช้ base ตัวเต็มของรุ่นเดียวกัน (ตัด "-bnb-4bit" ออกจากชื่อ) แล้วค่อย quantize ตอนโหลดถ้าต้องการ
+- merge ทำด้วย torch ล้วนจาก adapter_model.safetensors + adapter_config.json ที่ model.save_pretrained(save_dir) เขียนไว้
+  รองรับ nn.Linear และ Conv1D (GPT-2); key ของ adapter ที่ชื่อ module ต่างจากโมเดล (เช่น transformers รุ่นใหม่
+  ย้าย language model ไปไว้ใต้ model.language_model) จับคู่ด้วย suffix ของชื่อ module ที่ไม่ซ้ำ
+- load_snapshot(): โหลด + จับเวลา cold start แยกช่วง (config, น้ำหนัก, processor) พิมพ์ [ColdStart]
+- AdapterRegistry: ลงทะเบียนหลาย adapter (เช่น vision-only กับ full fine-tune) บนโมเดล base ที่โหลดไว้แล้ว
+  activate(name) → คืนน้ำหนักเดิมเฉพาะ module ที่ adapter ก่อนหน้าแตะ (อ่านจาก safetensors ของ snapshot แบบ mmap
+  หรือจากสำเนาในหน่วยความจำถ้าไม่มีไฟล์) แล้ว merge adapter ใหม่ → สลับ adapter ได้โดยไม่โหลด base ใหม่
+  รายชื่อ adapter + hash เก็บใน registry.json ในโฟลเดอร์ snapshot
+
+CLI (รันจาก root ของ repo):
+    python checkpoint_snapshot.py save --base unsloth/Qwen2.5-VL-3B-Instruct \\
+        --adapter lora_model_20251005_175200 --out snapshots/qwen_lora_20251005
+    python checkpoint_snapshot.py load snapshots/qwen_lora_20251005          → เวลา cold start
+    python checkpoint_snapshot.py register snapshots/qwen_base vision=lora_model_vision full=lora_model_full
+    python checkpoint_snapshot.py --selftest                                 → GPT-2 จิ๋วบน CPU
+"""
+import argparse
+import json
+import math
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+INDEX_NAME = "model.safetensors.index.json"
+META_NAME = "snapshot.json"
+REGISTRY_NAME = "registry.json"
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+ADAPTER_CONFIG = "adapter_config.json"
+PROCESSOR_FILES = ("tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "vocab.json", "merges.txt",
+                   "chat_template.json", "chat_template.jinja", "preprocessor_config.json", "added_tokens.json")
+
+
+def full_precision_base(base: str) -> str:
+    """unsloth/Qwen2.5-VL-3B-Instruct-bnb-4bit → unsloth/Qwen2.5-VL-3B-Instruct (merge ลงน้ำหนัก 4-bit ไม่ได้)"""
+    return base[:-len("-bnb-4bit")] if base.endswith("-bnb-4bit") else base
+
+
+# ---------- LoRA ----------
+
+def read_adapter(adapter_dir: Path) -> Tuple[Dict[str, Tuple[torch.Tensor, torch.Tensor]], float, Dict]:
+    """
+    คืน ({ชื่อ module: (A, B)}, alpha, config) จากโฟลเดอร์ที่ peft/unsloth save_pretrained ไว้
+    ชื่อ module ตัด prefix "base_model.model." ออกแล้ว
+    """
+    adapter_dir = Path(adapter_dir)
+    config = json.loads((adapter_dir / ADAPTER_CONFIG).read_text(encoding="utf-8"))
+    tensors = load_file(str(adapter_dir / ADAPTER_WEIGHTS))
+    pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+    skipped = []
+    for key, t in tensors.items():
+        name = key[len("base_model.model."):] if key.startswith("base_model.model.") else key
+        for part in ("lora_A", "lora_B"):
+            marker = f".{part}."
+            if marker in name:
+                module = name.split(marker)[0]
+                pairs.setdefault(module, {})[part] = t
+                break
+        else:
+            skipped.append(key)
+    if skipped:
+        print(f"[WARN] {adapter_dir}: ข้าม {len(skipped)} tensor ที่ไม่ใช่ lora_A/lora_B "
+              f"(เช่น {skipped[0]}) — modules_to_save/DoRA ยังไม่รองรับ")
+    lora = {m: (p["lora_A"], p["lora_B"]) for m, p in pairs.items() if "lora_A" in p and "lora_B" in p}
+    return lora, float(config.get("lora_alpha", 8)), config
+
+
+def lora_scale(alpha: float, r: int, use_rslora: bool = False) -> float:
+    return alpha / math.sqrt(r) if use_rslora else alpha / r
+
+
+def _module_index(model) -> Dict[str, List[str]]:
+    """suffix ของชื่อ module ทุกระดับ → ชื่อเต็ม (ใช้จับคู่ชื่อใน adapter ที่ prefix ไม่ตรงกับโมเดล)"""
+    index: Dict[str, List[str]] = {}
+    for name, module in model.named_modules():
+        if not hasattr(module, "weight"):
+            continue
+        parts = name.split(".")
+        for i in range(len(parts)):
+            index.setdefault(".".join(parts[i:]), []).append(name)
+    return index
+
+
+def _resolve(name: str, index: Dict[str, List[str]]) -> Optional[str]:
+    parts = name.split(".")
+    for i in range(len(parts)):
+        hits = index.get(".".join(parts[i:]), [])
+        if len(hits) == 1:
+            return hits[0]
+    return None
+
+
+def lora_deltas(model, adapter_dir: Path) -> Dict[str, torch.Tensor]:
+    """{ชื่อ module ในโมเดล: ΔW ใน layout ของ module.weight (fp32)}"""
+    from transformers.pytorch_utils import Conv1D
+
+    lora, alpha, config = read_adapter(adapter_dir)
+    index = _module_index(model)
+    deltas, missing = {}, []
+    for name, (a, b) in lora.items():
+        target = _resolve(name, index)
+        if target is None:
+            missing.append(name)
+            continue
+        delta = (b.float() @ a.float()) * lora_scale(alpha, a.shape[0], config.get("use_rslora", False))
+        module = model.get_submodule(target)
+        deltas[target] = delta.T if isinstance(module, Conv1D) else delta
+    if missing:
+        raise KeyError(f"{adapter_dir}: หา module ในโมเดลไม่เจอ {len(missing)} ตัว เช่น {missing[0]}")
+    return deltas
+
+
+@torch.no_grad()
+def merge_adapter(model, adapter_dir: Path) -> int:
+    """merge adapter ลงน้ำหนักของโมเดลแบบ in-place คืนจำนวน module ที่ถูกแก้"""
+    deltas = lora_deltas(model, adapter_dir)
+    for name, delta in deltas.items():
+        w = model.get_submodule(name).weight
+        w.copy_((w.float() + delta.to(w.device)).to(w.dtype))
+    return len(deltas)
+
+
+# ---------- save ----------
+
+def _shard(state: Dict[str, torch.Tensor], max_shard_mb: float) -> List[Dict[str, torch.Tensor]]:
+    shards, cur, size = [], {}, 0
+    limit = max_shard_mb * 2**20
+    for key, t in state.items():
+        n = t.numel() * t.element_size()
+        if cur and size + n > limit:
+            shards.append(cur)
+            cur, size = {}, 0
+        cur[key] = t
+        size += n
+    if cur:
+        shards.append(cur)
+    return shards
+
+
+def write_safetensors(state: Dict[str, torch.Tensor], out_dir: Path, max_shard_mb: float = 2048) -> Dict:
+    """state dict → shard safetensors + index (น้ำหนักที่ share storage กันเขียนครั้งเดียว เหมือน save_pretrained)"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    seen, unique = {}, {}
+    for key, t in state.items():
+        ptr = (t.untyped_storage().data_ptr(), t.storage_offset(), tuple(t.shape))
+        if ptr in seen:
+            continue
+        seen[ptr] = key
+        unique[key] = t.detach().to("cpu").contiguous()
+    shards = _shard(unique, max_shard_mb)
+    weight_map, total = {}, 0
+    for i, shard in enumerate(shards, 1):
+        fname = "model.safetensors" if len(shards) == 1 else f"model-{i:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, str(out_dir / fname), metadata={"format": "pt"})
+        for key, t in shard.items():
+            weight_map[key] = fname
+            total += t.numel() * t.element_size()
+    index = {"metadata": {"total_size": total}, "weight_map": weight_map}
+    (out_dir / INDEX_NAME).write_text(json.dumps(index, indent=2), encoding="utf-8")
+    return index
+
+
+def save_snapshot(model, out_dir: Path, processor=None, adapter: Optional[Path] = None, base: str = "",
+                  max_shard_mb: float = 2048) -> Path:
+    """
+    merge adapter (ถ้ามี) ลงโมเดลแล้วเขียน snapshot ที่โหลดได้ทันที
+    model ต้องเป็นน้ำหนักเต็ม (fp16/bf16/fp32) ไม่ใช่ bnb-4bit
+    """
+    from caption_images import model_id
+
+    out_dir = Path(out_dir)
+    t0 = time.perf_counter()
+    n_merged = merge_adapter(model, adapter) if adapter else 0
+    index = write_safetensors(model.state_dict(), out_dir, max_shard_mb)
+    model.config.save_pretrained(out_dir)
+    if getattr(model, "generation_config", None) is not None:
+        model.generation_config.save_pretrained(out_dir)
+    if processor is not None:
+        processor.save_pretrained(out_dir)
+    elif adapter:
+        # tokenizer.save_pretrained(save_dir) ใน notebook เขียนไฟล์ tokenizer ไว้ข้าง adapter แล้ว
+        for name in PROCESSOR_FILES:
+            if (Path(adapter) / name).exists():
+                shutil.copy2(Path(adapter) / name, out_dir / name)
+    meta = {
+        "base": base,
+        "adapter": model_id(base, str(adapter)) if adapter else None,
+        "merged_modules": n_merged,
+        "dtype": str(next(model.parameters()).dtype).replace("torch.", ""),
+        "total_mb": round(index["metadata"]["total_size"] / 2**20, 1),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    (out_dir / META_NAME).write_text(json.dumps(meta, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"[Snapshot] {out_dir}: {meta['total_mb']} MB ({meta['dtype']}), merge {n_merged} module "
+          f"ใน {time.perf_counter() - t0:.1f}s")
+    return out_dir
+
+
+# ---------- load ----------
+
+def _auto_class(config):
+    from transformers import AutoModelForCausalLM, AutoModelForImageTextToText
+
+    return AutoModelForImageTextToText if type(config) in AutoModelForImageTextToText._model_mapping \
+        else AutoModelForCausalLM
+
+
+def load_snapshot(path: Path, device_map: Optional[str] = None, with_processor: bool = True,
+                  **kwargs) -> Tuple[Any, Any, Dict[str, float]]:
+    """โหลด snapshot คืน (model, processor หรือ None, เวลาแต่ละช่วงเป็นวินาที)"""
+    t0 = time.perf_counter()
+    from transformers import AutoConfig, AutoProcessor
+
+    t_import = time.perf_counter()
+    config = AutoConfig.from_pretrained(path)
+    t_config = time.perf_counter()
+    model = _auto_class(config).from_pretrained(path, config=config, dtype="auto", device_map=device_map, **kwargs)
+    model.eval()
+    t_weights = time.perf_counter()
+    processor = None
+    if with_processor:
+        try:
+            processor = AutoProcessor.from_pretrained(path)
+        except (OSError, ValueError, TypeError):
+            processor = None
+    t_end = time.perf_counter()
+    timings = {"import_s": t_import - t0, "config_s": t_config - t_import, "weights_s": t_weights - t_config,
+               "processor_s": t_end - t_weights, "total_s": t_end - t0}
+    print(f"[ColdStart] {path}: {timings['total_s']:.2f}s (import {timings['import_s']:.2f}, "
+          f"config {timings['config_s']:.2f}, น้ำหนัก {timings['weights_s']:.2f}, processor {timings['processor_s']:.2f})")
+    return model, processor, timings
+
+
+# ---------- registry ----------
+
+class AdapterRegistry:
+    """หลาย adapter บนโมเดล base ตัวเดียว: activate(name) สลับโดยไม่โหลด base ใหม่"""
+
+    def __init__(self, model, base_dir: Optional[Path] = None):
+        self.model = model
+        self.base_dir = Path(base_dir) if base_dir else None
+        self.adapters: Dict[str, Dict[str, Any]] = {}
+        self.active: Optional[str] = None
+        self._touched: Dict[str, Optional[torch.Tensor]] = {}     # module → สำเนาน้ำหนักเดิม (None = อ่านจากไฟล์)
+        self._deltas: Dict[str, Dict[str, torch.Tensor]] = {}
+        self._weight_map: Dict[str, str] = {}
+        if self.base_dir is not None:
+            index = self.base_dir / INDEX_NAME
+            if index.exists():
+                self._weight_map = json.loads(index.read_text(encoding="utf-8"))["weight_map"]
+            reg = self.base_dir / REGISTRY_NAME
+            if reg.exists():
+                for name, info in json.loads(reg.read_text(encoding="utf-8"))["adapters"].items():
+                    self.register(name, info["path"], save=False)
+
+    def register(self, name: str, adapter_dir: Path, save: bool = True) -> None:
+        """ลงทะเบียน adapter (ΔW คำนวณครั้งแรกที่ activate)"""
+        from caption_images import model_id
+
+        cfg = json.loads((Path(adapter_dir) / ADAPTER_CONFIG).read_text(encoding="utf-8"))
+        self.adapters[name] = {"path": str(adapter_dir), "id": model_id("", str(adapter_dir)).lstrip("+"),
+                               "r": cfg.get("r"), "lora_alpha": cfg.get("lora_alpha"),
+                               "use_rslora": cfg.get("use_rslora", False),
+                               "target_modules": cfg.get("target_modules")}
+        self._deltas.pop(name, None)
+        if save and self.base_dir is not None:
+            self.save()
+
+    def save(self) -> None:
+        (self.base_dir / REGISTRY_NAME).write_text(
+            json.dumps({"adapters": self.adapters}, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    def _original(self, module: str) -> torch.Tensor:
+        saved = self._touched[module]
+        if saved is not None:
+            return saved
+        key = f"{module}.weight"
+        with safe_open(str(self.base_dir / self._weight_map[key]), framework="pt") as f:
+            return f.get_tensor(key)
+
+    @torch.no_grad()
+    def _restore(self) -> None:
+        for module in self._touched:
+            w = self.model.get_submodule(module).weight
+            w.copy_(self._original(module).to(device=w.device, dtype=w.dtype))
+
+    @torch.no_grad()
+    def activate(self, name: Optional[str]) -> float:
+        """เปิด adapter name (None = base เปล่า) คืนเวลาที่ใช้สลับ (วินาที)"""
+        t0 = time.perf_counter()
+        if name == self.active:
+            return 0.0
+        if name is not None and name not in self.adapters:
+            raise KeyError(f"ไม่มี adapter {name!r} (มี: {', '.join(self.adapters) or '-'})")
+        self._restore()
+        if name is not None:
+            if name not in self._deltas:
+                self._deltas[name] = lora_deltas(self.model, Path(self.adapters[name]["path"]))
+            for module, delta in self._deltas[name].items():
+                w = self.model.get_submodule(module).weight
+                if module not in self._touched:
+                    on_disk = f"{module}.weight" in self._weight_map
+                    self._touched[module] = None if on_disk else w.detach().clone()
+                w.copy_((w.float() + delta.to(w.device)).to(w.dtype))
+        self.active = name
+        elapsed = time.perf_counter() - t0
+        print(f"[Adapter] active = {name or 'base'} ({elapsed * 1000:.0f} ms)")
+        return elapsed
+
+
+# ---------- self-test บน CPU ----------
+
+def _fake_adapter(model, out_dir: Path, targets: List[str], r: int = 4, alpha: float = 8, seed: int = 0) -> Path:
+    """adapter สุ่มในรูปแบบเดียวกับที่ peft save_pretrained เขียน"""
+    from transformers.pytorch_utils import Conv1D
+
+    g = torch.Generator().manual_seed(seed)
+    tensors = {}
+    for name, module in model.named_modules():
+        if name.split(".")[-1] not in targets:
+            continue
+        fan_in, fan_out = (module.weight.shape if isinstance(module, Conv1D) else module.weight.shape[::-1])
+        prefix = f"base_model.model.{name}"
+        tensors[f"{prefix}.lora_A.weight"] = torch.randn(r, fan_in, generator=g) * 0.05
+        tensors[f"{prefix}.lora_B.weight"] = torch.randn(fan_out, r, generator=g) * 0.05
+    out_dir.mkdir(parents=True, exist_ok=True)
+    save_file(tensors, str(out_dir / ADAPTER_WEIGHTS))
+    (out_dir / ADAPTER_CONFIG).write_text(json.dumps({"r": r, "lora_alpha": alpha, "use_rslora": False,
+                                                      "target_modules": targets, "peft_type": "LORA"}))
+    return out_dir
+
+
+def _selftest(seed: int = 0) -> Dict[str, float]:
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=257, n_positions=128, n_embd=64, n_layer=4, n_head=2)
+    ids = torch.randint(1, 257, (2, 16), generator=torch.Generator().manual_seed(seed))
+
+    def logits(m):
+        with torch.no_grad():
+            return m(input_ids=ids).logits
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        base = GPT2LMHeadModel(config).eval()
+        base.save_pretrained(tmp / "base")
+        attn = _fake_adapter(base, tmp / "lora_attn", ["c_attn", "c_proj"], seed=1)    # คล้าย vision-only / attention
+        full = _fake_adapter(base, tmp / "lora_full", ["c_attn", "c_proj", "c_fc"], seed=2)
+
+        # snapshot ที่ merge แล้ว vs base + merge ทุก session
+        t0 = time.perf_counter()
+        m = GPT2LMHeadModel.from_pretrained(tmp / "base").eval()
+        merge_adapter(m, attn)
+        per_session = time.perf_counter() - t0
+        expected_attn = logits(m)
+        save_snapshot(GPT2LMHeadModel.from_pretrained(tmp / "base"), tmp / "snap_attn", adapter=attn, base="tiny-gpt2")
+        snap, _, timings = load_snapshot(tmp / "snap_attn", with_processor=False)
+        assert torch.allclose(logits(snap), expected_attn, atol=1e-5)
+
+        # registry: สลับ adapter บน base ตัวเดียว
+        write_safetensors(base.state_dict(), tmp / "base_snap")
+        base.config.save_pretrained(tmp / "base_snap")
+        model, _, _ = load_snapshot(tmp / "base_snap", with_processor=False)
+        expected_base = logits(model)
+        reg = AdapterRegistry(model, tmp / "base_snap")
+        reg.register("attn", attn)
+        reg.register("full", full)
+        reg.activate("attn")
+        assert torch.allclose(logits(model), expected_attn, atol=1e-5)
+        swap = reg.activate("full")
+        m_full = GPT2LMHeadModel.from_pretrained(tmp / "base").eval()
+        merge_adapter(m_full, full)
+        assert torch.allclose(logits(model), logits(m_full), atol=1e-5)
+        reg.activate(None)
+        assert torch.allclose(logits(model), expected_base, atol=1e-6)
+        assert set(AdapterRegistry(model, tmp / "base_snap").adapters) == {"attn", "full"}
+
+    print(f"[SelfTest] ok: base+merge {per_session:.2f}s vs snapshot {timings['total_s']:.2f}s "
+          f"(น้ำหนัก {timings['weights_s']:.2f}s), สลับ adapter {swap * 1000:.0f} ms")
+    return {"base_plus_merge_s": per_session, "snapshot_s": timings["total_s"], "swap_s": swap}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merged checkpoint snapshots and adapter registry")
+    parser.add_argument("--selftest", action="store_true")
+    sub = parser.add_subparsers(dest="cmd")
+    p_save = sub.add_parser("save", help="merge adapter ลง base แล้วเขียน snapshot")
+    p_save.add_argument("--base", default="unsloth/Qwen2.5-VL-3B-Instruct")
+    p_save.add_argument("--adapter", default=None)
+    p_save.add_argument("--out", required=True)
+    p_save.add_argument("--dtype", default="bfloat16")
+    p_save.add_argument("--max-shard-mb", type=float, default=2048)
+    p_load = sub.add_parser("load", help="โหลด snapshot แล้วรายงานเวลา cold start")
+    p_load.add_argument("path")
+    p_load.add_argument("--device-map", default=None)
+    p_reg = sub.add_parser("register", help="ลงทะเบียน adapter ใน registry.json ของ snapshot base")
+    p_reg.add_argument("path")
+    p_reg.add_argument("adapters", nargs="+", metavar="NAME=DIR")
+    args = parser.parse_args()
+
+    if args.selftest:
+        _selftest()
+    elif args.cmd == "save":
+        from transformers import AutoConfig, AutoProcessor
+
+        base = full_precision_base(args.base)
+        if base != args.base:
+            print(f"[Snapshot] base 4-bit merge ไม่ได้ → ใช้ {base}")
+        model = _auto_class(AutoConfig.from_pretrained(base)).from_pretrained(base, dtype=getattr(torch, args.dtype))
+        try:
+            processor = AutoProcessor.from_pretrained(args.adapter or base)
+        except (OSError, ValueError, TypeError):
+            processor = None
+        save_snapshot(model, Path(args.out), processor=processor, adapter=args.adapter, base=base,
+                      max_shard_mb=args.max_shard_mb)
+    elif args.cmd == "load":
+        load_snapshot(Path(args.path), device_map=args.device_map)
+    elif args.cmd == "register":
+        reg = AdapterRegistry(None, Path(args.path))
+        for item in args.adapters:
+            name, _, path = item.partition("=")
+            reg.register(name, Path(path))
+        print(f"[Adapter] {args.path}: {', '.join(reg.adapters)}")
+    else:
+        parser.print_help()
@@ -0,0 +1,307 @@
+"""
+จัดคลาสจาก log-likelihood ของ label โดยตรง แทนการ generate caption ยาว ๆ แล้ว regex หา "Class:"
+
+- LabelScorer.score(): ได้ log p("Class: <label>\\n" | prompt) ของทั้ง 8 คลาสใน CLASS_LABELS
+  mode="cache" : forward prompt (รวมภาพ) ครั้งเดียว แล้วขยาย KV cache เป็น 8 แถว → forward เฉพาะ token ของ label
+  mode="full"  : ต่อ prompt + label เป็น B×8 แถวแล้ว forward ครั้งเดียว (สำหรับโมเดล text ล้วน/โมเดลเล็ก)
+  token ร่วมของทุก label (เช่น "Class:") ต่อท้าย prompt ไปเลย เพราะไม่มีผลต่อการเลือกคลาส
+- ไม่มีกรณี "อ่านไม่ออก" อีกต่อไป: ทุกแถวได้คลาสเสมอ (argmax)
+- prefix_allowed_tokens_fn(): ถ้ายังอยาก generate caption ต่อ ให้บังคับ token แรก ๆ อยู่ในชุด label
+  (ใช้กับ model.generate(prefix_allowed_tokens_fn=...)) → extract_pred_class ไม่มีวันได้ None
+- python class_scoring.py --selftest : เทรน GPT-2 จิ๋วบน CPU ไม่กี่วินาที แล้วเทียบ latency กับ generate
+
+ใช้ใน callback:
+    scorer = LabelScorer(tokenizer)
+    inputs = prompt_inputs(tokenizer, images, device=model.device)
+    pred_ids = scorer.predict(model, **inputs)          # np.ndarray ของ LABEL_TO_ID
+"""
+import argparse
+import inspect
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from dataset_builder import CLASS_LABELS, instruction
+
+LABEL_TO_ID = {c: i for i, c in enumerate(CLASS_LABELS)}
+
+# คำตอบตอนเทรนคือ f"Class: {cls_name}\nExplanation: {description}"
+ANSWER_PREFIX = "Class: "
+ANSWER_SUFFIX = "\n"
+
+def _accepts(model, name: str) -> bool:
+    try:
+        params = inspect.signature(model.forward).parameters
+    except (TypeError, ValueError):
+        return False
+    return name in params or any(p.kind is p.VAR_KEYWORD for p in params.values())
+
+
+def _rope_holders(model) -> List:
+    """โมดูลที่เก็บ rope_deltas (Qwen2-VL / Qwen2.5-VL ใช้ M-RoPE) — หาไล่ลงไปผ่าน peft/unsloth wrapper"""
+    found, stack, seen = [], [model], set()
+    while stack:
+        m = stack.pop()
+        if m is None or id(m) in seen:
+            continue
+        seen.add(id(m))
+        if isinstance(getattr(m, "rope_deltas", None), torch.Tensor):
+            found.append(m)
+        stack.extend(getattr(m, a, None) for a in ("base_model", "model"))
+    return found
+
+
+def _uses_mrope(model) -> bool:
+    """Qwen2-VL คำนวณ position (M-RoPE) เองจาก input_ids + image_grid_thw → ห้ามส่ง position_ids 1 มิติ"""
+    cfg = getattr(model, "config", None)
+    for c in (cfg, getattr(cfg, "text_config", None)):
+        rs = getattr(c, "rope_scaling", None)
+        if isinstance(rs, dict) and "mrope_section" in rs:
+            return True
+    return bool(_rope_holders(model))
+
+
+def _repeat_cache(past, k: int):
+    if hasattr(past, "batch_repeat_interleave"):  # transformers Cache
+        past.batch_repeat_interleave(k)
+        return past
+    return tuple(tuple(t.repeat_interleave(k, dim=0) for t in layer) for layer in past)
+
+
+def _positions(mask: torch.Tensor) -> torch.Tensor:
+    """position_ids ของ batch ที่ pad ซ้าย (แบบเดียวกับที่ generate คำนวณ)"""
+    return (mask.long().cumsum(-1) - 1).clamp(min=0)
+
+
+class LabelScorer:
+    def __init__(self, tokenizer, labels: Sequence[str] = CLASS_LABELS, prefix: str = ANSWER_PREFIX,
+                 suffix: str = ANSWER_SUFFIX, normalize: str = "sum"):
+        """
+        tokenizer : tokenizer หรือ processor (ใช้ .tokenizer ข้างในถ้ามี)
+        normalize : "sum" = log p ทั้ง label, "mean" = เฉลี่ยต่อ token (ลด bias ต่อ label ที่ยาว)
+        """
+        tok = getattr(tokenizer, "tokenizer", tokenizer)
+        self.tokenizer = tok
+        self.labels = list(labels)
+        self.normalize = normalize
+        full = [list(tok.encode(prefix + lab + suffix, add_special_tokens=False)) for lab in self.labels]
+        n_shared = 0
+        while all(len(ids) > n_shared + 1 for ids in full) and len({ids[n_shared] for ids in full}) == 1:
+            n_shared += 1
+        self.shared = full[0][:n_shared]
+        self.tails = [ids[n_shared:] for ids in full]
+        self.full_ids = full
+        pad = tok.pad_token_id if tok.pad_token_id is not None else getattr(tok, "eos_token_id", None)
+        self.pad_id = pad if pad is not None else 0
+
+    # ---------- tensors ของ label ----------
+
+    def _tail_tensors(self, device) -> Tuple[torch.Tensor, torch.Tensor]:
+        width = max(len(t) for t in self.tails)
+        ids = torch.full((len(self.tails), width), self.pad_id, dtype=torch.long, device=device)
+        mask = torch.zeros((len(self.tails), width), dtype=torch.long, device=device)
+        for k, t in enumerate(self.tails):
+            ids[k, :len(t)] = torch.tensor(t, dtype=torch.long, device=device)
+            mask[k, :len(t)] = 1
+        return ids, mask
+
+    def _with_shared(self, input_ids, attention_mask):
+        if not self.shared:
+            return input_ids, attention_mask
+        shared = torch.tensor(self.shared, dtype=input_ids.dtype, device=input_ids.device).expand(input_ids.size(0), -1)
+        return (torch.cat([input_ids, shared], 1),
+                torch.cat([attention_mask, torch.ones_like(shared, dtype=attention_mask.dtype)], 1))
+
+    # ---------- scoring ----------
+
+    @torch.no_grad()
+    def score(self, model, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+              mode: str = "cache", **model_kwargs) -> torch.Tensor:
+        """
+        log-likelihood ของแต่ละ label shape (B, K)
+        input_ids ต้องเป็น prompt ที่จบด้วย generation prompt แล้ว (pad ซ้ายถ้า B > 1)
+        model_kwargs: pixel_values / image_grid_thw ฯลฯ จาก processor
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        input_ids, attention_mask = self._with_shared(input_ids, attention_mask)
+        tails, tail_mask = self._tail_tensors(input_ids.device)
+        if mode == "full":
+            lp = self._score_full(model, input_ids, attention_mask, tails, tail_mask, model_kwargs)
+        elif mode == "cache":
+            lp = self._score_cached(model, input_ids, attention_mask, tails, tail_mask, model_kwargs)
+        else:
+            raise ValueError(f"unknown mode: {mode!r}")
+        if self.normalize == "mean":
+            lp = lp / tail_mask.sum(-1).to(lp.dtype)
+        return lp
+
+    def _score_cached(self, model, input_ids, attention_mask, tails, tail_mask, model_kwargs) -> torch.Tensor:
+        B, K, P = input_ids.size(0), tails.size(0), input_ids.size(1)
+        L = tails.size(1)
+        kwargs = dict(model_kwargs)
+        mrope = _uses_mrope(model)
+        if not mrope and _accepts(model, "position_ids"):
+            kwargs.setdefault("position_ids", _positions(attention_mask))
+        out = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=True, **kwargs)
+        # token แรกของทุก label ใช้ logits ตัวสุดท้ายของ prompt
+        lp = out.logits[:, -1].float().log_softmax(-1)[:, tails[:, 0]]  # (B, K)
+        if L == 1:
+            return lp
+
+        holders = _rope_holders(model)
+        saved = [h.rope_deltas for h in holders]
+        try:
+            for h in holders:
+                h.rope_deltas = h.rope_deltas.repeat_interleave(K, dim=0)
+            cont = tails[:, :-1].repeat(B, 1)                 # (B*K, L-1) เรียงแบบ b0k0..b0k7, b1k0..
+            cont_mask = tail_mask[:, :-1].repeat(B, 1)
+            kw = dict(
+                input_ids=cont,
+                attention_mask=torch.cat([attention_mask.repeat_interleave(K, 0), cont_mask.to(attention_mask.dtype)], 1),
+                past_key_values=_repeat_cache(out.past_key_values, K),
+                use_cache=False,
+            )
+            if _accepts(model, "cache_position"):
+                kw["cache_position"] = torch.arange(P, P + L - 1, device=input_ids.device)
+            if not mrope and _accepts(model, "position_ids"):
+                start = attention_mask.long().sum(-1).repeat_interleave(K)
+                kw["position_ids"] = start[:, None] + torch.arange(L - 1, device=input_ids.device)
+            logits = model(**kw).logits.float().log_softmax(-1)  # (B*K, L-1, V)
+        finally:
+            for h, r in zip(holders, saved):
+                h.rope_deltas = r
+        target = tails[:, 1:].repeat(B, 1)
+        tok_lp = logits.gather(-1, target.unsqueeze(-1)).squeeze(-1) * tail_mask[:, 1:].repeat(B, 1)
+        return lp + tok_lp.sum(-1).view(B, K)
+
+    def _score_full(self, model, input_ids, attention_mask, tails, tail_mask, model_kwargs) -> torch.Tensor:
+        B, K, P = input_ids.size(0), tails.size(0), input_ids.size(1)
+        ids = torch.cat([input_ids.repeat_interleave(K, 0), tails.repeat(B, 1)], 1)
+        mask = torch.cat([attention_mask.repeat_interleave(K, 0), tail_mask.repeat(B, 1).to(attention_mask.dtype)], 1)
+        kwargs = {k: (v.repeat_interleave(K, 0) if isinstance(v, torch.Tensor) and v.size(0) == B else v)
+                  for k, v in model_kwargs.items()}
+        if _accepts(model, "position_ids") and not _uses_mrope(model):
+            kwargs.setdefault("position_ids", _positions(mask))
+        logits = model(input_ids=ids, attention_mask=mask, **kwargs).logits.float()
+        # logits ตำแหน่ง P-1+j ทำนาย token j ของ label
+        logp = logits[:, P - 1:P - 1 + tails.size(1)].log_softmax(-1)
+        tok_lp = logp.gather(-1, tails.repeat(B, 1).unsqueeze(-1)).squeeze(-1) * tail_mask.repeat(B, 1)
+        return tok_lp.sum(-1).view(B, K)
+
+    def predict(self, model, mode: str = "cache", **inputs) -> np.ndarray:
+        """index ของคลาสที่ log-likelihood สูงสุด (ตรงกับ LABEL_TO_ID เมื่อใช้ CLASS_LABELS)"""
+        return self.score(model, mode=mode, **inputs).argmax(-1).cpu().numpy()
+
+    def predict_labels(self, model, mode: str = "cache", **inputs) -> List[str]:
+        return [self.labels[i] for i in self.predict(model, mode=mode, **inputs)]
+
+    # ---------- constrained generation ----------
+
+    def prefix_allowed_tokens_fn(self, prompt_len: int, vocab_size: Optional[int] = None):
+        """
+        ใช้กับ model.generate(prefix_allowed_tokens_fn=...): token ที่ generate ช่วงแรก
+        ต้องเดินตาม "Class: <label>\\n" ของ label ใดก็ได้ หลังจากนั้นปล่อยอิสระ
+        prompt_len = ความยาว input_ids (รวม padding) ที่ส่งเข้า generate
+        """
+        trie: Dict[Tuple[int, ...], set] = {}
+        for ids in self.full_ids:
+            for j in range(len(ids)):
+                trie.setdefault(tuple(ids[:j]), set()).add(ids[j])
+        allowed = {k: sorted(v) for k, v in trie.items()}
+        everything = list(range(vocab_size or len(self.tokenizer)))
+
+        def fn(batch_id: int, ids: torch.Tensor) -> List[int]:
+            return allowed.get(tuple(ids[prompt_len:].tolist()), everything)
+
+        return fn
+
+
+def prompt_inputs(processor, images: Optional[Sequence] = None, prompt: str = instruction, device=None) -> Dict:
+    """
+    สร้างอินพุตแบบเดียวกับ cell inference ใน progress3_qwen.ipynb (ภาพ + instruction, pad ซ้าย)
+    images=None → prompt แบบ text ล้วน (ใช้กับโมเดลเล็กตอนทดสอบ)
+    """
+    tok = getattr(processor, "tokenizer", processor)
+    tok.padding_side = "left"
+    if images is None:
+        enc = tok([prompt], add_special_tokens=False, return_tensors="pt", padding=True)
+    else:
+        messages = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}]
+        text = processor.apply_chat_template(messages, add_generation_prompt=True)
+        enc = processor(list(images), [text] * len(images), add_special_tokens=False,
+                        return_tensors="pt", padding=True)
+    return {k: v.to(device) for k, v in enc.items()} if device is not None else dict(enc)
+
+
+# ---------- self-test บน CPU ----------
+
+class _ByteTokenizer:
+    """tokenizer ระดับไบต์ (ไม่ต้องโหลดไฟล์) สำหรับ self-test"""
+    pad_token_id = 0
+    eos_token_id = 0
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        return [b + 1 for b in text.encode("utf-8")]
+
+    def __len__(self) -> int:
+        return 257
+
+
+def _selftest(steps: int = 300, max_new_tokens: int = 96, seed: int = 0) -> Dict[str, float]:
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    tok = _ByteTokenizer()
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=257, n_positions=256, n_embd=64, n_layer=2, n_head=2,
+                                                bos_token_id=0, eos_token_id=0))
+    prompts = [f"xray finding {k}: " for k in range(len(CLASS_LABELS))]
+    rows = [tok.encode(p + ANSWER_PREFIX + lab + ANSWER_SUFFIX + "Explanation: ok.")
+            for p, lab in zip(prompts, CLASS_LABELS)]
+    width = max(map(len, rows))
+    batch = torch.tensor([r + [0] * (width - len(r)) for r in rows])
+    mask = (torch.arange(width)[None] < torch.tensor([len(r) for r in rows])[:, None]).long()
+    opt = torch.optim.AdamW(model.parameters(), lr=3e-3)
+    model.train()
+    for _ in range(steps):
+        loss = model(input_ids=batch, attention_mask=mask, labels=batch.masked_fill(mask == 0, -100)).loss
+        loss.backward()
+        opt.step()
+        opt.zero_grad()
+    model.eval()
+
+    scorer = LabelScorer(tok)
+    ids = [torch.tensor([tok.encode(p)]) for p in prompts]
+    results = {}
+    for mode in ("cache", "full"):
+        t0 = time.perf_counter()
+        preds = [int(scorer.predict(model, input_ids=x, mode=mode)[0]) for x in ids]
+        results[f"{mode}_ms"] = (time.perf_counter() - t0) / len(ids) * 1000
+        results[f"{mode}_acc"] = float(np.mean([p == k for k, p in enumerate(preds)]))
+
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        for x in ids:
+            model.generate(input_ids=x, attention_mask=torch.ones_like(x), max_new_tokens=max_new_tokens,
+                           min_new_tokens=max_new_tokens, do_sample=False, pad_token_id=0)
+    results["generate_ms"] = (time.perf_counter() - t0) / len(ids) * 1000
+    results["speedup"] = results["generate_ms"] / results["cache_ms"]
+    print(f"[SelfTest] acc cache={results['cache_acc']:.2f} full={results['full_acc']:.2f}  "
+          f"score {results['cache_ms']:.1f} ms/sample vs generate({max_new_tokens}) {results['generate_ms']:.1f} ms/sample "
+          f"→ x{results['speedup']:.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score CLASS_LABELS by log-likelihood instead of parsing generations")
+    parser.add_argument("--selftest", action="store_true", help="เทรน GPT-2 จิ๋วบน CPU แล้วตรวจ/จับเวลา")
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--max-new-tokens", type=int, default=96)
+    args = parser.parse_args()
+
+    if args.selftest:
+        _selftest(args.steps, args.max_new_tokens)
+    else:
+        parser.print_help()
@@ -0,0 +1,379 @@
+"""
+สร้าง dataset รูป-ข้อความแบบ shard (Arrow IPC / Parquet) แทน save_to_disk + list ของ convert_to_conversation
+
+- จับคู่รูปหลังบาลานซ์กับข้อความใน disease_output/csv ด้วยกติกาเดิมของ prepare_data.ipynb
+  (align_texts_to_images / strip_aug_suffix / MISMATCH_POLICY)
+- เขียนทีละ batch ลง shard: image = struct{bytes, path} (ไบต์ไฟล์เดิม ไม่ decode/encode ใหม่), text, __class__
+  → RAM ตอน build ไม่โตตามขนาด dataset
+- LazyConversationDataset: เปิด shard แบบ memory-map แล้วค่อย decode รูป + convert_to_conversation ตอน __getitem__
+  ใช้แทน [convert_to_conversation(s) for s in train_hf] ได้เลย (มี __len__/__getitem__ แบบ map-style)
+- train_test_split() ใช้สูตรเดียวกับ datasets.Dataset.train_test_split → ได้ split เดิมของ notebook ที่ seed=42
+- shard แบบ arrow เปิดด้วย datasets.Dataset.from_file ได้ (to_hf) และใส่ set_transform ให้แปลงตอนอ่าน
+- image_cache (image_cache.ImageCache): อ่านรูปที่ preprocess แล้วจาก cache แทน decode ไฟล์เดิมทุกครั้ง
+
+CLI:
+    python dataset_builder.py                                         → lung8_image_text_shards/ (arrow)
+    python dataset_builder.py --format parquet --rows-per-shard 500
+"""
+import argparse
+import io
+import json
+import math
+import re
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+from image_balance import ALLOWED_CLASSES, balanced_root, valid_exts
+
+csv_dir = Path("prepare_data/disease_output/csv")
+shards_root = Path("lung8_image_text_shards")
+
+MISMATCH_POLICY = "TRUNCATE"
+
+CLASS_LABELS = sorted(ALLOWED_CLASSES)  # ลำดับคงที่ → id ของคลาส
+
+instruction = "Describe the chest X-ray using precise clinical terms. Identify one main diagnostic category from: Chest_Changes, Degenerative_Infectious, Higher_Density, Inflammatory_Pneumonia, Lower_Density, Mediastinal_Changes, Normal, or Obstructive."
+
+SCHEMA = pa.schema([
+    ("image", pa.struct([("bytes", pa.binary()), ("path", pa.string())])),
+    ("text", pa.string()),
+    ("__class__", pa.string()),
+])
+# ให้ datasets รู้ว่าคอลัมน์ image เป็น Image feature (decode เป็น PIL ตอนอ่าน)
+HF_FEATURES = {
+    "image": {"_type": "Image"},
+    "text": {"dtype": "string", "_type": "Value"},
+    "__class__": {"dtype": "string", "_type": "Value"},
+}
+INDEX_NAME = "index.json"
+
+
+# ---------- จับคู่รูป-ข้อความ (เหมือน prepare_data.ipynb) ----------
+
+def pick_col(cols, candidates):
+    for c in candidates:
+        if c in cols:
+            return c
+    return None
+
+
+def align_texts_to_images(text_series: pd.Series, n_images: int, cls_name: str,
+                          policy: str = MISMATCH_POLICY) -> pd.Series:
+    s = text_series.fillna("").astype(str).reset_index(drop=True)
+    n_text = len(s)
+    if n_text == n_images:
+        return s
+    if policy in ("TRUNCATE", "PAD_CLASS"):
+        if n_text >= n_images:
+            return s.iloc[:n_images].reset_index(drop=True)
+        pad = pd.Series([cls_name] * (n_images - n_text))
+        return pd.concat([s, pad], ignore_index=True)
+    if policy == "CYCLE":
+        if n_text == 0:
+            return pd.Series([cls_name] * n_images)
+        reps = (n_images + n_text - 1) // n_text
+        return pd.concat([s] * reps, ignore_index=True).iloc[:n_images].reset_index(drop=True)
+    raise ValueError(f"Unknown MISMATCH_POLICY: {policy}")
+
+
+def strip_aug_suffix(name: str) -> str:
+    """
+    รับชื่อไฟล์เช่น 'IMG001_aug0003.png' → คืน 'IMG001.png'
+    """
+    m = re.match(r"^(.*?)(?:_aug\d+)?(\.\w+)$", name)
+    if m:
+        return m.group(1) + m.group(2)
+    return name
+
+
+def collect_meta(csv_root: Path = csv_dir, images: Path = balanced_root,
+                 classes=ALLOWED_CLASSES, policy: str = MISMATCH_POLICY) -> pd.DataFrame:
+    """DataFrame(image_path, text, __class__) — เก็บแค่ path ยังไม่เปิดรูป"""
+    rows = []
+    for csv_path in sorted(Path(csv_root).glob("*.csv")):
+        cls = csv_path.stem.strip()
+        if cls not in classes:
+            continue
+        df = pd.read_csv(csv_path, encoding="utf-8-sig")
+        filename_col = pick_col(df.columns, ["filename", "file", "image", "img", "path", "filepath"])
+        text_col = pick_col(df.columns, ["text", "caption", "report", "label_text", "description"])
+
+        img_files = sorted([p for p in (Path(images) / cls).rglob("*")
+                            if p.suffix.lower() in valid_exts and p.is_file()], key=lambda p: p.name)
+        n_img = len(img_files)
+        if n_img == 0:
+            print(f"[WARN] โฟลเดอร์ {cls} หลังบาลานซ์ ไม่มีรูป ถูกข้าม")
+            continue
+
+        texts = df[text_col].astype(str) if text_col is not None else pd.Series([cls] * len(df), dtype=str)
+        if filename_col is not None:
+            # จับคู่ตามชื่อไฟล์ต้นฉบับ (รองรับรูปเสริม _augXXXX)
+            names = df[filename_col].astype(str).map(lambda x: Path(x).name)
+            text_by_name = dict(zip(names[~names.duplicated()], texts[~names.duplicated()]))
+            use_texts = pd.Series([text_by_name.get(strip_aug_suffix(p.name), cls) for p in img_files], dtype=str)
+        else:
+            use_texts = align_texts_to_images(texts, n_img, cls, policy)
+            if len(df) != n_img:
+                print(f"[INFO] {csv_path.name}: ข้อความ {len(df)} รายการ, รูป {n_img} ไฟล์ → จับคู่แบบ {policy} เป็น {n_img}")
+
+        rows.append(pd.DataFrame({"image_path": [p.as_posix() for p in img_files],
+                                  "text": use_texts, "__class__": cls}))
+    if not rows:
+        raise RuntimeError("ไม่พบข้อมูลหลังประมวลผล — ตรวจโฟลเดอร์/CSV อีกครั้ง")
+    meta = pd.concat(rows, ignore_index=True).drop_duplicates().reset_index(drop=True)
+    print("จำนวนภาพต่อคลาส (สุดท้าย):", meta["__class__"].value_counts().to_dict())
+    return meta
+
+
+# ---------- เขียน shard ----------
+
+def _record_batch(rows: pd.DataFrame) -> pa.RecordBatch:
+    images = [{"bytes": Path(p).read_bytes(), "path": Path(p).name} for p in rows["image_path"]]
+    return pa.record_batch([pa.array(images, type=SCHEMA.field("image").type),
+                            pa.array(rows["text"].tolist(), type=pa.string()),
+                            pa.array(rows["__class__"].tolist(), type=pa.string())], schema=SCHEMA)
+
+
+class _ShardWriter:
+    def __init__(self, path: Path, fmt: str, schema: pa.Schema):
+        self.path = path
+        self.rows = 0
+        if fmt == "parquet":
+            self._w = pq.ParquetWriter(str(path), schema)
+            self._write = self._w.write_batch
+        else:
+            self._sink = pa.OSFile(str(path), "wb")
+            # stream format = แบบที่ datasets ใช้ใน cache (Dataset.from_file เปิดได้)
+            self._w = pa.ipc.new_stream(self._sink, schema)
+            self._write = self._w.write_batch
+
+    def write(self, batch: pa.RecordBatch) -> None:
+        self._write(batch)
+        self.rows += batch.num_rows
+
+    def close(self) -> None:
+        self._w.close()
+        if hasattr(self, "_sink"):
+            self._sink.close()
+
+
+def build_shards(meta: pd.DataFrame, out_dir: Path = shards_root, rows_per_shard: int = 1000,
+                 batch_rows: int = 64, fmt: str = "arrow") -> Path:
+    """
+    เขียน meta เป็น shard-XXXXX.<fmt> ทีละ batch_rows แถว (อ่านไบต์รูปเฉพาะ batch ปัจจุบัน)
+    พร้อม index.json (จำนวนแถวต่อ shard, จำนวนต่อคลาส) — คืน out_dir
+    """
+    if fmt not in ("arrow", "parquet"):
+        raise ValueError(f"unknown format: {fmt!r}")
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old in out_dir.glob("shard-*"):
+        old.unlink()
+    schema = SCHEMA.with_metadata({"huggingface": json.dumps({"info": {"features": HF_FEATURES}})})
+
+    t0 = time.perf_counter()
+    shards: List[Dict] = []
+    total_bytes = 0
+    for s, start in enumerate(range(0, len(meta), rows_per_shard)):
+        part = meta.iloc[start:start + rows_per_shard]
+        path = out_dir / f"shard-{s:05d}.{fmt}"
+        writer = _ShardWriter(path, fmt, schema)
+        try:
+            for b in range(0, len(part), batch_rows):
+                writer.write(_record_batch(part.iloc[b:b + batch_rows]))
+        finally:
+            writer.close()
+        shards.append({"file": path.name, "rows": writer.rows})
+        total_bytes += path.stat().st_size
+
+    index = {
+        "format": fmt,
+        "rows": int(len(meta)),
+        "shards": shards,
+        "counts": {k: int(v) for k, v in meta["__class__"].value_counts().sort_index().items()},
+    }
+    (out_dir / INDEX_NAME).write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"[Saved] {out_dir}: {len(meta)} แถว, {len(shards)} shard, {total_bytes / 2**20:.1f} MB "
+          f"ใน {time.perf_counter() - t0:.1f}s")
+    return out_dir
+
+
+# ---------- อ่านแบบ lazy ----------
+
+def _open_table(path: Path, fmt: str) -> pa.Table:
+    if fmt == "parquet":
+        return pq.read_table(str(path), memory_map=True)
+    # zero-copy: buffer ของ table ชี้เข้าไฟล์ที่ map ไว้ ไม่ได้อ่านเข้า RAM
+    return pa.ipc.open_stream(pa.memory_map(str(path), "r")).read_all()
+
+
+def load_table(out_dir: Path = shards_root) -> pa.Table:
+    out_dir = Path(out_dir)
+    index = json.loads((out_dir / INDEX_NAME).read_text(encoding="utf-8"))
+    tables = [_open_table(out_dir / s["file"], index["format"]) for s in index["shards"]]
+    return pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+
+
+def iter_batches(out_dir: Path = shards_root, columns: Optional[Sequence[str]] = None,
+                 batch_size: int = 256) -> Iterator[pa.RecordBatch]:
+    """อ่าน shard ทีละ record batch (parquet อ่านทีละ batch จริง, arrow ชี้เข้าไฟล์ที่ map ไว้) → RAM ไม่โตตามขนาดชุด"""
+    out_dir = Path(out_dir)
+    index = json.loads((out_dir / INDEX_NAME).read_text(encoding="utf-8"))
+    for s in index["shards"]:
+        path = out_dir / s["file"]
+        if index["format"] == "parquet":
+            yield from pq.ParquetFile(str(path), memory_map=True).iter_batches(batch_size=batch_size, columns=columns)
+        else:
+            table = _open_table(path, index["format"])
+            yield from (table.select(columns) if columns else table).to_batches(max_chunksize=batch_size)
+
+
+def decode_image(cell: Dict) -> Image.Image:
+    im = Image.open(io.BytesIO(cell["bytes"]))
+    im.load()
+    return im
+
+
+def convert_to_conversation(sample):
+    cls_name = sample["__class__"]
+    description = sample["text"]
+
+    answer = f"Class: {cls_name}\nExplanation: {description}"
+
+    conversation = [
+        {"role": "user", "content": [
+            {"type": "text", "text": instruction},
+            {"type": "image", "image": sample["image"]}]
+         },
+        {"role": "assistant", "content": [
+            {"type": "text", "text": answer}]
+         },
+    ]
+
+    return {"messages": conversation}
+
+
+def conversation_transform(batch: Dict[str, List]) -> Dict[str, List]:
+    """convert_to_conversation แบบ batch สำหรับ datasets.Dataset.set_transform"""
+    images = [im if isinstance(im, Image.Image) else decode_image(im) for im in batch["image"]]
+    return {"messages": [convert_to_conversation({"image": im, "text": t, "__class__": c})["messages"]
+                         for im, t, c in zip(images, batch["text"], batch["__class__"])]}
+
+
+class LazyConversationDataset:
+    """
+    มุมมองของแถวใน shard (ผ่าน indices) — ไม่ decode อะไรจนกว่าจะเรียก __getitem__
+    transform=None → คืน sample ดิบ {"image": PIL, "text", "__class__"} (แบบ hf[i])
+    """
+
+    def __init__(self, table: pa.Table, indices: Optional[np.ndarray] = None, transform=convert_to_conversation,
+                 image_cache=None):
+        self.table = table
+        self.indices = np.arange(table.num_rows, dtype=np.int64) if indices is None \
+            else np.asarray(indices, dtype=np.int64)
+        self.transform = transform
+        self.image_cache = image_cache
+        self._images = table.column("image")
+        self._texts = table.column("text")
+        self._classes = table.column("__class__")
+
+    @classmethod
+    def open(cls, out_dir: Path = shards_root, transform=convert_to_conversation,
+             image_cache=None) -> "LazyConversationDataset":
+        return cls(load_table(out_dir), transform=transform, image_cache=image_cache)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def sample(self, i: int) -> Dict:
+        row = int(self.indices[i])
+        cell = self._images[row].as_py()
+        return {"image": self.image_cache.get(cell["bytes"]) if self.image_cache is not None else decode_image(cell),
+                "text": self._texts[row].as_py(),
+                "__class__": self._classes[row].as_py()}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.select(self.indices[i], relative=False)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = self.sample(i)
+        return self.transform(s) if self.transform is not None else s
+
+    def __iter__(self) -> Iterator:
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def classes(self) -> np.ndarray:
+        """ชื่อคลาสของทุกแถวในมุมมองนี้ (ไม่ decode รูป)"""
+        return self._classes.take(pa.array(self.indices)).to_numpy(zero_copy_only=False)
+
+    @property
+    def texts(self) -> np.ndarray:
+        """ข้อความ caption ของทุกแถวในมุมมองนี้ (ไม่ decode รูป)"""
+        return self._texts.take(pa.array(self.indices)).to_numpy(zero_copy_only=False)
+
+    def select(self, indices: Sequence[int], relative: bool = True) -> "LazyConversationDataset":
+        idx = np.asarray(indices, dtype=np.int64)
+        return LazyConversationDataset(self.table, self.indices[idx] if relative else idx, self.transform,
+                                       self.image_cache)
+
+    def with_transform(self, transform) -> "LazyConversationDataset":
+        return LazyConversationDataset(self.table, self.indices, transform, self.image_cache)
+
+    def train_test_split(self, test_size: float, seed: int = 42, shuffle: bool = True) -> Dict[str, "LazyConversationDataset"]:
+        """สูตรเดียวกับ datasets.Dataset.train_test_split (test_size แบบสัดส่วน)"""
+        n = len(self)
+        n_test = math.ceil(test_size * n)
+        n_train = n - n_test
+        perm = np.random.default_rng(seed).permutation(n) if shuffle else np.arange(n)
+        return {"train": self.select(perm[n_test:n_test + n_train]), "test": self.select(perm[:n_test])}
+
+
+def to_hf(out_dir: Path = shards_root, lazy_conversation: bool = True, image_cache=None):
+    """
+    เปิด shard (arrow) เป็น datasets.Dataset แบบ memory-map
+    lazy_conversation=True → set_transform(conversation_transform): ได้ "messages" ตอนอ่านแต่ละแถว
+    image_cache → รูปใน "messages" มาจาก cache (ขนาด side×side)
+    """
+    from datasets import Dataset, Image as ImageFeature, concatenate_datasets
+
+    out_dir = Path(out_dir)
+    index = json.loads((out_dir / INDEX_NAME).read_text(encoding="utf-8"))
+    if index["format"] != "arrow":
+        raise ValueError("to_hf ใช้กับ shard แบบ arrow; parquet ใช้ load_dataset('parquet', data_files=...)")
+    ds = concatenate_datasets([Dataset.from_file(str(out_dir / s["file"])) for s in index["shards"]])
+    if lazy_conversation and image_cache is not None:
+        from image_cache import conversation_transform as cached_transform
+
+        # ต้อง cast image เป็นไบต์ดิบ ไม่งั้น datasets จะ decode เป็น PIL ก่อนถึง transform
+        ds = ds.cast_column("image", ImageFeature(decode=False))
+        ds.set_transform(cached_transform(image_cache))
+    elif lazy_conversation:
+        ds.set_transform(conversation_transform)
+    return ds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build sharded image-text dataset with lazy conversation transform")
+    parser.add_argument("--csv-dir", default=str(csv_dir))
+    parser.add_argument("--images", default=str(balanced_root))
+    parser.add_argument("--out", default=str(shards_root))
+    parser.add_argument("--format", choices=["arrow", "parquet"], default="arrow")
+    parser.add_argument("--rows-per-shard", type=int, default=1000)
+    parser.add_argument("--batch-rows", type=int, default=64)
+    parser.add_argument("--policy", choices=["TRUNCATE", "CYCLE", "PAD_CLASS"], default=MISMATCH_POLICY)
+    args = parser.parse_args()
+
+    meta = collect_meta(args.csv_dir, args.images, policy=args.policy)
+    build_shards(meta, args.out, rows_per_shard=args.rows_per_shard, batch_rows=args.batch_rows, fmt=args.format)
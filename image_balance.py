@@ -0,0 +1,423 @@
+"""
+บาลานซ์รูป X-ray ต่อคลาส (ย้ายมาจาก prepare_data.ipynb ให้ import ได้)
+
+- คลาสที่มีรูป >= TARGET_PER_CLASS → สุ่มเลือก TARGET_PER_CLASS รูป
+- คลาสที่มีรูปน้อยกว่า → ก็อปปี้ทั้งหมด + เติมด้วย augmentation (ไม่ flip) ชื่อ <basename>_augXXXX.png
+- ทุกรูปเสริมมี seed ของตัวเอง (คำนวณจาก seed หลัก + ชื่อคลาส + aug_id) → ผลเหมือนเดิมทุกครั้ง
+  ไม่ว่าจะใช้กี่ worker หรือ batch ขนาดเท่าไร
+- ทำงานเป็น batch: ส่วน geometric (affine / crop) ทำทีละรูปด้วย PIL
+  ส่วนแสง/คอนทราสต์/noise ทำแบบ vectorized บน stack ของ NumPy
+- balance_all() ส่งงานของทุกคลาสเข้า process pool ตัวเดียว → ใช้ได้ทุก core
+
+CLI:
+    python image_balance.py                                   → ทุกคลาสใน ALLOWED_CLASSES
+    python image_balance.py --workers 8 --target 1000 --seed 1337
+    python image_balance.py --classes Normal Obstructive --workers 0   → รันใน process เดียว
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+
+images_root = Path("X-ray Lung Diseases Images (9 classes)")
+balanced_root = Path("lung8_balanced_1000")
+
+ALLOWED_CLASSES = {
+    "Chest_Changes",
+    "Degenerative_Infectious",
+    "Higher_Density",
+    "Inflammatory_Pneumonia",
+    "Lower_Density",
+    "Mediastinal_Changes",
+    "Normal",
+    "Obstructive",
+}
+valid_exts = {".jpg", ".jpeg", ".apng", ".bmp", ".tif", ".tiff", ".png"}  # เผื่อ .png
+
+TARGET_PER_CLASS = 1000
+MAX_ROT_DEG = 10
+SEED = 1337
+
+
+# ---------- seed ----------
+
+def image_seed(base_seed: int, cls_name: str, index) -> int:
+    """seed 63-bit ของรูปหนึ่งรูป — ขึ้นกับ (seed หลัก, คลาส, ลำดับ) เท่านั้น"""
+    h = hashlib.blake2b(f"{base_seed}:{cls_name}:{index}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "little") >> 1
+
+
+def _rng(rng: Optional[random.Random]):
+    return random if rng is None else rng
+
+
+# ---------- I/O ----------
+
+def load_gray_keep_size(path: Path) -> Image.Image:
+    return Image.open(path).convert("L")  # x-ray เป็น gray จะสม่ำเสมอ
+
+
+def to_numpy(im: Image.Image) -> np.ndarray:
+    return np.array(im)
+
+
+def from_numpy(arr: np.ndarray) -> Image.Image:
+    return Image.fromarray(arr)
+
+
+def list_images(folder: Path) -> List[Path]:
+    return sorted([p for p in folder.rglob("*") if p.suffix.lower() in valid_exts and p.is_file()],
+                  key=lambda p: p.name)
+
+
+def ensure_dir(d: Path) -> None:
+    d.mkdir(parents=True, exist_ok=True)
+
+
+# ---------- vectorized ops (stack รูปขนาดเดียวกัน shape = (N, H, W)) ----------
+
+def _per_image(values, n: int) -> np.ndarray:
+    return np.broadcast_to(np.asarray(values, dtype=np.float32), (n,)).reshape(n, 1, 1)
+
+
+def adjust_brightness_batch(stack: np.ndarray, factors) -> np.ndarray:
+    """เหมือน ImageEnhance.Brightness: blend กับภาพดำ → x * f"""
+    out = stack.astype(np.float32) * _per_image(factors, len(stack))
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def adjust_contrast_batch(stack: np.ndarray, factors) -> np.ndarray:
+    """เหมือน ImageEnhance.Contrast: blend กับค่าเฉลี่ยของแต่ละรูป → m + f * (x - m)"""
+    x = stack.astype(np.float32)
+    mean = np.floor(x.mean(axis=(1, 2), keepdims=True) + 0.5)
+    out = mean + _per_image(factors, len(stack)) * (x - mean)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def add_gaussian_noise_batch(stack: np.ndarray, stds, seeds: Sequence[int]) -> np.ndarray:
+    """noise ของแต่ละรูปมาจาก generator ของ seed รูปนั้น → ผลไม่ขึ้นกับว่าอยู่ batch ไหน"""
+    h, w = stack.shape[1:]
+    noise = np.stack([np.random.default_rng(s).standard_normal((h, w), dtype=np.float32) for s in seeds])
+    out = stack.astype(np.float32) + noise * _per_image(stds, len(stack))
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+# ---------- แผน augmentation ต่อรูป ----------
+
+@dataclass
+class AugPlan:
+    """
+    ค่าสุ่มทั้งหมดของรูปเสริมหนึ่งรูป (สุ่มครั้งเดียวจาก seed ของรูป แล้วค่อยนำไปใช้)
+    ops    : ลำดับขั้น ("affine" / "crop" / "enhance") หลัง shuffle
+    affine : (angle, tx_ratio, ty_ratio, scale)
+    crop   : (dx_ratio, dy_ratio)
+    ค่า None = ไม่ทำขั้นนั้น
+    """
+    ops: List[str] = field(default_factory=lambda: ["enhance"])
+    affine: Optional[Tuple[float, float, float, float]] = None
+    crop: Optional[Tuple[float, float]] = None
+    brightness: Optional[float] = None
+    contrast: Optional[float] = None
+    sharpness: Optional[float] = None
+    blur: Optional[float] = None
+    noise_std: Optional[float] = None
+    noise_seed: int = 0
+    equalize: bool = False
+    autocontrast: bool = False
+
+
+def _sample_affine(r, max_deg=MAX_ROT_DEG, max_trans=0.05, scale_range=(0.95, 1.05)):
+    return (r.uniform(-max_deg, max_deg), r.uniform(-max_trans, max_trans),
+            r.uniform(-max_trans, max_trans), r.uniform(*scale_range))
+
+
+def _sample_crop(r, max_ratio=0.05):
+    return r.uniform(0, max_ratio), r.uniform(0, max_ratio)
+
+
+def _sample_enhance(r, plan: AugPlan, noise_range=(2, 6)) -> AugPlan:
+    # ความน่าจะเป็นเดียวกับ enhance_random เดิมใน notebook
+    if r.random() < 0.7:
+        plan.brightness = r.uniform(0.9, 1.1)
+    if r.random() < 0.7:
+        plan.contrast = r.uniform(0.9, 1.1)
+    if r.random() < 0.3:
+        plan.sharpness = r.uniform(0.8, 1.2)
+    if r.random() < 0.25:
+        plan.blur = r.uniform(0.0, 1.2)
+    if r.random() < 0.3:
+        plan.noise_std = r.uniform(*noise_range)
+        plan.noise_seed = r.getrandbits(63)
+    plan.equalize = r.random() < 0.25
+    plan.autocontrast = r.random() < 0.25
+    return plan
+
+
+def sample_plan(rng: Optional[random.Random] = None) -> AugPlan:
+    """สุ่มแผนแบบเดียวกับ augment_once เดิม: affine 90%, crop 60%, enhance เสมอ แล้วสลับลำดับ"""
+    r = _rng(rng)
+    plan = AugPlan(ops=[])
+    if r.random() < 0.9:
+        plan.ops.append("affine")
+        plan.affine = _sample_affine(r)
+    if r.random() < 0.6:
+        plan.ops.append("crop")
+        plan.crop = _sample_crop(r)
+    plan.ops.append("enhance")
+    _sample_enhance(r, plan)
+    r.shuffle(plan.ops)
+    return plan
+
+
+# ---------- ขั้น geometric (ทีละรูป) ----------
+
+def _affine(im: Image.Image, angle: float, tx_ratio: float, ty_ratio: float, scale: float) -> Image.Image:
+    w, h = im.size
+    # 1) scale
+    new_w, new_h = int(w * scale), int(h * scale)
+    im2 = im.resize((new_w, new_h), resample=Image.BICUBIC)
+    # 2) pad/crop to original size
+    canvas = Image.new("L", (w, h), 0)
+    canvas.paste(im2, ((w - new_w) // 2, (h - new_h) // 2))
+    # 3) rotate (fill=0 = ดำ)
+    canvas = canvas.rotate(angle, resample=Image.BICUBIC, expand=False, fillcolor=0)
+    # 4) translate via affine matrix (a, b, c, d, e, f) → translate = (c, f)
+    return canvas.transform((w, h), Image.AFFINE, (1, 0, tx_ratio * w, 0, 1, ty_ratio * h),
+                            resample=Image.BICUBIC, fillcolor=0)
+
+
+def safe_int(v, a, b):  # clamp
+    return max(a, min(b, int(v)))
+
+
+def _crop_pad(im: Image.Image, dx_ratio: float, dy_ratio: float) -> Image.Image:
+    w, h = im.size
+    dx, dy = int(w * dx_ratio), int(h * dy_ratio)
+    box = (safe_int(dx, 0, w // 2), safe_int(dy, 0, h // 2),
+           safe_int(w - dx, w // 2, w), safe_int(h - dy, h // 2, h))
+    return im.crop(box).resize((w, h), Image.BICUBIC)
+
+
+# ---------- ขั้น enhance (vectorized ต่อกลุ่มขนาดเดียวกัน) ----------
+
+def _pil_step(stack: np.ndarray, idx: List[int], fn) -> None:
+    for i in idx:
+        stack[i] = to_numpy(fn(i, from_numpy(stack[i])))
+
+
+def _enhance_stack(stack: np.ndarray, plans: List[AugPlan]) -> np.ndarray:
+    """ลำดับเดียวกับ enhance_random เดิม: brightness → contrast → sharpness → blur → noise → equalize → autocontrast"""
+    pick = lambda attr: [i for i, p in enumerate(plans) if getattr(p, attr) is not None]
+    flag = lambda attr: [i for i, p in enumerate(plans) if getattr(p, attr)]
+
+    idx = pick("brightness")
+    if idx:
+        stack[idx] = adjust_brightness_batch(stack[idx], [plans[i].brightness for i in idx])
+    idx = pick("contrast")
+    if idx:
+        stack[idx] = adjust_contrast_batch(stack[idx], [plans[i].contrast for i in idx])
+    _pil_step(stack, pick("sharpness"), lambda i, im: ImageEnhance.Sharpness(im).enhance(plans[i].sharpness))
+    _pil_step(stack, pick("blur"), lambda i, im: im.filter(ImageFilter.GaussianBlur(radius=plans[i].blur)))
+    idx = pick("noise_std")
+    if idx:
+        stack[idx] = add_gaussian_noise_batch(stack[idx], [plans[i].noise_std for i in idx],
+                                              [plans[i].noise_seed for i in idx])
+    _pil_step(stack, flag("equalize"), lambda i, im: ImageOps.equalize(im))
+    _pil_step(stack, flag("autocontrast"), lambda i, im: ImageOps.autocontrast(im, cutoff=2))
+    return stack
+
+
+def _enhance_group(images: List[Image.Image], plans: List[AugPlan], members: List[int]) -> None:
+    by_size: Dict[Tuple[int, int], List[int]] = {}
+    for i in members:
+        by_size.setdefault(images[i].size, []).append(i)
+    for idx in by_size.values():
+        stack = np.stack([to_numpy(images[i]) for i in idx])
+        stack = _enhance_stack(stack, [plans[i] for i in idx])
+        for k, i in enumerate(idx):
+            images[i] = from_numpy(stack[k])
+
+
+def augment_batch(images: Sequence[Image.Image], plans: Sequence[AugPlan]) -> List[Image.Image]:
+    """
+    ใช้แผนของแต่ละรูปกับ batch ทั้งก้อน: เดินทีละตำแหน่งของ ops
+    รูปที่ถึงขั้น enhance พร้อมกันจะถูก stack แล้วทำ brightness/contrast/noise ในครั้งเดียว
+    ผลของแต่ละรูปขึ้นกับแผนของมันเท่านั้น (เหมือนเรียกทีละรูป)
+    """
+    out = [im if im.mode == "L" else im.convert("L") for im in images]
+    for step in range(max((len(p.ops) for p in plans), default=0)):
+        enhance = []
+        for i, p in enumerate(plans):
+            if step >= len(p.ops):
+                continue
+            op = p.ops[step]
+            if op == "affine":
+                out[i] = _affine(out[i], *p.affine)
+            elif op == "crop":
+                out[i] = _crop_pad(out[i], *p.crop)
+            else:
+                enhance.append(i)
+        if enhance:
+            _enhance_group(out, list(plans), enhance)
+    return out
+
+
+# ---------- ฟังก์ชันเดิมของ notebook (รับ rng ได้; ไม่ใส่ = ใช้ random ของ module เหมือนเดิม) ----------
+
+def add_gaussian_noise(im: Image.Image, std_range=(2, 8), rng: Optional[random.Random] = None) -> Image.Image:
+    r = _rng(rng)
+    std = r.uniform(*std_range)
+    return from_numpy(add_gaussian_noise_batch(to_numpy(im)[None], [std], [r.getrandbits(63)])[0])
+
+
+def random_affine_no_flip(im: Image.Image, max_deg=MAX_ROT_DEG, max_trans=0.05, scale_range=(0.95, 1.05),
+                          rng: Optional[random.Random] = None) -> Image.Image:
+    # หมุน ±10°, เลื่อน ≤5%, สเกล 0.95–1.05 โดย "ไม่กลับด้าน"
+    return _affine(im, *_sample_affine(_rng(rng), max_deg, max_trans, scale_range))
+
+
+def random_crop_pad(im: Image.Image, max_ratio=0.05, rng: Optional[random.Random] = None) -> Image.Image:
+    # ครอปเล็กน้อยแล้ว pad กลับให้เท่าเดิม
+    return _crop_pad(im, *_sample_crop(_rng(rng), max_ratio))
+
+
+def enhance_random(im: Image.Image, rng: Optional[random.Random] = None) -> Image.Image:
+    # ปรับแสง/คอนทราสต์/ชาร์ปเพลส/บลอร์ แบบสุ่มเบาๆ
+    plan = _sample_enhance(_rng(rng), AugPlan())
+    return augment_batch([im], [plan])[0]
+
+
+def augment_once(im: Image.Image, rng: Optional[random.Random] = None) -> Image.Image:
+    # ลำดับแบบสุ่มเล็กน้อย (ไม่ flip)
+    return augment_batch([im], [sample_plan(rng)])[0]
+
+
+# ---------- บาลานซ์ ----------
+
+@dataclass
+class AugJob:
+    src: str
+    dst: str
+    seed: int
+    size: Tuple[int, int]  # (W, H) ที่บังคับให้รูปเสริม (ขนาดรูปแรกของคลาส เหมือน notebook)
+
+
+def plan_class(cls_name: str, src_imgs: List[Path], cls_dst: Path, target: int = TARGET_PER_CLASS,
+               seed: int = SEED) -> Tuple[List[Path], List[AugJob]]:
+    """คืน (รูปต้นฉบับที่จะก็อปปี้, งาน augment) — ไม่แตะไฟล์"""
+    n = len(src_imgs)
+    if n == 0:
+        return [], []
+    if n >= target:
+        return random.Random(image_seed(seed, cls_name, "sample")).sample(src_imgs, target), []
+    with Image.open(src_imgs[0]) as first:
+        size = first.size
+    jobs = []
+    # เติมแบบวนรอบแหล่งรูป
+    for aug_id in range(1, target - n + 1):
+        src_p = src_imgs[(aug_id - 1) % n]
+        jobs.append(AugJob(src=str(src_p), dst=str(cls_dst / f"{src_p.stem}_aug{aug_id:04d}.png"),
+                           seed=image_seed(seed, cls_name, aug_id), size=size))
+    return list(src_imgs), jobs
+
+
+def augment_jobs(jobs: List[AugJob]) -> int:
+    """ทำงาน augment หนึ่ง chunk (ใช้ได้ทั้งใน worker process และ process หลัก)"""
+    loaded: Dict[str, Image.Image] = {}
+    for job in jobs:
+        if job.src not in loaded:
+            loaded[job.src] = load_gray_keep_size(Path(job.src))
+    plans = [sample_plan(random.Random(job.seed)) for job in jobs]
+    outs = augment_batch([loaded[job.src] for job in jobs], plans)
+    for job, im in zip(jobs, outs):
+        if im.size != job.size:
+            im = im.resize(job.size, Image.BICUBIC)  # บังคับขนาดกลับเท่าเดิม
+        im.save(job.dst)
+    return len(jobs)
+
+
+def _chunks(items: List, size: int) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def balance_all(
+    classes: Iterable[str] = ALLOWED_CLASSES,
+    src_root: Path = images_root,
+    dst_root: Path = balanced_root,
+    target: int = TARGET_PER_CLASS,
+    seed: int = SEED,
+    workers: Optional[int] = None,
+    batch_size: int = 16,
+) -> Dict[str, int]:
+    """
+    บาลานซ์หลายคลาสพร้อมกัน: ก็อปปี้ใน process หลัก แล้วส่งงาน augment ของทุกคลาสเข้า pool เดียว
+    workers=None → os.cpu_count(); workers<=1 → ไม่สร้าง pool (ผลเหมือนกันทุกกรณี)
+    คืน dict: คลาส -> จำนวนรูปหลังบาลานซ์
+    """
+    src_root, dst_root = Path(src_root), Path(dst_root)
+    counts: Dict[str, int] = {}
+    all_jobs: List[AugJob] = []
+    for cls_name in sorted(classes):
+        cls_dst = dst_root / cls_name
+        ensure_dir(cls_dst)
+        src_imgs = list_images(src_root / cls_name)
+        n = len(src_imgs)
+        if n == 0:
+            print(f"[WARN] {cls_name}: ไม่มีรูป ข้าม")
+            counts[cls_name] = 0
+            continue
+        copy, jobs = plan_class(cls_name, src_imgs, cls_dst, target, seed)
+        for p in copy:
+            shutil.copy2(p, cls_dst / p.name)  # ก็อปปี้แบบใช้ชื่อเดิม
+        if jobs:
+            print(f"[INFO] {cls_name}: เดิม {n} → augment เพิ่ม {len(jobs)} ให้ครบ {target}")
+        else:
+            print(f"[INFO] {cls_name}: เดิม {n} → ใช้ {target} (สุ่ม)")
+        all_jobs.extend(jobs)
+        counts[cls_name] = len(copy) + len(jobs)
+
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    chunks = list(_chunks(all_jobs, max(1, batch_size)))
+    t0 = time.perf_counter()
+    if workers <= 1 or len(chunks) <= 1:
+        done = sum(augment_jobs(c) for c in chunks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = sum(pool.map(augment_jobs, chunks))
+    elapsed = time.perf_counter() - t0
+    if done:
+        print(f"[INFO] augment {done} รูปใน {elapsed:.1f}s ({done / elapsed:.1f} รูป/s, workers={max(1, workers)})")
+    print(f"[DONE] รวมหลังบาลานซ์ = {sum(counts.values())} รูป")
+    return counts
+
+
+def balance_class(cls_name: str, src_root: Path = images_root, dst_root: Path = balanced_root,
+                  target: int = TARGET_PER_CLASS, seed: int = SEED, workers: Optional[int] = 1,
+                  batch_size: int = 16) -> int:
+    """บาลานซ์คลาสเดียว (API เดิมของ notebook) คืนจำนวนรูปหลังบาลานซ์"""
+    return balance_all([cls_name], src_root, dst_root, target, seed, workers, batch_size)[cls_name]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Balance X-ray classes to a fixed count with seeded augmentation")
+    parser.add_argument("--images-root", default=str(images_root))
+    parser.add_argument("--out", default=str(balanced_root))
+    parser.add_argument("--classes", nargs="*", default=sorted(ALLOWED_CLASSES))
+    parser.add_argument("--target", type=int, default=TARGET_PER_CLASS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--workers", type=int, default=None, help="default = จำนวน core; 0/1 = ไม่ใช้ pool")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    balance_all(args.classes, args.images_root, args.out, target=args.target, seed=args.seed,
+                workers=args.workers, batch_size=args.batch_size)
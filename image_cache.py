@@ -0,0 +1,317 @@
+"""
+แคชรูป X-ray ที่ preprocess แล้ว (แทนการเปิด JPEG/TIFF/BMP → gray → ให้ processor ย่อใหม่ทุก epoch / ทุกรอบ eval)
+
+- preprocess: decode (JPEG ใช้ draft ให้ libjpeg ย่อระหว่าง decode) → gray "L" → pad/ย่อเป็น side×side
+  ค่า mean/std ให้ processor ทำตามเดิม (เก็บ uint8 เล็กกว่า float32 4 เท่า)
+- key = blake2b ของไบต์ไฟล์ + (side, fit) → ไฟล์เดียวกันคนละชื่อ/คนละ shard ใช้ slot เดียวกัน, เปลี่ยน side = key ใหม่
+- เก็บเป็น memmap ขนาด slot คงที่: slots.u8 (capacity, side, side) + keys.u8 (capacity, 16) + meta.json
+  อ่าน cache = memcpy จาก page cache ไม่มี decode
+- จำกัดขนาดด้วย max_mb: เต็มแล้วเขียนทับ slot ที่ไม่ได้ใช้นานที่สุด (LRU, ลำดับการใช้เก็บใน ticks.npy)
+  key ของ slot ถูกล้างก่อนเขียนพิกเซลและเขียนกลับหลังเขียนเสร็จ → ถ้า process ตายกลางคัน slot นั้นแค่หายไป
+- side เป็นพหุคูณของ 28 (patch 14 × merge 2 ของ Qwen2.5-VL) → smart_resize ไม่ย่อต่อ
+  vision token ต่อรูปคงที่ = (side / 28)²: 448 → 256 token, 336 → 144 token
+
+ใช้:
+    cache = ImageCache("lung8_image_cache", side=448, max_mb=2048)
+    cache.warm_shards(shards_root)                                   # ครั้งเดียว ก่อนเทรน
+    ds = LazyConversationDataset.open(shards_root, image_cache=cache)
+    hf = to_hf(shards_root, image_cache=cache)                       # datasets.Dataset + set_transform
+    im = cache.get_path("lung8_balanced_1000/Normal/x.jpg")          # รูปจากโฟลเดอร์
+DataLoader แบบหลาย worker: แต่ละ worker มี index ของตัวเอง → warm ให้ครบก่อน แล้วเปิดด้วย read_only=True
+(miss ใน worker จะ preprocess ให้แต่ไม่เขียนลง cache)
+ผู้ใช้ cache ที่ warm ไว้แล้ว (caption_images --image-cache) เปิดด้วย ImageCache.open(root) → side/fit ตาม meta.json
+(ImageCache(root) ด้วย side/fit ที่ไม่ตรงจะล้าง cache แล้วสร้างใหม่)
+
+CLI:
+    python image_cache.py --shards lung8_image_text_shards --side 448 --max-mb 2048
+    python image_cache.py --folder lung8_balanced_1000 --side 336
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+PATCH_SIZE = 14
+MERGE_SIZE = 2
+KEY_BYTES = 16
+
+PIXELS_NAME = "slots.u8"
+KEYS_NAME = "keys.u8"
+TICKS_NAME = "ticks.npy"
+META_NAME = "meta.json"
+
+
+def vision_tokens(width: int, height: int, patch: int = PATCH_SIZE, merge: int = MERGE_SIZE) -> int:
+    """จำนวน vision token ของ Qwen2.5-VL หลัง smart_resize (ปัดแต่ละด้านเป็นพหุคูณของ patch × merge)"""
+    f = patch * merge
+    return max(1, round(height / f)) * max(1, round(width / f))
+
+
+def preprocess(data: bytes, side: int, fit: str = "pad") -> np.ndarray:
+    """ไบต์ไฟล์รูป → uint8 (side, side) แบบ gray; fit="pad" คงสัดส่วนแล้วเติมขอบดำ, "stretch" ย่อตรง ๆ"""
+    im = Image.open(io.BytesIO(data))
+    if im.format == "JPEG":
+        im.draft("L", (side, side))      # ให้ libjpeg decode ที่ 1/2, 1/4, ... ของขนาดเดิม (ไม่เล็กกว่า side)
+    im = im.convert("L")
+    if im.size != (side, side):
+        if fit == "pad":
+            im = ImageOps.pad(im, (side, side), method=Image.BICUBIC, color=0)
+        else:
+            im = im.resize((side, side), Image.BICUBIC)
+    return np.asarray(im, dtype=np.uint8)
+
+
+class ImageCache:
+    def __init__(self, root: Path = Path("lung8_image_cache"), side: int = 448, max_mb: float = 2048,
+                 fit: str = "pad", read_only: bool = False):
+        if side % (PATCH_SIZE * MERGE_SIZE):
+            print(f"[WARN] side={side} ไม่ใช่พหุคูณของ {PATCH_SIZE * MERGE_SIZE} → processor จะย่อ/ขยายต่ออีกรอบ")
+        if fit not in ("pad", "stretch"):
+            raise ValueError(f"unknown fit: {fit!r}")
+        self.root = Path(root)
+        self.side = side
+        self.fit = fit
+        self.read_only = read_only
+        self.capacity = max(1, int(max_mb * 2**20) // (side * side))
+        self._person = f"lc{side}{fit}".encode("utf-8")[:16]
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._path_keys: Dict[Tuple[str, int, int], bytes] = {}
+        self._open()
+
+    @classmethod
+    def open(cls, root: Path = Path("lung8_image_cache"), read_only: bool = False) -> "ImageCache":
+        """เปิด cache ที่ warm ไว้แล้วด้วย side/fit ตาม meta.json (ไม่ล้าง/สร้างใหม่เพราะค่าเริ่มต้นไม่ตรง)"""
+        meta_path = Path(root) / META_NAME
+        if not meta_path.exists():
+            raise FileNotFoundError(f"{root}: ยังไม่มี cache (warm ด้วย image_cache.py ก่อน)")
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        return cls(root, side=int(meta["side"]), fit=meta["fit"], read_only=read_only)
+
+    # ---------- storage ----------
+
+    def _open(self) -> None:
+        meta_path = self.root / META_NAME
+        meta = {"side": self.side, "fit": self.fit, "capacity": self.capacity, "dtype": "uint8"}
+        fresh = True
+        if meta_path.exists():
+            old = json.loads(meta_path.read_text(encoding="utf-8"))
+            if old.get("side") == self.side and old.get("fit") == self.fit:
+                # ขนาด slot เท่าเดิม: ใช้ capacity เดิม (max_mb ใหม่มีผลเมื่อสร้าง cache ใหม่เท่านั้น)
+                self.capacity = int(old["capacity"])
+                meta, fresh = old, False
+            elif self.read_only:
+                raise ValueError(f"{self.root}: cache สร้างด้วย side={old.get('side')} fit={old.get('fit')}")
+            else:
+                print(f"[Cache] {self.root}: side/fit เปลี่ยน → สร้าง cache ใหม่")
+        if fresh and self.read_only:
+            raise FileNotFoundError(f"{self.root}: ยังไม่มี cache (warm ก่อนเปิดแบบ read_only)")
+        if fresh:
+            self.root.mkdir(parents=True, exist_ok=True)
+            for name in (PIXELS_NAME, KEYS_NAME, TICKS_NAME):
+                if (self.root / name).exists():
+                    (self.root / name).unlink()
+
+        mode = "r" if self.read_only else ("w+" if fresh else "r+")
+        shape = (self.capacity, self.side, self.side)
+        self._pixels = np.memmap(self.root / PIXELS_NAME, dtype=np.uint8, mode=mode, shape=shape)
+        self._keys = np.memmap(self.root / KEYS_NAME, dtype=np.uint8, mode=mode, shape=(self.capacity, KEY_BYTES))
+        ticks_path = self.root / TICKS_NAME
+        self._ticks = np.load(ticks_path) if ticks_path.exists() and not fresh \
+            else np.zeros(self.capacity, dtype=np.int64)
+        used = np.flatnonzero(self._keys.any(axis=1))
+        self._slots: Dict[bytes, int] = dict(zip((bytes(k) for k in self._keys[used]), used.tolist()))
+        self._free = sorted(set(range(self.capacity)) - set(self._slots.values()), reverse=True)
+        self._tick = int(self._ticks.max()) if self.capacity else 0
+        if fresh:
+            meta_path.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+    def _store(self, key: bytes, arr: np.ndarray) -> None:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = int(np.argmin(self._ticks))
+            del self._slots[bytes(self._keys[slot])]
+            self.stats["evictions"] += 1
+        self._keys[slot] = 0
+        self._pixels[slot] = arr
+        self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+        self._slots[key] = slot
+        self._touch(slot)
+
+    def _touch(self, slot: int) -> None:
+        self._tick += 1
+        self._ticks[slot] = self._tick
+
+    def flush(self) -> None:
+        """เขียน memmap ลงดิสก์ + เก็บลำดับการใช้ (LRU) ไว้ใช้ต่อรอบหน้า"""
+        if self.read_only:
+            return
+        self._pixels.flush()
+        self._keys.flush()
+        np.save(self.root / TICKS_NAME, self._ticks)
+
+    def __enter__(self) -> "ImageCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, data: bytes) -> bool:
+        return self.key(data) in self._slots
+
+    # ---------- อ่าน ----------
+
+    def key(self, data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=KEY_BYTES, person=self._person).digest()
+
+    def _lookup(self, key: bytes, data) -> np.ndarray:
+        slot = self._slots.get(key)
+        if slot is not None:
+            self.stats["hits"] += 1
+            self._touch(slot)
+            return np.array(self._pixels[slot])          # copy: slot อาจถูกเขียนทับภายหลัง
+        self.stats["misses"] += 1
+        arr = preprocess(data() if callable(data) else data, self.side, self.fit)
+        if not self.read_only:
+            self._store(key, arr)
+        return arr
+
+    def get_array(self, data: bytes) -> np.ndarray:
+        """uint8 (side, side) ของรูปจากไบต์ไฟล์"""
+        return self._lookup(self.key(data), data)
+
+    def get(self, data: bytes) -> Image.Image:
+        """PIL mode "L" ขนาด side×side (โหมดเดียวกับรูปใน dataset เดิม)"""
+        return Image.fromarray(self.get_array(data), "L")
+
+    def get_path(self, path) -> Image.Image:
+        """รูปจากไฟล์: จำ key ตาม (path, size, mtime) → hit ครั้งถัดไปไม่ต้องอ่าน/hash ไฟล์"""
+        st = os.stat(path)
+        memo = (str(path), st.st_size, st.st_mtime_ns)
+        key = self._path_keys.get(memo)
+        if key is None:
+            data = Path(path).read_bytes()
+            key = self._path_keys[memo] = self.key(data)
+            return Image.fromarray(self._lookup(key, data), "L")
+        return Image.fromarray(self._lookup(key, lambda: Path(path).read_bytes()), "L")
+
+    # ---------- warm ----------
+
+    def warm(self, blobs: Iterable[bytes], flush_every: int = 1000) -> int:
+        """preprocess ไบต์รูปทั้งหมดลง cache (ข้ามที่มีอยู่แล้ว) คืนจำนวนรูปที่เพิ่มใหม่"""
+        added = 0
+        for i, data in enumerate(blobs, 1):
+            key = self.key(data)
+            if key not in self._slots:
+                self._store(key, preprocess(data, self.side, self.fit))
+                added += 1
+            if i % flush_every == 0:
+                self.flush()
+        self.flush()
+        if len(self._slots) >= self.capacity and self.stats["evictions"]:
+            print(f"[WARN] cache เต็ม ({self.capacity} slot) มีการเขียนทับระหว่าง warm → เพิ่ม max_mb")
+        return added
+
+    def warm_shards(self, shards: Path) -> int:
+        from dataset_builder import iter_batches
+
+        # ทีละ record batch → ไบต์รูปในหน่วยความจำไม่เกินทีละ batch
+        return self.warm(data.as_py() for batch in iter_batches(shards, columns=["image"])
+                         for data in batch.column(0).field("bytes"))
+
+    def warm_folder(self, folder: Path) -> int:
+        from image_balance import list_images
+
+        return self.warm(p.read_bytes() for p in list_images(Path(folder)))
+
+    # ---------- report ----------
+
+    def report(self) -> Dict:
+        s = self.stats
+        looked = s["hits"] + s["misses"]
+        report = {
+            "entries": len(self._slots),
+            "capacity": self.capacity,
+            "side": self.side,
+            "vision_tokens": vision_tokens(self.side, self.side),
+            "size_mb": self.capacity * self.side * self.side / 2**20,
+            "hit_rate": s["hits"] / looked if looked else 0.0,
+            **s,
+        }
+        print(f"[Cache] {self.root}: {report['entries']}/{self.capacity} รูป ({report['size_mb']:.0f} MB), "
+              f"{self.side}×{self.side} = {report['vision_tokens']} vision token/รูป, "
+              f"hit {s['hits']} / miss {s['misses']} / evict {s['evictions']}")
+        return report
+
+
+def conversation_transform(cache: ImageCache):
+    """dataset_builder.conversation_transform ที่อ่านรูปผ่าน cache (ใช้กับ datasets.Dataset.set_transform)"""
+    from dataset_builder import convert_to_conversation
+
+    def transform(batch: Dict) -> Dict:
+        images = [cache.get(im["bytes"]) if isinstance(im, dict) else im for im in batch["image"]]
+        return {"messages": [convert_to_conversation({"image": im, "text": t, "__class__": c})["messages"]
+                             for im, t, c in zip(images, batch["text"], batch["__class__"])]}
+
+    return transform
+
+
+def benchmark(blobs, cache: ImageCache, repeats: int = 3) -> Dict[str, float]:
+    """เวลาเฉลี่ยต่อรูป: decode + convert เดิม vs อ่านจาก cache"""
+    blobs = list(blobs)
+    t0 = time.perf_counter()
+    sizes = []
+    for data in blobs:
+        im = Image.open(io.BytesIO(data)).convert("L")
+        sizes.append(im.size)
+    decode = (time.perf_counter() - t0) / max(1, len(blobs))
+    cache.warm(blobs)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for data in blobs:
+            cache.get(data)
+    cached = (time.perf_counter() - t0) / max(1, len(blobs) * repeats)
+    native = float(np.mean([vision_tokens(w, h) for w, h in sizes])) if sizes else 0.0
+    print(f"[Bench] {len(blobs)} รูป: decode เดิม {decode * 1e3:.2f} ms/รูป → cache {cached * 1e3:.3f} ms/รูป "
+          f"({decode / max(cached, 1e-12):.0f}x), vision token {native:.0f} → {vision_tokens(cache.side, cache.side)}")
+    return {"decode_ms": decode * 1e3, "cached_ms": cached * 1e3, "native_tokens": native,
+            "cached_tokens": vision_tokens(cache.side, cache.side)}
+
+
+if __name__ == "__main__":
+    from image_balance import list_images
+
+    parser = argparse.ArgumentParser(description="Preprocessed image cache for the vision pipeline")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--shards", help="โฟลเดอร์ shard จาก dataset_builder")
+    src.add_argument("--folder", help="โฟลเดอร์รูป เช่น lung8_balanced_1000")
+    parser.add_argument("--out", default="lung8_image_cache")
+    parser.add_argument("--side", type=int, default=448)
+    parser.add_argument("--fit", choices=["pad", "stretch"], default="pad")
+    parser.add_argument("--max-mb", type=float, default=2048)
+    parser.add_argument("--bench", type=int, default=200, help="จำนวนรูปที่ใช้วัดเวลา (0 = ไม่วัด)")
+    args = parser.parse_args()
+
+    with ImageCache(args.out, args.side, args.max_mb, args.fit) as cache:
+        t0 = time.perf_counter()
+        added = cache.warm_shards(args.shards) if args.shards else cache.warm_folder(args.folder)
+        print(f"[Warm] เพิ่ม {added} รูปใน {time.perf_counter() - t0:.1f}s")
+        if args.bench:
+            if args.shards:
+                from dataset_builder import load_table
+
+                blobs = [c["bytes"] for c in load_table(args.shards).column("image")[:args.bench].to_pylist()]
+            else:
+                blobs = [p.read_bytes() for p in list_images(Path(args.folder))[:args.bench]]
+            benchmark(blobs, cache)
+        cache.report()
@@ -0,0 +1,175 @@
+"""
+Stratified k-fold แบบเก็บเป็น index (แทน train_hf.select(range(start, end)) + concatenate_datasets ใน progress4_qwen.ipynb)
+
+- stratified_fold_ids: สุ่มแถวในแต่ละคลาสแล้วแจกวนเข้า fold → ทุก fold มีสัดส่วน 8 คลาสเท่ากัน (ต่างกันไม่เกิน 1 แถว/คลาส)
+  ขนาด fold ต่างกันไม่เกิน 1 แถว
+- KFoldIndex: เก็บแค่ fold id ต่อแถว (int8) เป็น folds.npy + folds.json (n, k, seed, hash ของ label, จำนวนต่อคลาส)
+  โหลดแบบ mmap ได้ และ build_or_load จะใช้ไฟล์เดิมถ้า label/k/seed ตรงกัน
+- fold_view / iter_folds: คืน train/val เป็นมุมมองผ่าน indices (dataset.select) ไม่ copy ตาราง Arrow
+  ใช้ได้กับ datasets.Dataset, LazyConversationDataset (dataset_builder) และ PixelMemmapDataset (LoRA/pixel_memmap)
+
+ใช้ใน notebook:
+    splits = hf.train_test_split(test_size=0.15, seed=42)
+    folds = KFoldIndex.build_or_load(labels_of(splits["train"]), k=6, seed=42, out_dir="lung8_folds")
+    for i, train_fold, val_fold in iter_folds(splits["train"], folds):
+        ...
+
+CLI:
+    python kfold_split.py --shards lung8_image_text_shards --k 6 --out lung8_folds
+"""
+import argparse
+import hashlib
+import inspect
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+LABEL_COL = "__class__"
+FOLDS_NAME = "folds.npy"
+META_NAME = "folds.json"
+
+
+def labels_of(dataset, label_col: str = LABEL_COL) -> np.ndarray:
+    """label ของทุกแถว โดยไม่ decode รูป"""
+    if hasattr(dataset, "classes"):          # LazyConversationDataset
+        return np.asarray(dataset.classes)
+    if hasattr(dataset, "diseases"):         # PixelMemmapDataset
+        return np.asarray(dataset.diseases)
+    if hasattr(dataset, "with_format"):      # datasets.Dataset (ข้าม set_transform ที่อาจตัดคอลัมน์ทิ้ง)
+        return np.asarray(list(dataset.with_format(None)[label_col]))
+    return np.asarray([row[label_col] for row in dataset])
+
+
+def label_hash(labels: Sequence) -> str:
+    h = hashlib.sha256()
+    for v in labels:
+        h.update(str(v).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+def stratified_fold_ids(labels: Sequence, k: int, seed: int = 42) -> np.ndarray:
+    """fold id (0..k-1) ของแต่ละแถว — แบ่งแต่ละคลาสเท่า ๆ กัน"""
+    labels = np.asarray(labels)
+    if k < 2:
+        raise ValueError("k ต้องมีค่าอย่างน้อย 2")
+    if k > len(labels):
+        raise ValueError(f"k={k} มากกว่าจำนวนแถว ({len(labels)})")
+    rng = np.random.default_rng(seed)
+    classes, inverse = np.unique(labels, return_inverse=True)
+    fold = np.empty(len(labels), dtype=np.int8 if k <= 127 else np.int32)
+    offset = 0
+    for c in range(len(classes)):
+        rows = rng.permutation(np.flatnonzero(inverse == c))
+        # ต่อ offset ข้ามคลาส → เศษของแต่ละคลาสไปลง fold ที่ยังเล็กกว่า
+        fold[rows] = (offset + np.arange(len(rows))) % k
+        offset += len(rows)
+    return fold
+
+
+class KFoldIndex:
+    def __init__(self, fold_ids: np.ndarray, meta: Optional[Dict] = None):
+        self.fold_ids = fold_ids
+        self.k = int(meta["k"]) if meta else int(fold_ids.max()) + 1
+        self.meta = meta or {"n": int(len(fold_ids)), "k": self.k}
+
+    @classmethod
+    def build(cls, labels: Sequence, k: int = 6, seed: int = 42) -> "KFoldIndex":
+        labels = np.asarray(labels)
+        fold_ids = stratified_fold_ids(labels, k, seed)
+        classes = sorted(set(labels.tolist()))
+        counts = [{c: int(np.sum((fold_ids == f) & (labels == c))) for c in classes} for f in range(k)]
+        meta = {"n": int(len(labels)), "k": k, "seed": seed, "label_hash": label_hash(labels), "counts": counts}
+        return cls(fold_ids, meta)
+
+    @classmethod
+    def load(cls, out_dir: Path, mmap: bool = True) -> "KFoldIndex":
+        out_dir = Path(out_dir)
+        meta = json.loads((out_dir / META_NAME).read_text(encoding="utf-8"))
+        return cls(np.load(out_dir / FOLDS_NAME, mmap_mode="r" if mmap else None), meta)
+
+    @classmethod
+    def build_or_load(cls, labels: Sequence, k: int = 6, seed: int = 42, out_dir: Path = Path("folds")) -> "KFoldIndex":
+        """ใช้ folds ที่เคยเซฟไว้ถ้า label/k/seed ตรงกัน ไม่งั้นสร้างใหม่แล้วเซฟ"""
+        labels = np.asarray(labels)
+        out_dir = Path(out_dir)
+        if (out_dir / META_NAME).exists() and (out_dir / FOLDS_NAME).exists():
+            folds = cls.load(out_dir)
+            m = folds.meta
+            if m.get("k") == k and m.get("seed") == seed and m.get("n") == len(labels) \
+                    and m.get("label_hash") == label_hash(labels):
+                print(f"[Folds] loaded {out_dir} (k={k}, n={len(labels)})")
+                return folds
+            print(f"[Folds] {out_dir} ไม่ตรงกับ label/k/seed ปัจจุบัน → สร้างใหม่")
+        folds = cls.build(labels, k, seed)
+        folds.save(out_dir)
+        return folds
+
+    def save(self, out_dir: Path) -> Path:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        np.save(out_dir / FOLDS_NAME, np.asarray(self.fold_ids))
+        (out_dir / META_NAME).write_text(json.dumps(self.meta, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[Folds] saved {out_dir} (k={self.k}, n={len(self.fold_ids)})")
+        return out_dir
+
+    def __len__(self) -> int:
+        return self.k
+
+    def val_indices(self, fold: int) -> np.ndarray:
+        return np.flatnonzero(np.asarray(self.fold_ids) == fold)
+
+    def train_indices(self, fold: int) -> np.ndarray:
+        return np.flatnonzero(np.asarray(self.fold_ids) != fold)
+
+    def indices(self, folds: Sequence[int]) -> np.ndarray:
+        """index ของแถวที่อยู่ใน fold ที่เลือก (แทน concatenate_datasets([folds[i] for i in selected_folds]))"""
+        return np.flatnonzero(np.isin(np.asarray(self.fold_ids), list(folds)))
+
+    def sizes(self) -> List[int]:
+        return np.bincount(np.asarray(self.fold_ids), minlength=self.k).tolist()
+
+    def report(self) -> None:
+        counts = self.meta.get("counts")
+        print(f"[Folds] k={self.k}, n={len(self.fold_ids)}, sizes={self.sizes()}")
+        if counts:
+            for c in counts[0]:
+                print(f"  {c:<24s} " + " ".join(f"{fc[c]:5d}" for fc in counts))
+
+
+def _select(dataset, indices: np.ndarray):
+    # datasets.Dataset: keep_in_memory → indices mapping อยู่ใน RAM ไม่เขียน cache file ทุกครั้งที่สลับ fold
+    if "keep_in_memory" in inspect.signature(dataset.select).parameters:
+        return dataset.select(indices, keep_in_memory=True)
+    return dataset.select(indices)
+
+
+def fold_view(dataset, folds: KFoldIndex, fold: int) -> Tuple[object, object]:
+    """(train, val) ของ fold ที่กำหนด เป็นมุมมองผ่าน indices ของ dataset เดิม"""
+    if len(dataset) != len(folds.fold_ids):
+        raise ValueError(f"dataset มี {len(dataset)} แถว แต่ folds สร้างจาก {len(folds.fold_ids)} แถว")
+    return _select(dataset, folds.train_indices(fold)), _select(dataset, folds.val_indices(fold))
+
+
+def iter_folds(dataset, folds: KFoldIndex, only: Optional[Sequence[int]] = None) -> Iterator[Tuple[int, object, object]]:
+    for i in (range(folds.k) if only is None else only):
+        train, val = fold_view(dataset, folds, i)
+        yield i, train, val
+
+
+if __name__ == "__main__":
+    from dataset_builder import LazyConversationDataset, shards_root
+
+    parser = argparse.ArgumentParser(description="Stratified k-fold index arrays for the lung8 train split")
+    parser.add_argument("--shards", default=str(shards_root))
+    parser.add_argument("--test-size", type=float, default=0.15, help="blind test ที่กันไว้ก่อนทำ fold")
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="lung8_folds")
+    args = parser.parse_args()
+
+    ds = LazyConversationDataset.open(args.shards, transform=None)
+    train = ds.train_test_split(test_size=args.test_size, seed=args.seed)["train"] if args.test_size > 0 else ds
+    KFoldIndex.build_or_load(labels_of(train), args.k, args.seed, args.out).report()
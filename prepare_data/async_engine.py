@@ -0,0 +1,450 @@
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from scheduler import GeminiScheduler, finish_reason_of
+from stream_csv import ClassCsvWriter, ParagraphSplitter
+
+
+# ========= โครงสร้างงาน/ผลลัพธ์ต่อ 1 call =========
+@dataclass
+class CallJob:
+    """งาน 1 call: เลขลำดับ (กำหนดไว้ล่วงหน้า), จำนวนข้อความ, contents และไฟล์ปลายทาง"""
+    seq: int
+    n_items: int
+    contents: Any
+    out_path: Path
+    keep: Optional[int] = None      # เก็บไม่เกินกี่ข้อความ (run_to_target ขอเผื่อ gate แต่ไม่อยากได้เกินส่วนที่ขาด)
+
+
+@dataclass
+class CallResult:
+    seq: int
+    n_items: int
+    out_path: Path
+    text: str = ""
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    n_parsed: Optional[int] = None
+    finish_reason: str = ""
+    attempts: int = 1
+    prompt_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    thinking_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    n_rejected: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def input_note(self) -> str:
+        """token ขาเข้าของ call: ทั้งหมด / ส่วนที่มาจาก cache (ว่างถ้าไม่รู้ usage)"""
+        if self.prompt_tokens is None:
+            return ""
+        if self.cached_tokens:
+            return f", in {self.prompt_tokens} tok (cached {self.cached_tokens})"
+        return f", in {self.prompt_tokens} tok"
+
+    @property
+    def truncated(self) -> bool:
+        """ถูกตัดด้วย max tokens หรือได้ข้อความน้อยกว่าที่ขอ (แถวที่ quality gate ตัดทิ้งไม่นับว่าถูกตัด)"""
+        if not self.ok:
+            return False
+        if self.finish_reason == "MAX_TOKENS":
+            return True
+        return self.n_parsed is not None and self.n_parsed + self.n_rejected < self.n_items
+
+
+def extract_response_text(resp) -> str:
+    """ดึงข้อความจาก response: ใช้ resp.text ก่อน ถ้าไม่มีค่อยรวมจาก candidates/parts"""
+    text_out = getattr(resp, "text", None)
+    if text_out:
+        return text_out
+    try:
+        if hasattr(resp, "candidates") and resp.candidates:
+            parts = []
+            for p in getattr(resp.candidates[0].content, "parts", []) or []:
+                if hasattr(p, "text") and p.text:
+                    parts.append(p.text)
+            return "\n".join(parts).strip()
+    except Exception:
+        pass
+    return ""
+
+
+def usage_counts(resp) -> Dict[str, Optional[int]]:
+    """token usage จาก resp.usage_metadata (prompt / output / thinking)"""
+    usage = getattr(resp, "usage_metadata", None)
+
+    def get(name):
+        v = getattr(usage, name, None) if usage is not None else None
+        return int(v) if v is not None else None
+
+    return {
+        "prompt_tokens": get("prompt_token_count"),
+        "output_tokens": get("candidates_token_count"),
+        "thinking_tokens": get("thoughts_token_count"),
+        "cached_tokens": get("cached_content_token_count"),
+    }
+
+
+def input_token_report(results: Sequence[CallResult]) -> str:
+    """สรุป token ขาเข้าเฉลี่ยต่อ call: ก่อน cache (ทั้ง prompt) → หลัง cache (ส่วนที่ไม่ได้มาจาก cache)"""
+    known = [r for r in results if r.ok and r.prompt_tokens is not None]
+    if not known:
+        return "[Tokens] ไม่มี usage_metadata"
+    full = sum(r.prompt_tokens for r in known) / len(known)
+    billed = sum(r.prompt_tokens - (r.cached_tokens or 0) for r in known) / len(known)
+    return f"[Tokens] input/call {full:.0f} → uncached {billed:.0f} ({len(known)} calls)"
+
+
+def _contents_chars(contents: Any) -> int:
+    total = 0
+    for c in contents or []:
+        for p in getattr(c, "parts", None) or []:
+            total += len(getattr(p, "text", "") or "")
+    return total
+
+
+# ========= ตัวรันแบบ async (จำกัดจำนวน call ที่ค้างอยู่พร้อมกัน) =========
+async def _run_one(client, job: CallJob, model_name: str, config, timeout: Optional[float],
+                   semaphore: asyncio.Semaphore, scheduler: Optional[GeminiScheduler] = None,
+                   split_items: Optional[Callable[[str], List[str]]] = None,
+                   on_result: Optional[Callable[[CallResult], None]] = None) -> CallResult:
+    result = await call_and_save(client, job, model_name, config, timeout, semaphore, scheduler, split_items)
+    if on_result is not None:
+        on_result(result)
+    return result
+
+
+async def call_and_save(client, job: CallJob, model_name: str, config, timeout: Optional[float],
+                        semaphore: asyncio.Semaphore, scheduler: Optional[GeminiScheduler],
+                        split_items: Optional[Callable[[str], List[str]]]) -> CallResult:
+    """ยิง 1 call (ผ่าน scheduler ถ้ามี) แล้วบันทึก <seq>.txt; error/timeout คืนเป็น CallResult.error"""
+    async with semaphore:
+        t0 = time.perf_counter()
+        attempts = 1
+        try:
+            def call():
+                return client.aio.models.generate_content(
+                    model=model_name,
+                    contents=job.contents,
+                    config=config,
+                )
+
+            if scheduler is None:
+                resp = await asyncio.wait_for(call(), timeout=timeout)
+            else:
+                est = scheduler.estimate_tokens(_contents_chars(job.contents), job.n_items)
+                resp, attempts = await scheduler.run(call, est_tokens=est, timeout=timeout)
+        except asyncio.TimeoutError:
+            elapsed = time.perf_counter() - t0
+            print(f"[Timeout] {job.out_path}  (> {timeout}s)")
+            return CallResult(job.seq, job.n_items, job.out_path, elapsed=elapsed, error="timeout")
+        except Exception as e:
+            elapsed = time.perf_counter() - t0
+            print(f"[Failed] {job.out_path}  ({type(e).__name__}: {e})")
+            return CallResult(job.seq, job.n_items, job.out_path, elapsed=elapsed, error=repr(e))
+        elapsed = time.perf_counter() - t0
+
+    return _finish(job, resp, elapsed, attempts, split_items)
+
+
+def _cut_before(text: str, items: List[str], k: int) -> str:
+    """ข้อความก่อน items[k] (หาตำแหน่งไล่ตามลำดับ เผื่อมีข้อความซ้ำกัน)"""
+    pos = start = 0
+    for item in items[:k + 1]:
+        start = text.find(item, pos)
+        pos = start + len(item)
+    return text[:start].rstrip()
+
+
+def _finish(job: CallJob, resp, elapsed: float, attempts: int,
+            split_items: Optional[Callable[[str], List[str]]]) -> CallResult:
+    """แยกข้อความ, ตัดข้อความสุดท้ายที่ถูกตัด (MAX_TOKENS), กรองด้วย quality gate, บันทึกไฟล์ (ถ้ามีข้อความ) และสร้าง CallResult"""
+    text_out = extract_response_text(resp).strip()
+    finish_reason = finish_reason_of(resp)
+    n_parsed = None
+    n_rejected = 0
+    if split_items is not None:
+        items = split_items(text_out)
+        if finish_reason == "MAX_TOKENS" and items:
+            # ข้อความสุดท้ายถูกตัดกลางคัน → ทิ้งก่อนบันทึก
+            text_out = text_out[: text_out.rfind(items[-1])].rstrip()
+            items = items[:-1]
+        accept = getattr(split_items, "accept", None)
+        if accept is not None and items:
+            # quality_gate.GatedSplit: ทิ้งแถวที่ไม่ผ่านก่อนเขียน → n_parsed ลดลง, run_to_target เติมเฉพาะส่วนที่ขาด
+            kept = accept(items)
+            n_rejected = len(items) - len(kept)
+            if n_rejected:
+                items = kept
+                text_out = split_items.rejoin(kept)
+        if job.keep is not None and len(items) > job.keep:
+            text_out = _cut_before(text_out, items, job.keep)
+            items = items[:job.keep]
+        n_parsed = len(items)
+
+    result = CallResult(job.seq, job.n_items, job.out_path, text=text_out, elapsed=elapsed,
+                        n_parsed=n_parsed, finish_reason=finish_reason, attempts=attempts, n_rejected=n_rejected,
+                        **usage_counts(resp))
+    got = f"{n_parsed}/{job.n_items}" if n_parsed is not None else f"~ {job.n_items}"
+    if n_rejected:
+        got += f", rejected {n_rejected}"
+    if n_parsed == 0 or not text_out:
+        # ไม่มีข้อความที่ใช้ได้ → ไม่สร้างไฟล์ว่าง (manifest ยังบันทึก call นี้ไว้พร้อม n_parsed=0)
+        print(f"[Empty] {job.out_path}  (items {got}, {elapsed:.1f}s{result.input_note}) ไม่บันทึกไฟล์")
+        return result
+    job.out_path.parent.mkdir(parents=True, exist_ok=True)
+    job.out_path.write_text(text_out, encoding="utf-8")
+    print(f"[Saved] {job.out_path}  (items {got}, {elapsed:.1f}s{result.input_note})")
+    return result
+
+
+def run_job_sync(client, job: CallJob, model_name: str, config,
+                 split_items: Optional[Callable[[str], List[str]]] = None) -> CallResult:
+    """เรียก 1 call แบบ blocking (client.models) — ใช้ในโหมดทีละ call; error โยนต่อตามเดิม"""
+    t0 = time.perf_counter()
+    resp = client.models.generate_content(
+        model=model_name,
+        contents=job.contents,
+        config=config,
+    )
+    return _finish(job, resp, time.perf_counter() - t0, 1, split_items)
+
+
+async def run_jobs(
+    client,
+    jobs: Sequence[CallJob],
+    model_name: str,
+    config,
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    scheduler: Optional[GeminiScheduler] = None,
+    split_items: Optional[Callable[[str], List[str]]] = None,
+    on_result: Optional[Callable[[CallResult], None]] = None,
+) -> List[CallResult]:
+    """
+    ยิงทุก job ผ่าน client.aio.models.generate_content พร้อมกัน แต่ไม่เกิน `concurrency` call
+    - timeout: วินาทีต่อ call (None = ไม่จำกัด); call ที่ timeout/error จะไม่ทำให้ call อื่นล้ม
+    - semaphore: ส่งตัวเดียวกันเข้ามาหลายชุดงาน (หลายโรค) เพื่อแชร์ขีดจำกัดรวม
+    - scheduler: ถ้ามี จะคุม RPM/TPM และ retry ให้แต่ละ call
+    - on_result: เรียกทันทีที่แต่ละ call จบ (เช่น บันทึกลง manifest)
+    ผลลัพธ์เรียงตาม seq เสมอ ไม่ว่า call ไหนจะเสร็จก่อน
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = await asyncio.gather(
+        *(_run_one(client, job, model_name, config, timeout, semaphore, scheduler, split_items, on_result)
+          for job in jobs)
+    )
+    return sorted(results, key=lambda r: r.seq)
+
+
+async def run_to_target(
+    client,
+    total_items: int,
+    make_job: Callable[[int], CallJob],
+    model_name: str,
+    config,
+    scheduler: GeminiScheduler,
+    split_items: Callable[[str], List[str]],
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    on_result: Optional[Callable[[CallResult], None]] = None,
+    max_empty_calls: int = 3,
+    min_accept_rate: float = 0.2,
+) -> List[CallResult]:
+    """
+    ยิงจนได้ข้อความครบ total_items โดยขนาดแต่ละ call มาจาก scheduler.items_per_call ณ ตอนนั้น
+    - response ที่ได้ไม่ครบ (ถูกตัด/ไม่ผ่าน quality gate) → ส่วนที่ขาดกลับเข้าคิว
+      (scheduler ลด items_per_call เฉพาะกรณีถูกตัด)
+    - แต่ละ call ขอ ceil(ส่วนที่ขาด / อัตราที่ได้จริงจนถึงตอนนี้) ข้อความ (ไม่เกิน items_per_call
+      และไม่เกิน 1/min_accept_rate เท่าของส่วนที่ขาด) → gate ที่ตัดทิ้งมากไม่ทำให้เติมทีละ 1–2 ข้อความ
+      จนชน max_empty_calls; ข้อความที่ผ่านเกินส่วนที่ขาดถูกตัดทิ้ง (CallJob.keep) → ได้ total_items พอดี
+    - call ที่ fail หลัง retry ครบ หรือได้ 0 ข้อความติดกัน max_empty_calls ครั้ง → หยุดรับงานใหม่
+      (กันวนยิงไม่รู้จบเมื่อ quota/คีย์มีปัญหา หรือ gate ตัดทิ้งทุกแถว)
+    make_job(n_items) ต้องจองเลข seq ใหม่ทุกครั้ง
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+    state = {"unclaimed": total_items, "stop": False, "empty": 0, "requested": 0, "accepted": 0}
+    results: List[CallResult] = []
+
+    def request_size(need: int) -> int:
+        rate = state["accepted"] / state["requested"] if state["requested"] else 1.0
+        rate = min(1.0, max(rate, min_accept_rate))
+        return max(need, min(scheduler.items_per_call, math.ceil(need / rate)))
+
+    async def worker():
+        while not state["stop"] and state["unclaimed"] > 0:
+            need = min(scheduler.items_per_call, state["unclaimed"])
+            state["unclaimed"] -= need
+            job = make_job(request_size(need))
+            job.keep = need
+            res = await _run_one(client, job, model_name, config, timeout,
+                                 semaphore, scheduler, split_items, on_result)
+            results.append(res)
+            if not res.ok:
+                state["unclaimed"] += need
+                state["stop"] = True
+                continue
+            scheduler.record_result(res.truncated)
+            state["requested"] += job.n_items
+            state["accepted"] += res.n_parsed or 0
+            state["unclaimed"] += max(0, need - (res.n_parsed or 0))
+            state["empty"] = 0 if res.n_parsed else state["empty"] + 1
+            if state["empty"] >= max_empty_calls:
+                state["stop"] = True
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    if state["stop"]:
+        print(f"[Stopped] เหลือ {state['unclaimed']} ข้อความที่ยังไม่ได้สร้าง (มี call ที่ fail หรือได้ 0 ข้อความติดกัน)")
+    return sorted(results, key=lambda r: r.seq)
+
+
+# ========= โหมด streaming: แยกย่อหน้าแล้ว append ลง CSV ของ class ทันที =========
+async def _consume_stream(client, job: CallJob, model_name: str, config,
+                          writer: ClassCsvWriter, state: Dict[str, Any]):
+    """
+    อ่าน generate_content_stream ทีละ chunk → ย่อหน้าที่ครบแล้วส่งเข้า writer ทันที
+    หยุดอ่านเมื่อ CSV ครบ target; ย่อหน้าสุดท้ายที่ถูกตัด (MAX_TOKENS) จะถูกทิ้ง
+    คืน chunk สุดท้าย (มี finish_reason / usage_metadata) — เก็บไว้ใน state["last"] ด้วยเผื่อ stream ขาดกลางคัน
+    """
+    splitter = ParagraphSplitter()
+    last = None
+    stream = await client.aio.models.generate_content_stream(
+        model=model_name,
+        contents=job.contents,
+        config=config,
+    )
+    try:
+        async for chunk in stream:
+            last = state["last"] = chunk
+            for para in splitter.feed(getattr(chunk, "text", None) or ""):
+                if writer.append(para):
+                    state["accepted"] += 1
+            if writer.full:
+                break
+        else:
+            tail = splitter.flush()
+            if tail and finish_reason_of(last) != "MAX_TOKENS" and writer.append(tail):
+                state["accepted"] += 1
+    finally:
+        writer.flush()
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    return last
+
+
+async def stream_call(client, job: CallJob, model_name: str, config, timeout: Optional[float],
+                      semaphore: asyncio.Semaphore, scheduler: Optional[GeminiScheduler],
+                      writer: ClassCsvWriter) -> CallResult:
+    """
+    ยิง 1 call แบบ streaming แล้ว append ย่อหน้าลง writer; n_parsed = จำนวนแถวที่เขียนจริง
+    429/503 กลาง stream หลังเขียนไปแล้วบางแถว: ไม่ยิง job.n_items ซ้ำทั้งก้อน — รอ backoff ของ scheduler แล้วคืนผล
+    บางส่วน ผู้เรียก (run_stream_to_csv จาก writer.remaining, job_planner จาก n_parsed) วางแผนส่วนที่ขาดใหม่เอง
+    """
+    state: Dict[str, Any] = {"accepted": 0, "last": None}
+
+    async def partial():
+        print(f"[Partial] {job.out_path}  (stream ขาดหลังเขียน {state['accepted']}/{job.n_items} rows → ไม่ยิงซ้ำ)")
+        return state["last"]
+
+    async with semaphore:
+        t0 = time.perf_counter()
+        attempts = 1
+        try:
+            def call():
+                if state["accepted"]:
+                    return partial()
+                return _consume_stream(client, job, model_name, config, writer, state)
+
+            if scheduler is None:
+                last = await asyncio.wait_for(call(), timeout=timeout)
+            else:
+                est = scheduler.estimate_tokens(_contents_chars(job.contents), job.n_items)
+                last, attempts = await scheduler.run(call, est_tokens=est, timeout=timeout)
+        except asyncio.TimeoutError:
+            elapsed = time.perf_counter() - t0
+            print(f"[Timeout] {job.out_path}  (> {timeout}s, +{state['accepted']} rows)")
+            return CallResult(job.seq, job.n_items, job.out_path, elapsed=elapsed, error="timeout",
+                              n_parsed=state["accepted"])
+        except Exception as e:
+            elapsed = time.perf_counter() - t0
+            print(f"[Failed] {job.out_path}  ({type(e).__name__}: {e})")
+            return CallResult(job.seq, job.n_items, job.out_path, elapsed=elapsed, error=repr(e),
+                              n_parsed=state["accepted"])
+        elapsed = time.perf_counter() - t0
+
+    result = CallResult(job.seq, job.n_items, job.out_path, elapsed=elapsed, n_parsed=state["accepted"],
+                        finish_reason=finish_reason_of(last), attempts=attempts, **usage_counts(last))
+    print(f"[Streamed] {job.out_path}  (+{state['accepted']}/{job.n_items} rows, "
+          f"{writer.count}/{writer.target}, {elapsed:.1f}s{result.input_note})")
+    return result
+
+
+async def run_stream_to_csv(
+    client,
+    writer: ClassCsvWriter,
+    make_job: Callable[[int], CallJob],
+    model_name: str,
+    config,
+    items_per_call: int,
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    scheduler: Optional[GeminiScheduler] = None,
+    on_result: Optional[Callable[[CallResult], None]] = None,
+    max_empty_calls: int = 3,
+) -> List[CallResult]:
+    """
+    ยิง call แบบ streaming จน CSV ของ class มีครบ writer.target แถวพอดี
+    - แต่ละ worker จองจำนวนข้อความจากส่วนที่ยังขาด (ลบด้วยที่ call อื่นกำลังสร้างอยู่)
+    - ได้ไม่ครบ/ไม่ผ่าน validate → ส่วนที่ขาดกลับเข้าคิวเอง (คำนวณจาก writer.remaining)
+    - call ที่ fail หรือได้ 0 แถวติดกัน max_empty_calls ครั้ง → หยุดรับงานใหม่
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+    if scheduler is not None:
+        scheduler.bind_items_per_call(items_per_call)
+    state = {"claimed": 0, "stop": False, "empty": 0}
+    results: List[CallResult] = []
+
+    async def worker():
+        while not state["stop"]:
+            free = writer.remaining - state["claimed"]
+            if free <= 0:
+                break
+            per_call = scheduler.items_per_call if scheduler is not None else items_per_call
+            n = min(per_call, free)
+            state["claimed"] += n
+            res = await stream_call(client, make_job(n), model_name, config, timeout,
+                                    semaphore, scheduler, writer)
+            state["claimed"] -= n
+            results.append(res)
+            if on_result is not None:
+                on_result(res)
+            if not res.ok:
+                state["stop"] = True
+                continue
+            state["empty"] = 0 if res.n_parsed else state["empty"] + 1
+            if state["empty"] >= max_empty_calls:
+                state["stop"] = True
+                continue
+            if scheduler is not None and not writer.full:
+                scheduler.record_result(res.truncated)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    if not writer.full:
+        print(f"[Stopped] {writer.path}: {writer.count}/{writer.target} แถว "
+              f"(rejected {writer.rejected}, duplicates {writer.duplicates})")
+    return sorted(results, key=lambda r: r.seq)
@@ -1,10 +1,24 @@
 import os
+import re
+import asyncio
+import argparse
+import itertools
 from pathlib import Path
 from math import ceil
-from typing import Optional
+from typing import Dict, List, Optional
 from google import genai
 from google.genai import types
-from disease_template import ALL_TEMPLATES
+from disease_template import ALL_TEMPLATES, minify_schema, split_schema
+from async_engine import (CallJob, call_and_save, input_token_report, run_job_sync, run_jobs, run_stream_to_csv,
+                          run_to_target, stream_call)
+from job_planner import ClassTask
+from manifest import RunManifest
+from prompt_cache import PromptCache
+from quality_gate import GatedSplit, disease_gate
+from scheduler import GeminiScheduler
+from stream_csv import ClassCsvWriter, validate_paragraph
+from telemetry import CallTelemetry
+from template_renderer import ONTOLOGIES
 
 # ========= แก้ไขได้ง่าย: ค่าพื้นฐาน =========
 MODEL_NAME = "gemini-2.5-flash"
@@ -37,6 +51,127 @@ Separate each paragraph with a blank line.
 """
 
 
+# ========= ฟังก์ชันช่วย: client / config / content ต่อรอบ =========
+def _make_client(api_key: Optional[str] = None, client=None):
+    """คืน client ที่ส่งมา (เช่น FakeClient ตอนทดสอบ) หรือสร้าง genai.Client จาก API key"""
+    if client is not None:
+        return client
+    if api_key is None:
+        api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Missing GEMINI_API_KEY. Set environment variable or pass api_key.")
+    return genai.Client(api_key=api_key)
+
+
+def _make_config(system_instruction_text: str, temperature: float, thinking_budget: int,
+                 cached_content: Optional[str] = None):
+    if cached_content is not None:
+        # system instruction อยู่ใน cache แล้ว (ใส่ซ้ำใน config ไม่ได้)
+        return types.GenerateContentConfig(
+            temperature=temperature,
+            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+            cached_content=cached_content,
+        )
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+        system_instruction=[types.Part.from_text(text=system_instruction_text)],
+    )
+
+
+SHARED_SCHEMA_HEADER = "Shared schema for all disease classes (placeholders, template_variations, rendering_rules):\n"
+
+
+def _prepare_prompt(client, system_instruction_text: str, template_variations_text: str, temperature: float,
+                    thinking_budget: int, prompt_cache: Optional[PromptCache] = None, compact_schema: bool = False):
+    """
+    คืน (config, template_variations_text ที่จะใส่ในแต่ละ call)
+    - prompt_cache: system instruction + ส่วนกลางของสคีมา (เหมือนกันทั้ง 9 โรค) อยู่ใน context cache
+      แต่ละ call ส่งเฉพาะส่วนเฉพาะโรค (name/description/ontology_binding)
+    - compact_schema: ส่งสคีมาแบบ minified (ใช้เองอัตโนมัติเมื่อใช้ cache)
+    """
+    if prompt_cache is not None:
+        shared, specific = split_schema(template_variations_text, compact=True)
+        name = prompt_cache.get(client, system_instruction_text, SHARED_SCHEMA_HEADER + shared)
+        if name is not None:
+            return _make_config(system_instruction_text, temperature, thinking_budget, cached_content=name), specific
+        compact_schema = True
+    if compact_schema:
+        template_variations_text = minify_schema(template_variations_text)
+    return _make_config(system_instruction_text, temperature, thinking_budget), template_variations_text
+
+
+def _make_contents(user_content_template: str, n_items: int, disease_name: str, template_variations_text: str):
+    user_content_text = user_content_template.format(
+        n_items=n_items,
+        disease_name=disease_name,
+        template_variations=template_variations_text,
+    )
+    return [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=user_content_text)],
+        )
+    ]
+
+
+def split_items(text: str):
+    """แยกผลลัพธ์เป็นรายการย่อหน้า (คั่นด้วยบรรทัดว่าง)"""
+    return [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+
+
+def gated_split(disease_name: str, quality_gate: bool = False):
+    """split_items ที่กรองด้วย quality gate ของโรค (quality_gate=False หรือชื่อที่ไม่มี ontology → split_items เดิม)"""
+    if not quality_gate or disease_name.lower() not in ONTOLOGIES:
+        return split_items
+    return GatedSplit(split_items, disease_gate(disease_name), "\n\n")
+
+
+def csv_validator(disease_name: str, quality_gate: bool = False):
+    """validate ของ ClassCsvWriter: quality gate ของโรค (ถ้าเปิด) หรือ validate_paragraph เดิม"""
+    if not quality_gate or disease_name.lower() not in ONTOLOGIES:
+        return validate_paragraph
+    return disease_gate(disease_name).validate
+
+
+def _items_per_round(items_per_call: int, total_items: int):
+    """แบ่ง total_items เป็นจำนวนต่อรอบ (รอบสุดท้ายอาจเหลือไม่เต็ม)"""
+    num_calls = ceil(total_items / items_per_call)
+    return [min(items_per_call, total_items - i * items_per_call) for i in range(num_calls)]
+
+
+def disease_dir_name(template_key: str) -> str:
+    """แปลงคีย์ของ ALL_TEMPLATES เป็นชื่อโฟลเดอร์/CSV เช่น 'chest_changes' -> 'Chest_Changes'"""
+    return "_".join(w.capitalize() for w in template_key.split("_"))
+
+
+def _seq_of(path: Path) -> Optional[int]:
+    return int(path.stem) if path.stem.isdigit() else None
+
+
+def _recorder(manifest: RunManifest, call_params: dict, telemetry: Optional[CallTelemetry]):
+    """บันทึกผลของ call ลง manifest (+ telemetry ถ้ามี)"""
+    def record(result) -> None:
+        manifest.record(result, **call_params)
+        if telemetry is not None:
+            telemetry.record(result, **call_params)
+    return record
+
+
+def _open_manifest(base_dir: Path, total_items: int, resume: bool, manifest_path=None):
+    """
+    เปิด manifest ของโฟลเดอร์โรค (รับไฟล์ .txt เดิมเข้าเป็น run 'legacy' ถ้ายังไม่เคยมี manifest)
+    คืน (manifest, จำนวนข้อความที่ยังขาด)
+    """
+    manifest = RunManifest(manifest_path or base_dir / "manifest.jsonl", split_items=split_items)
+    manifest.adopt_legacy(base_dir.glob("*.txt"), _seq_of)
+    manifest.begin(resume=resume)
+    done = manifest.items_done()
+    if done:
+        print(f"[Resume] run {manifest.run_id}: มีแล้ว {done}/{total_items} ข้อความ")
+    return manifest, max(0, total_items - done)
+
+
 # ========= ฟังก์ชันหลัก =========
 def generate_batch_outputs(
     system_instruction_text: str,
@@ -50,119 +185,471 @@ def generate_batch_outputs(
     thinking_budget: int = 0,
     model_name: str = MODEL_NAME,
     api_key: Optional[str] = None,
+    concurrency: int = 1,
+    timeout: Optional[float] = None,
+    client=None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    manifest_path: Optional[str] = None,
+    stream: bool = False,
+    csv_path: Optional[str] = None,
+    prompt_cache: Optional[PromptCache] = None,
+    compact_schema: bool = False,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
 ):
     """
     เรียก Gemini หลายรอบจนได้จำนวนข้อความครบตาม total_items
     บันทึกผลครั้งละ 1 ไฟล์ (หนึ่งไฟล์ต่อหนึ่งครั้งที่เรียก API)
 
-    โครงสร้างไฟล์: output/<disease_name>/<sequence>/<sequence>.txt
-    เช่น: output/Inflammatory_Pneumonia/001/001.txt
-    """
-    if api_key is None:
-        api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("Missing GEMINI_API_KEY. Set environment variable or pass api_key.")
+    โครงสร้างไฟล์: <out_root>/<disease_name>/<sequence>.txt + manifest.jsonl
+    เช่น: disease_output/Inflammatory_Pneumonia/001.txt
 
-    client = genai.Client(api_key=api_key)
+    ทุก call ถูกบันทึกลง manifest.jsonl (พารามิเตอร์, จำนวนข้อความที่ได้จริง, token usage, ไฟล์)
+    resume=True → ต่อ run ล่าสุด ยิงเฉพาะจำนวนที่ยังขาดจาก total_items
 
-    # เตรียม system_instruction
-    system_instruction_parts = [types.Part.from_text(text=system_instruction_text)]
+    prompt_cache → system instruction + ส่วนกลางของสคีมาไปอยู่ใน context cache (ส่งครั้งเดียว)
+    compact_schema=True → ส่งสคีมาแบบ minified
+    ท้ายรันพิมพ์ [Tokens] input/call ทั้งหมด → ส่วนที่ไม่ได้มาจาก cache
+    telemetry (telemetry.CallTelemetry) → บันทึก token / เวลา / finish reason ของทุก call เพิ่มจาก manifest
+    quality_gate=True → ทิ้งย่อหน้าที่ไม่ผ่าน quality_gate.disease_gate (ประโยคปฏิเสธ / ไม่มีคำจาก ontology ฯลฯ)
+    ก่อนเขียน แล้วเติมส่วนที่ขาด (ค่าเริ่มต้นปิด: ข้อมูลเดิมส่วนใหญ่ไม่ผ่านเกณฑ์ ontology)
 
-    # นับจำนวนรอบ
-    num_calls = ceil(total_items / items_per_call)
+    stream=True → ใช้ generate_content_stream แยกย่อหน้าระหว่างรับ แล้ว append ลง
+    <out_root>/csv/<disease_name>.csv ทันที (ไม่มีไฟล์ .txt) จนมีครบ total_items แถวพอดี
+
+    concurrency > 1 → รันแบบ async ผ่าน agenerate_batch_outputs (ยิงพร้อมกันไม่เกิน concurrency call)
+    scheduler       → คุม RPM/TPM + retry + ลด items_per_call อัตโนมัติ (รันผ่าน async เช่นกัน)
+    ถ้าอยู่ใน event loop อยู่แล้ว (เช่น Jupyter) ให้ `await agenerate_batch_outputs(...)` แทน
+    """
+    if concurrency > 1 or scheduler is not None or stream:
+        return asyncio.run(agenerate_batch_outputs(
+            system_instruction_text=system_instruction_text,
+            user_content_template=user_content_template,
+            template_variations_text=template_variations_text,
+            items_per_call=items_per_call,
+            total_items=total_items,
+            disease_name=disease_name,
+            out_root=out_root,
+            temperature=temperature,
+            thinking_budget=thinking_budget,
+            model_name=model_name,
+            api_key=api_key,
+            concurrency=concurrency,
+            timeout=timeout,
+            client=client,
+            scheduler=scheduler,
+            resume=resume,
+            manifest_path=manifest_path,
+            stream=stream,
+            csv_path=csv_path,
+            prompt_cache=prompt_cache,
+            compact_schema=compact_schema,
+            telemetry=telemetry,
+            quality_gate=quality_gate,
+        ))
+
+    client = _make_client(api_key, client)
+
+    # เตรียม config (system_instruction + temperature + thinking) ใช้ร่วมทุกรอบ
+    cfg, template_variations_text = _prepare_prompt(client, system_instruction_text, template_variations_text,
+                                                    temperature, thinking_budget, prompt_cache, compact_schema)
 
     # โฟลเดอร์หลักของโรค
     base_dir = Path(out_root) / disease_name
     base_dir.mkdir(parents=True, exist_ok=True)
 
-    for i in range(1, num_calls + 1):
-        # คำนวณจำนวนที่ต้องการในรอบนี้ (รอบสุดท้ายอาจเหลือไม่เต็ม)
-        remaining = total_items - (i - 1) * items_per_call
-        n_this_call = min(items_per_call, remaining)
+    # เปิด manifest แล้วคำนวณส่วนที่ยังขาด (แทนการไล่ exists() ทีละไฟล์)
+    manifest, remaining = _open_manifest(base_dir, total_items, resume, manifest_path)
+    seqs = itertools.count(manifest.next_seq())
+    call_params = dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                       disease_name=disease_name)
 
-        # ทำ content สำหรับรอบนี้
-        user_content_text = user_content_template.format(
+    splitter = gated_split(disease_name, quality_gate)
+    record = _recorder(manifest, call_params, telemetry)
+    results = []
+    for n_this_call in _items_per_round(items_per_call, remaining):
+        seq = next(seqs)
+        job = CallJob(
+            seq=seq,
             n_items=n_this_call,
+            contents=_make_contents(user_content_template, n_this_call, disease_name, template_variations_text),
+            out_path=base_dir / f"{seq:03d}.txt",
+        )
+        # เรียกแบบ non-stream (ไม่มี chunk) แล้วบันทึกไฟล์ 1 ครั้ง ต่อ 1 call
+        result = run_job_sync(client, job, model_name, cfg, splitter)
+        record(result)
+        results.append(result)
+    if results:
+        print(f"{input_token_report(results)}  {disease_name}")
+    return results
+
+
+async def agenerate_batch_outputs(
+    system_instruction_text: str,
+    user_content_template: str,
+    template_variations_text: str,
+    items_per_call: int,
+    total_items: int,
+    disease_name: str,
+    out_root: str = "disease_output",
+    temperature: float = 0.7,
+    thinking_budget: int = 0,
+    model_name: str = MODEL_NAME,
+    api_key: Optional[str] = None,
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    client=None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    manifest_path: Optional[str] = None,
+    stream: bool = False,
+    csv_path: Optional[str] = None,
+    prompt_cache: Optional[PromptCache] = None,
+    compact_schema: bool = False,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
+):
+    """
+    เวอร์ชัน async ของ generate_batch_outputs: ยิงทุกรอบพร้อมกัน (ไม่เกิน concurrency call)
+    - จองเลขไฟล์ <seq>.txt จาก manifest ไว้ก่อนยิง → ไฟล์เรียงลำดับเสมอแม้ call จะเสร็จไม่พร้อมกัน
+    - timeout: วินาทีต่อ call; call ที่ล้ม/timeout จะถูกรายงานใน error ของผลลัพธ์
+    - semaphore: แชร์ระหว่างหลายโรคเพื่อคุมจำนวน call รวม (ดู agenerate_all_templates)
+    - scheduler: คุม RPM/TPM, retry 429/5xx และลด items_per_call เมื่อ response ถูกตัด
+      (ยิงเพิ่มจนได้ครบ total_items แทนการแบ่งรอบตายตัว)
+    - resume: ต่อ run ล่าสุดใน manifest ยิงเฉพาะส่วนที่ยังขาด
+    - stream: เขียนลง CSV ของ class โดยตรง (ดู _astream_to_csv)
+    คืนค่า list[CallResult] เรียงตาม seq
+    """
+    client = _make_client(api_key, client)
+    cfg, template_variations_text = _prepare_prompt(client, system_instruction_text, template_variations_text,
+                                                    temperature, thinking_budget, prompt_cache, compact_schema)
+
+    if stream:
+        return await _astream_to_csv(
+            client, cfg,
+            user_content_template=user_content_template,
+            template_variations_text=template_variations_text,
+            items_per_call=items_per_call,
+            total_items=total_items,
             disease_name=disease_name,
-            template_variations=template_variations_text,
+            csv_file=Path(csv_path) if csv_path else Path(out_root) / "csv" / f"{disease_name}.csv",
+            call_params=dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                             disease_name=disease_name, stream=True),
+            model_name=model_name,
+            concurrency=concurrency,
+            timeout=timeout,
+            semaphore=semaphore,
+            scheduler=scheduler,
+            resume=resume,
+            manifest_path=manifest_path,
+            telemetry=telemetry,
+            quality_gate=quality_gate,
         )
 
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=user_content_text)],
+    base_dir = Path(out_root) / disease_name
+    base_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest, remaining = _open_manifest(base_dir, total_items, resume, manifest_path)
+    if remaining == 0:
+        print(f"[Done] {disease_name}: ครบ {total_items} ข้อความแล้ว ไม่ต้องยิงเพิ่ม")
+        return []
+    seqs = itertools.count(manifest.next_seq())
+    call_params = dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                       disease_name=disease_name)
+    splitter = gated_split(disease_name, quality_gate)
+
+    def make_job(n: int) -> CallJob:
+        seq = next(seqs)
+        return CallJob(
+            seq=seq,
+            n_items=n,
+            contents=_make_contents(user_content_template, n, disease_name, template_variations_text),
+            out_path=base_dir / f"{seq:03d}.txt",
+        )
+
+    on_result = _recorder(manifest, call_params, telemetry)
+
+    if scheduler is not None:
+        # โหมด scheduler: ขนาดแต่ละ call ปรับตาม scheduler.items_per_call และเติมส่วนที่ขาดจนครบ
+        scheduler.bind_items_per_call(items_per_call)
+        results = await run_to_target(
+            client, remaining, make_job,
+            model_name=model_name,
+            config=cfg,
+            scheduler=scheduler,
+            split_items=splitter,
+            concurrency=concurrency,
+            timeout=timeout,
+            semaphore=semaphore,
+            on_result=on_result,
+        )
+    else:
+        jobs = [make_job(n) for n in _items_per_round(items_per_call, remaining)]
+        results = await run_jobs(
+            client, jobs,
+            model_name=model_name,
+            config=cfg,
+            concurrency=concurrency,
+            timeout=timeout,
+            semaphore=semaphore,
+            split_items=splitter,
+            on_result=on_result,
+        )
+    print(f"{input_token_report(results)}  {disease_name}")
+    return results
+
+
+async def _astream_to_csv(client, cfg, user_content_template: str, template_variations_text: str,
+                          items_per_call: int, total_items: int, disease_name: str, csv_file: Path,
+                          call_params: dict, model_name: str, concurrency: int, timeout: Optional[float],
+                          semaphore: Optional[asyncio.Semaphore], scheduler: Optional[GeminiScheduler],
+                          resume: bool, manifest_path: Optional[str], telemetry: Optional[CallTelemetry] = None,
+                          quality_gate: bool = False):
+    """
+    โหมด stream: CSV ของ class คือปลายทางเดียว จำนวนแถวที่มีอยู่แล้วนับรวมใน total_items เสมอ
+    (รันซ้ำ = เติมเฉพาะที่ขาด) ส่วน manifest (<Class>.manifest.jsonl ข้าง CSV) เก็บสถิติต่อ call
+    """
+    with ClassCsvWriter(csv_file, total_items, validate=csv_validator(disease_name, quality_gate)) as writer:
+        if writer.full:
+            print(f"[Done] {csv_file}: ครบ {total_items} แถวแล้ว ไม่ต้องยิงเพิ่ม")
+            return []
+        manifest = RunManifest(manifest_path or csv_file.with_suffix(".manifest.jsonl"))
+        manifest.begin(resume=resume)
+        seqs = itertools.count(manifest.next_seq())
+
+        def make_job(n: int) -> CallJob:
+            return CallJob(
+                seq=next(seqs),
+                n_items=n,
+                contents=_make_contents(user_content_template, n, disease_name, template_variations_text),
+                out_path=csv_file,
             )
-        ]
 
-        cfg = types.GenerateContentConfig(
+        results = await run_stream_to_csv(
+            client, writer, make_job,
+            model_name=model_name,
+            config=cfg,
+            items_per_call=items_per_call,
+            concurrency=concurrency,
+            timeout=timeout,
+            semaphore=semaphore,
+            scheduler=scheduler,
+            on_result=_recorder(manifest, call_params, telemetry),
+        )
+    print(f"{input_token_report(results)}  {disease_name}")
+    return results
+
+
+async def agenerate_all_templates(
+    items_per_call: int,
+    total_items: int,
+    template_keys=None,
+    system_instruction_text: str = SYSTEM_INSTRUCTION_TEXT,
+    user_content_template: str = USER_CONTENT_TEMPLATE,
+    out_root: str = "disease_output",
+    temperature: float = 0.7,
+    thinking_budget: int = 0,
+    model_name: str = MODEL_NAME,
+    api_key: Optional[str] = None,
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    client=None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    stream: bool = False,
+    prompt_cache: Optional[PromptCache] = None,
+    compact_schema: bool = False,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
+):
+    """
+    สร้างข้อความของหลายโรค (ค่าเริ่มต้น: ทุกคีย์ใน ALL_TEMPLATES) พร้อมกันใน event loop เดียว
+    ทุกโรคแชร์ semaphore ตัวเดียว → จำนวน call ค้างรวมไม่เกิน concurrency
+    และแชร์ scheduler ตัวเดียว (ถ้ามี) → โควตา RPM/TPM รวมทุกโรค
+    prompt_cache ตัวเดียว → ส่วนกลางของสคีมาถูก cache ครั้งเดียวใช้ได้ทั้ง 9 โรค
+    คืนค่า dict: ชื่อโฟลเดอร์โรค -> list[CallResult]
+    """
+    client = _make_client(api_key, client)
+    keys = list(template_keys or ALL_TEMPLATES.keys())
+    names = [disease_dir_name(k) for k in keys]
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = await asyncio.gather(*(
+        agenerate_batch_outputs(
+            system_instruction_text=system_instruction_text,
+            user_content_template=user_content_template,
+            template_variations_text=ALL_TEMPLATES[k],
+            items_per_call=items_per_call,
+            total_items=total_items,
+            disease_name=name,
+            out_root=out_root,
             temperature=temperature,
-            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
-            system_instruction=system_instruction_parts,
+            thinking_budget=thinking_budget,
+            model_name=model_name,
+            timeout=timeout,
+            client=client,
+            semaphore=semaphore,
+            scheduler=scheduler,
+            resume=resume,
+            stream=stream,
+            prompt_cache=prompt_cache,
+            compact_schema=compact_schema,
+            telemetry=telemetry,
+            quality_gate=quality_gate,
         )
+        for k, name in zip(keys, names)
+    ))
+    return dict(zip(names, results))
 
-        # เรียกแบบ non-stream (ไม่มี chunk)
-        resp = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            config=cfg,
+
+def _class_task(client, key: str, target: int, items_per_call: int, out_root: str,
+                system_instruction_text: str, user_content_template: str, temperature: float,
+                thinking_budget: int, model_name: str, timeout: Optional[float],
+                semaphore: asyncio.Semaphore, scheduler: Optional[GeminiScheduler], resume: bool,
+                stream: bool, prompt_cache: Optional[PromptCache], compact_schema: bool,
+                telemetry: Optional[CallTelemetry] = None, quality_gate: bool = False) -> ClassTask:
+    name = disease_dir_name(key)
+    cfg, template_variations_text = _prepare_prompt(client, system_instruction_text, ALL_TEMPLATES[key],
+                                                    temperature, thinking_budget, prompt_cache, compact_schema)
+    call_params = dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                       disease_name=name, stream=stream)
+
+    if stream:
+        csv_file = Path(out_root) / "csv" / f"{name}.csv"
+        writer = ClassCsvWriter(csv_file, target, validate=csv_validator(name, quality_gate))
+        manifest = RunManifest(csv_file.with_suffix(".manifest.jsonl"))
+        manifest.begin(resume=resume)
+        done_before, close = writer.count, writer.close
+
+        def out_path(seq: int) -> Path:
+            return csv_file
+
+        async def call(job: CallJob):
+            result = await stream_call(client, job, model_name, cfg, timeout, semaphore, scheduler, writer)
+            record(result)
+            return result
+    else:
+        base_dir = Path(out_root) / name
+        base_dir.mkdir(parents=True, exist_ok=True)
+        manifest, remaining = _open_manifest(base_dir, target, resume)
+        done_before, close = target - remaining, None
+        splitter = gated_split(name, quality_gate)
+
+        def out_path(seq: int) -> Path:
+            return base_dir / f"{seq:03d}.txt"
+
+        async def call(job: CallJob):
+            result = await call_and_save(client, job, model_name, cfg, timeout, semaphore, scheduler, splitter)
+            record(result)
+            return result
+
+    seqs = itertools.count(manifest.next_seq())
+    record = _recorder(manifest, call_params, telemetry)
+
+    def make_job(n: int) -> CallJob:
+        seq = next(seqs)
+        return CallJob(
+            seq=seq,
+            n_items=n,
+            contents=_make_contents(user_content_template, n, name, template_variations_text),
+            out_path=out_path(seq),
         )
 
-        text_out = getattr(resp, "text", None)
-        if not text_out:
-            # บาง SDK version อาจอยู่ใน resp.candidates[0].content.parts
-            # สำรอง: ดึงแบบ parts รวมเป็นข้อความ
-            text_out = _extract_text_fallback(resp) or ""
-
-        # สร้างโฟลเดอร์ย่อยตามลำดับ (เช่น 001, 002, ...)
-        seq = f"{i:03d}"
-        seq_dir = base_dir
-
-        # บันทึกไฟล์ 1 ครั้ง ต่อ 1 call
-        out_path = seq_dir / f"{seq}.txt"
-        
-        # ถ้ามีไฟล์อยู่แล้ว -> เลื่อนไป seq ถัดไปจนกว่าจะเจอไฟล์ที่ยังไม่มี
-        while out_path.exists():
-            i += 1
-            seq = f"{i:03d}"
-            out_path = seq_dir / f"{seq}.txt"
-        
-        out_path.write_text(text_out.strip(), encoding="utf-8")
-
-        print(f"[Saved] {out_path}  (items ~ {n_this_call})")
-
-
-def _extract_text_fallback(resp) -> str:
-    """สำรอง: รวมข้อความจาก candidates/parts กรณี resp.text ไม่มี"""
-    try:
-        if hasattr(resp, "candidates") and resp.candidates:
-            parts = []
-            for p in getattr(resp.candidates[0].content, "parts", []) or []:
-                if hasattr(p, "text") and p.text:
-                    parts.append(p.text)
-            return "\n".join(parts).strip()
-    except Exception:
-        pass
-    return ""
+    return ClassTask(name=name, target=target, done_before=done_before, items_per_call=items_per_call,
+                     make_job=make_job, call=call, close=close)
+
+
+def build_class_tasks(
+    client,
+    targets: Dict[str, int],
+    items_per_call: int,
+    out_root: str = "disease_output",
+    system_instruction_text: str = SYSTEM_INSTRUCTION_TEXT,
+    user_content_template: str = USER_CONTENT_TEMPLATE,
+    temperature: float = 0.7,
+    thinking_budget: int = 0,
+    model_name: str = MODEL_NAME,
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    stream: bool = False,
+    prompt_cache: Optional[PromptCache] = None,
+    compact_schema: bool = False,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
+) -> List[ClassTask]:
+    """
+    แปลง {template_key: target} เป็น ClassTask สำหรับ job_planner.run_planned
+    ทุก class แชร์ client / semaphore / scheduler / prompt_cache ตัวเดียวกัน
+    โหมด .txt + manifest หรือ stream ลง CSV เหมือน agenerate_batch_outputs
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    return [
+        _class_task(client, key, target, items_per_call, out_root, system_instruction_text,
+                    user_content_template, temperature, thinking_budget, model_name, timeout,
+                    semaphore, scheduler, resume, stream, prompt_cache, compact_schema, telemetry, quality_gate)
+        for key, target in targets.items()
+    ]
 
 
 # ========= ตัวอย่างการใช้งาน =========
 if __name__ == "__main__":
+    # ตัวอย่าง:
+    #   python call_api_for_disease.py                      → เริ่ม run ใหม่ของ chest_changes
+    #   python call_api_for_disease.py --resume             → ต่อ run ล่าสุด ยิงเฉพาะส่วนที่ยังขาด
+    #   python call_api_for_disease.py --template normal --total-items 500
+    #   python call_api_for_disease.py --stream             → เขียนตรงลง disease_output/csv/Chest_Changes.csv
+    parser = argparse.ArgumentParser(description="Generate radiology paragraphs with Gemini")
+    parser.add_argument("--template", default="chest_changes", choices=sorted(ALL_TEMPLATES))
+    parser.add_argument("--items-per-call", type=int, default=50)
+    parser.add_argument("--total-items", type=int, default=1000)
+    parser.add_argument("--out-root", default="disease_output")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--resume", action="store_true", help="ต่อ run ล่าสุดใน manifest.jsonl")
+    parser.add_argument("--stream", action="store_true", help="stream ย่อหน้าลง CSV ของ class โดยตรง (ไม่มี .txt)")
+    parser.add_argument("--cache-prefix", action="store_true", help="เก็บ system instruction + สคีมาส่วนกลางใน context cache")
+    parser.add_argument("--compact-schema", action="store_true", help="ส่งสคีมาแบบ minified")
+    parser.add_argument("--telemetry", default=None, metavar="DIR", help="เขียน calls.jsonl + gemini.prom ลงโฟลเดอร์นี้")
+    parser.add_argument("--quality-gate", action="store_true", help="ทิ้งย่อหน้าที่ไม่ผ่าน quality_gate ก่อนเขียน")
+    args = parser.parse_args()
+
+    prompt_cache = PromptCache(MODEL_NAME) if args.cache_prefix else None
+    telemetry = CallTelemetry(Path(args.telemetry) / "calls.jsonl", prom_path=Path(args.telemetry) / "gemini.prom") \
+        if args.telemetry else None
+    client = _make_client(os.environ['ENV_API_KEY'])  # หรือใส่สตริงคีย์ตรงนี้
 
-    template_variations_example = ALL_TEMPLATES["chest_changes"]
+    template_variations_example = ALL_TEMPLATES[args.template]
 
-    # กำหนดชื่อโรค/หมวดเพื่อใช้เป็นเส้นทางโฟลเดอร์
-    disease_name = "Chest_Changes"
+    # กำหนดชื่อโรค/หมวดเพื่อใช้เป็นเส้นทางโฟลเดอร์ (เช่น Chest_Changes)
+    disease_name = disease_dir_name(args.template)
 
     # เรียกผลิตรวม 1000 รายการ โดยให้โมเดลสร้างครั้งละ 50
     generate_batch_outputs(
         system_instruction_text=SYSTEM_INSTRUCTION_TEXT,
         user_content_template=USER_CONTENT_TEMPLATE,
         template_variations_text=template_variations_example,
-        items_per_call=50,      # สร้างต่อ call
-        total_items=1000,        # จำนวนทั้งหมดที่ต้องการ
+        items_per_call=args.items_per_call,     # สร้างต่อ call
+        total_items=args.total_items,           # จำนวนทั้งหมดที่ต้องการ
         disease_name=disease_name,
+        out_root=args.out_root,
         temperature=0.7,
         thinking_budget=0,
         model_name=MODEL_NAME,
-        api_key=os.environ['ENV_API_KEY'],  # หรือใส่สตริงคีย์ตรงนี้
+        client=client,
+        concurrency=args.concurrency,       # ยิงพร้อมกันสูงสุดกี่ call (1 = แบบเดิมทีละ call)
+        timeout=180,            # วินาทีต่อ call
+        scheduler=GeminiScheduler(rpm=10, tpm=250_000),  # โควตาตาม tier ของคีย์
+        resume=args.resume,
+        stream=args.stream,
+        prompt_cache=prompt_cache,
+        compact_schema=args.compact_schema,
+        telemetry=telemetry,
+        quality_gate=args.quality_gate,
     )
+    if telemetry is not None:
+        telemetry.close()
+        telemetry.report()
+    if prompt_cache is not None:
+        prompt_cache.clear(client)
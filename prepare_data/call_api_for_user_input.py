@@ -1,10 +1,18 @@
 import os
+import asyncio
+import argparse
+import itertools
 from pathlib import Path
 from math import ceil
 from typing import Optional
 from google import genai
 from google.genai import types
 from disease_template import ALL_TEMPLATES
+from async_engine import CallJob, run_job_sync, run_jobs, run_to_target
+from manifest import RunManifest
+from quality_gate import PLACEHOLDER, GatedSplit, user_input_gate
+from scheduler import GeminiScheduler
+from telemetry import CallTelemetry
 
 # ========= แก้ไขได้ง่าย: ค่าพื้นฐาน =========
 MODEL_NAME = "gemini-2.5-flash"
@@ -35,6 +43,95 @@ Requirements:
 """
 
 
+# ========= ฟังก์ชันช่วย: client / config / content ต่อรอบ =========
+def _make_client(api_key: Optional[str] = None, client=None):
+    """คืน client ที่ส่งมา (เช่น FakeClient ตอนทดสอบ) หรือสร้าง genai.Client จาก API key"""
+    if client is not None:
+        return client
+    if api_key is None:
+        api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Missing GEMINI_API_KEY. Set environment variable or pass api_key.")
+    return genai.Client(api_key=api_key)
+
+
+def _make_config(system_instruction_text: str, temperature: float, thinking_budget: int,
+                 sentences_long: int, clinical_text: str):
+    system_instruction_format = system_instruction_text.format(
+        clinical_text=clinical_text,
+        sentences_long=sentences_long,
+    )
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+        system_instruction=[types.Part.from_text(text=system_instruction_format)],
+    )
+
+
+def _make_contents(user_content_template: str, n_items: int, sentences_long: int, clinical_text: str):
+    user_content_text = user_content_template.format(
+        n_items=n_items,
+        clinical_text=clinical_text,
+        sentences_long=sentences_long,
+    )
+    return [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=user_content_text)],
+        )
+    ]
+
+
+def split_items(text: str):
+    """แยกผลลัพธ์เป็นรายการข้อความ (หนึ่งบรรทัดต่อหนึ่งข้อความ)"""
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def gated_split(sentences_long: int, clinical_text: str = PLACEHOLDER, quality_gate: bool = False):
+    """
+    split_items ที่กรองด้วย quality gate (จำนวนประโยค = sentences_long, ต้องมี {clinical_text} ถ้ายังไม่ถูกแทนค่า)
+    quality_gate=False → split_items เดิม
+    """
+    if not quality_gate:
+        return split_items
+    return GatedSplit(split_items, user_input_gate(sentences_long, clinical_text == PLACEHOLDER), "\n")
+
+
+def _items_per_round(items_per_call: int, total_items: int):
+    """แบ่ง total_items เป็นจำนวนต่อรอบ (รอบสุดท้ายอาจเหลือไม่เต็ม)"""
+    num_calls = ceil(total_items / items_per_call)
+    return [min(items_per_call, total_items - i * items_per_call) for i in range(num_calls)]
+
+
+def _recorder(manifest: RunManifest, call_params: dict, telemetry: Optional[CallTelemetry]):
+    """บันทึกผลของ call ลง manifest (+ telemetry ถ้ามี)"""
+    def record(result) -> None:
+        manifest.record(result, **call_params)
+        if telemetry is not None:
+            telemetry.record(result, **call_params)
+    return record
+
+
+def _open_manifest(base_dir: Path, sentences_long: int, total_items: int, resume: bool, manifest_path=None):
+    """
+    เปิด manifest ของ sentences_long นี้ (รับไฟล์ sl<n>_*.txt เดิมเข้าเป็น run 'legacy' ถ้ายังไม่เคยมี manifest)
+    คืน (manifest, จำนวนข้อความที่ยังขาด)
+    """
+    prefix = f"sl{sentences_long}_"
+
+    def seq_of(path: Path) -> Optional[int]:
+        tail = path.stem[len(prefix):]
+        return int(tail) if path.stem.startswith(prefix) and tail.isdigit() else None
+
+    manifest = RunManifest(manifest_path or base_dir / f"manifest_sl{sentences_long}.jsonl", split_items=split_items)
+    manifest.adopt_legacy(base_dir.glob(f"{prefix}*.txt"), seq_of)
+    manifest.begin(resume=resume)
+    done = manifest.items_done()
+    if done:
+        print(f"[Resume] run {manifest.run_id}: มีแล้ว {done}/{total_items} ข้อความ")
+    return manifest, max(0, total_items - done)
+
+
 # ========= ฟังก์ชันหลัก =========
 def generate_batch_outputs(
     system_instruction_text: str,
@@ -48,114 +145,206 @@ def generate_batch_outputs(
     model_name: str = MODEL_NAME,
     api_key: Optional[str] = None,
     clinical_text: str = "{clinical_text}",
+    concurrency: int = 1,
+    timeout: Optional[float] = None,
+    client=None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    manifest_path: Optional[str] = None,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
 ):
     """
     เรียก Gemini หลายรอบจนได้จำนวนข้อความครบตาม total_items
     บันทึกผลครั้งละ 1 ไฟล์ (หนึ่งไฟล์ต่อหนึ่งครั้งที่เรียก API)
 
-    โครงสร้างไฟล์: output/<disease_name>/<sequence>/<sequence>.txt
-    เช่น: output/Inflammatory_Pneumonia/001/001.txt
-    """
-    if api_key is None:
-        api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("Missing GEMINI_API_KEY. Set environment variable or pass api_key.")
+    โครงสร้างไฟล์: <out_root>/sl<sentences_long>_<sequence>.txt + manifest_sl<sentences_long>.jsonl
+    เช่น: userinput_output/sl5_001.txt
 
-    client = genai.Client(api_key=api_key)
+    ทุก call ถูกบันทึกลง manifest (พารามิเตอร์, จำนวนข้อความที่ได้จริง, token usage, ไฟล์)
+    resume=True → ต่อ run ล่าสุด ยิงเฉพาะจำนวนที่ยังขาดจาก total_items
+    telemetry (telemetry.CallTelemetry) → บันทึก token / เวลา / finish reason ของทุก call เพิ่มจาก manifest
+    quality_gate=True → ทิ้งข้อความที่ไม่ผ่าน quality_gate.user_input_gate ก่อนเขียน แล้วเติมส่วนที่ขาด (ค่าเริ่มต้นปิด)
 
-    # เตรียม system_instruction
-    system_instruction_format = system_instruction_text.format(
-        clinical_text=clinical_text,
-        sentences_long=sentences_long,
-    )
-    system_instruction_parts = [types.Part.from_text(text=system_instruction_format)]
+    concurrency > 1 → รันแบบ async ผ่าน agenerate_batch_outputs (ยิงพร้อมกันไม่เกิน concurrency call)
+    scheduler       → คุม RPM/TPM + retry + ลด items_per_call อัตโนมัติ (รันผ่าน async เช่นกัน)
+    ถ้าอยู่ใน event loop อยู่แล้ว (เช่น Jupyter) ให้ `await agenerate_batch_outputs(...)` แทน
+    """
+    if concurrency > 1 or scheduler is not None:
+        return asyncio.run(agenerate_batch_outputs(
+            system_instruction_text=system_instruction_text,
+            user_content_template=user_content_template,
+            items_per_call=items_per_call,
+            total_items=total_items,
+            sentences_long=sentences_long,
+            out_root=out_root,
+            temperature=temperature,
+            thinking_budget=thinking_budget,
+            model_name=model_name,
+            api_key=api_key,
+            clinical_text=clinical_text,
+            concurrency=concurrency,
+            timeout=timeout,
+            client=client,
+            scheduler=scheduler,
+            resume=resume,
+            manifest_path=manifest_path,
+            telemetry=telemetry,
+            quality_gate=quality_gate,
+        ))
 
-    # นับจำนวนรอบ
-    num_calls = ceil(total_items / items_per_call)
+    client = _make_client(api_key, client)
+
+    # เตรียม config (system_instruction ที่เติม clinical_text/sentences_long แล้ว)
+    cfg = _make_config(system_instruction_text, temperature, thinking_budget, sentences_long, clinical_text)
 
     # โฟลเดอร์หลัก
     base_dir = Path(out_root)
     base_dir.mkdir(parents=True, exist_ok=True)
 
-    for i in range(1, num_calls + 1):
-        # คำนวณจำนวนที่ต้องการในรอบนี้ (รอบสุดท้ายอาจเหลือไม่เต็ม)
-        remaining = total_items - (i - 1) * items_per_call
-        n_this_call = min(items_per_call, remaining)
+    # เปิด manifest แล้วคำนวณส่วนที่ยังขาด (แทนการไล่ exists() ทีละไฟล์)
+    manifest, remaining = _open_manifest(base_dir, sentences_long, total_items, resume, manifest_path)
+    seqs = itertools.count(manifest.next_seq())
+    call_params = dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                       sentences_long=sentences_long)
 
-        # ทำ content สำหรับรอบนี้
-        user_content_text = user_content_template.format(
+    splitter = gated_split(sentences_long, clinical_text, quality_gate)
+    on_result = _recorder(manifest, call_params, telemetry)
+    results = []
+    for n_this_call in _items_per_round(items_per_call, remaining):
+        seq = next(seqs)
+        job = CallJob(
+            seq=seq,
             n_items=n_this_call,
-            clinical_text=clinical_text,
-            sentences_long=sentences_long,
-        )
-
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=user_content_text)],
-            )
-        ]
-
-        cfg = types.GenerateContentConfig(
-            temperature=temperature,
-            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
-            system_instruction=system_instruction_parts,
+            contents=_make_contents(user_content_template, n_this_call, sentences_long, clinical_text),
+            out_path=base_dir / f"sl{sentences_long}_{seq:03d}.txt",
         )
+        # เรียกแบบ non-stream (ไม่มี chunk) แล้วบันทึกไฟล์ 1 ครั้ง ต่อ 1 call
+        result = run_job_sync(client, job, model_name, cfg, splitter)
+        on_result(result)
+        results.append(result)
+    return results
 
-        # เรียกแบบ non-stream (ไม่มี chunk)
-        resp = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            config=cfg,
-        )
 
-        text_out = getattr(resp, "text", None)
-        if not text_out:
-            # บาง SDK version อาจอยู่ใน resp.candidates[0].content.parts
-            # สำรอง: ดึงแบบ parts รวมเป็นข้อความ
-            text_out = _extract_text_fallback(resp) or ""
+async def agenerate_batch_outputs(
+    system_instruction_text: str,
+    user_content_template: str,
+    items_per_call: int,
+    total_items: int,
+    sentences_long: int,
+    out_root: str = "output",
+    temperature: float = 1,
+    thinking_budget: int = 0,
+    model_name: str = MODEL_NAME,
+    api_key: Optional[str] = None,
+    clinical_text: str = "{clinical_text}",
+    concurrency: int = 8,
+    timeout: Optional[float] = None,
+    client=None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    scheduler: Optional[GeminiScheduler] = None,
+    resume: bool = False,
+    manifest_path: Optional[str] = None,
+    telemetry: Optional[CallTelemetry] = None,
+    quality_gate: bool = False,
+):
+    """
+    เวอร์ชัน async ของ generate_batch_outputs: ยิงทุกรอบพร้อมกัน (ไม่เกิน concurrency call)
+    ไฟล์ sl<sentences_long>_<seq>.txt ถูกจองเลขจาก manifest ไว้ก่อนยิง จึงเรียงลำดับเสมอ
+    scheduler: คุม RPM/TPM, retry 429/5xx และลด items_per_call เมื่อ response ถูกตัด
+    resume: ต่อ run ล่าสุดใน manifest ยิงเฉพาะส่วนที่ยังขาด
+    คืนค่า list[CallResult] เรียงตาม seq
+    """
+    client = _make_client(api_key, client)
+    cfg = _make_config(system_instruction_text, temperature, thinking_budget, sentences_long, clinical_text)
 
-        # บันทึกไฟล์ 1 ครั้ง ต่อ 1 call
-        seq = f"{i:03d}"
-        out_path = base_dir / f"sl{sentences_long}_{seq}.txt"
+    base_dir = Path(out_root)
+    base_dir.mkdir(parents=True, exist_ok=True)
 
-        # ถ้ามีไฟล์อยู่แล้ว -> เลื่อนไป seq ถัดไปจนกว่าจะเจอไฟล์ที่ยังไม่มี
-        while out_path.exists():
-            i += 1
-            seq = f"{i:03d}"
-            out_path = base_dir / f"sl{sentences_long}_{seq}.txt"
+    manifest, remaining = _open_manifest(base_dir, sentences_long, total_items, resume, manifest_path)
+    if remaining == 0:
+        print(f"[Done] sl{sentences_long}: ครบ {total_items} ข้อความแล้ว ไม่ต้องยิงเพิ่ม")
+        return []
+    seqs = itertools.count(manifest.next_seq())
+    call_params = dict(model=model_name, temperature=temperature, thinking_budget=thinking_budget,
+                       sentences_long=sentences_long)
+    splitter = gated_split(sentences_long, clinical_text, quality_gate)
 
-        out_path.write_text(text_out.strip(), encoding="utf-8")
+    def make_job(n: int) -> CallJob:
+        seq = next(seqs)
+        return CallJob(
+            seq=seq,
+            n_items=n,
+            contents=_make_contents(user_content_template, n, sentences_long, clinical_text),
+            out_path=base_dir / f"sl{sentences_long}_{seq:03d}.txt",
+        )
 
-        print(f"[Saved] {out_path}  (items ~ {n_this_call})")
+    on_result = _recorder(manifest, call_params, telemetry)
 
+    if scheduler is not None:
+        # โหมด scheduler: ขนาดแต่ละ call ปรับตาม scheduler.items_per_call และเติมส่วนที่ขาดจนครบ
+        scheduler.bind_items_per_call(items_per_call)
+        return await run_to_target(
+            client, remaining, make_job,
+            model_name=model_name,
+            config=cfg,
+            scheduler=scheduler,
+            split_items=splitter,
+            concurrency=concurrency,
+            timeout=timeout,
+            semaphore=semaphore,
+            on_result=on_result,
+        )
 
-def _extract_text_fallback(resp) -> str:
-    """สำรอง: รวมข้อความจาก candidates/parts กรณี resp.text ไม่มี"""
-    try:
-        if hasattr(resp, "candidates") and resp.candidates:
-            parts = []
-            for p in getattr(resp.candidates[0].content, "parts", []) or []:
-                if hasattr(p, "text") and p.text:
-                    parts.append(p.text)
-            return "\n".join(parts).strip()
-    except Exception:
-        pass
-    return ""
+    jobs = [make_job(n) for n in _items_per_round(items_per_call, remaining)]
+    return await run_jobs(
+        client, jobs,
+        model_name=model_name,
+        config=cfg,
+        concurrency=concurrency,
+        timeout=timeout,
+        semaphore=semaphore,
+        split_items=splitter,
+        on_result=on_result,
+    )
 
 
 # ========= ตัวอย่างการใช้งาน =========
 if __name__ == "__main__":
+    # ตัวอย่าง:
+    #   python call_api_for_user_input.py --sentences-long 5           → เริ่ม run ใหม่
+    #   python call_api_for_user_input.py --sentences-long 5 --resume  → ต่อ run ล่าสุด ยิงเฉพาะส่วนที่ยังขาด
+    parser = argparse.ArgumentParser(description="Generate user-input prompts with Gemini")
+    parser.add_argument("--sentences-long", type=int, default=5)
+    parser.add_argument("--items-per-call", type=int, default=100)
+    parser.add_argument("--total-items", type=int, default=500)
+    parser.add_argument("--out-root", default="userinput_output")
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--resume", action="store_true", help="ต่อ run ล่าสุดใน manifest_sl<n>.jsonl")
+    parser.add_argument("--telemetry", default=None, metavar="DIR", help="เขียน calls.jsonl + gemini.prom ลงโฟลเดอร์นี้")
+    parser.add_argument("--quality-gate", action="store_true", help="ทิ้งข้อความที่ไม่ผ่าน quality_gate ก่อนเขียน")
+    args = parser.parse_args()
+    telemetry = CallTelemetry(Path(args.telemetry) / "calls.jsonl", prom_path=Path(args.telemetry) / "gemini.prom") \
+        if args.telemetry else None
 
     generate_batch_outputs(
         system_instruction_text=SYSTEM_INSTRUCTION_TEXT,
         user_content_template=USER_CONTENT_TEMPLATE,
-        items_per_call=100,      # สร้างต่อ call
-        total_items=500,        # จำนวนทั้งหมดที่ต้องการ
-        sentences_long=5,
-        out_root="userinput_output",
+        items_per_call=args.items_per_call,     # สร้างต่อ call
+        total_items=args.total_items,           # จำนวนทั้งหมดที่ต้องการ
+        sentences_long=args.sentences_long,
+        out_root=args.out_root,
         temperature=1,
         thinking_budget=0,
         model_name=MODEL_NAME,
         api_key=os.environ['ENV_API_KEY'],  # หรือใส่สตริงคีย์ตรงนี้
+        concurrency=args.concurrency,       # ยิงพร้อมกันสูงสุดกี่ call (1 = แบบเดิมทีละ call)
+        timeout=180,            # วินาทีต่อ call
+        scheduler=GeminiScheduler(rpm=10, tpm=250_000, tokens_per_item=60),  # โควตาตาม tier ของคีย์
+        resume=args.resume,
+        telemetry=telemetry,
+        quality_gate=args.quality_gate,
     )
+    if telemetry is not None:
+        telemetry.close()
+        telemetry.report()
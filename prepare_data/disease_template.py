@@ -95,8 +95,25 @@ PLACEHOLDERS_BLOCK = {
 }
 
 
-def make_schema(schema_name: str, ontology_binding: dict, description: str = None) -> str:
-    """ประกอบสคีมาเป็นสตริง JSON (indent=2)"""
+# ส่วนของสคีมาที่เหมือนกันทุกโรค (ใช้เป็น prefix ที่ cache ได้) / ส่วนที่ต่างกันต่อโรค
+SHARED_SCHEMA_KEYS = (
+    "schema_version",
+    "placeholders",
+    "confidence_phrases",
+    "template_variations",
+    "rendering_rules",
+    "example_generation_note",
+)
+
+
+def _dumps(payload: dict, compact: bool) -> str:
+    if compact:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(payload, ensure_ascii=False, indent=2)
+
+
+def make_schema(schema_name: str, ontology_binding: dict, description: str = None, compact: bool = False) -> str:
+    """ประกอบสคีมาเป็นสตริง JSON (indent=2; compact=True → ไม่มีช่องว่าง/ขึ้นบรรทัด ประหยัด token)"""
     payload = {
         "schema_version": "1.0",
         "name": schema_name,
@@ -114,7 +131,23 @@ def make_schema(schema_name: str, ontology_binding: dict, description: str = Non
             "ontology_binding and placeholders, then apply rendering_rules."
         ),
     }
-    return json.dumps(payload, ensure_ascii=False, indent=2)
+    return _dumps(payload, compact)
+
+
+def minify_schema(schema_text: str) -> str:
+    """แปลงสคีมา (เช่นค่าใน ALL_TEMPLATES) เป็นแบบ compact"""
+    return _dumps(json.loads(schema_text), compact=True)
+
+
+def split_schema(schema_text: str, compact: bool = True):
+    """
+    แยกสคีมาเป็น (ส่วนกลาง, ส่วนเฉพาะโรค)
+    ส่วนกลางของทั้ง 9 โรคเป็นสตริงเดียวกันทุกตัวอักษร → ใช้เป็น cached prefix ตัวเดียวได้
+    """
+    payload = json.loads(schema_text)
+    shared = {k: payload[k] for k in SHARED_SCHEMA_KEYS if k in payload}
+    specific = {k: v for k, v in payload.items() if k not in SHARED_SCHEMA_KEYS}
+    return _dumps(shared, compact), _dumps(specific, compact)
 
 
 # ---------- บล็อก ontology ทั้ง 9 ตามข้อมูลที่ให้ ----------
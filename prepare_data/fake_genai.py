@@ -0,0 +1,338 @@
+"""
+Fake genai.Client สำหรับทดสอบ/รันแบบ offline (ไม่เรียก API จริง)
+
+ใช้แทน `genai.Client(api_key=...)` ได้ทั้งแบบ sync (client.models) และ async (client.aio.models)
+โดยสร้างย่อหน้าปลอมตามจำนวนที่ขอใน prompt ("Generate <n> ...")
+ถ้า prompt ระบุโรคที่มี ontology ("... describing <Class>.") ย่อหน้าจะใช้คำจาก group / subtypes / synonyms ของโรคนั้น
+และไม่มีประโยคปฏิเสธ (ยกเว้นคลาสใน quality_gate.NEGATION_ALLOWED เช่น Normal ที่ term ปฏิเสธคือผลปกติ)
+→ ผ่าน quality_gate.disease_gate เหมือนข้อความจริงที่ดี
+รองรับ generate_content_stream (ส่งข้อความเป็น chunk ขนาด chunk_chars; chunk สุดท้ายมี finish_reason/usage)
+และ context cache แบบ local (client.caches.create/get/delete + config.cached_content)
+จำลอง 429/503 และ response ที่ถูกตัด (MAX_TOKENS) ได้ เพื่อทดสอบ scheduler
+"""
+import asyncio
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+_N_ITEMS_RE = re.compile(r"Generate\s+(\d+)")
+_DISEASE_RE = re.compile(r"describing\s+([A-Za-z_]+)\.")
+# คำที่ทำให้ term กลายเป็นประโยคปฏิเสธ (เช่น "No pleural effusion" ของ Normal) → ไม่ใช้เป็นคำในย่อหน้าปลอม
+_NEGATION_WORDS = {"no", "not", "without", "none", "neither", "nor", "absent", "negative", "absence", "free",
+                   "excluded", "ruled"}
+_FINDING_SENTENCES = [
+    "Findings are compatible with {term} in the {zone} of the {side} lung.",
+    "Appearance is suggestive of {term} on the {view} projection.",
+    "There is {texture} change in keeping with {term}.",
+    "The pattern may reflect {term} with {texture} distribution.",
+    "Overall impression is consistent with {term}.",
+    "Explanatory context favors {term} given the {texture} appearance in the {zone}.",
+    "Correlation with prior imaging is advised to follow {term}.",
+]
+
+
+def _contents_text(contents: Any) -> str:
+    """รวมข้อความจาก contents (รองรับ str, list[str], list[types.Content])"""
+    if isinstance(contents, str):
+        return contents
+    texts: List[str] = []
+    for c in contents or []:
+        if isinstance(c, str):
+            texts.append(c)
+            continue
+        for p in getattr(c, "parts", None) or []:
+            if getattr(p, "text", None):
+                texts.append(p.text)
+    return "\n".join(texts)
+
+
+def _fake_paragraph(rng: random.Random, idx: int) -> str:
+    n_sent = rng.randint(5, 7)
+    return " ".join(
+        f"Synthetic finding {idx}.{k} with {rng.choice(['patchy', 'focal', 'diffuse'])} opacity."
+        for k in range(1, n_sent + 1)
+    )
+
+
+def _ontology_terms(disease: str) -> List[str]:
+    """คำจาก ontology ของโรค (ตัดวงเล็บ / คำอธิบายหลัง — และ term ที่มีคำปฏิเสธ) — ว่างถ้าไม่รู้จักโรค"""
+    from quality_gate import NEGATION_ALLOWED
+    from template_renderer import ONTOLOGIES
+
+    onto = ONTOLOGIES.get(disease.lower())
+    if onto is None:
+        return []
+    negation_ok = disease.lower() in NEGATION_ALLOWED
+    terms = []
+    for raw in [onto["group"]] + list(onto.get("subtypes", [])) + list(onto.get("synonyms", [])):
+        term = " ".join(re.sub(r"\([^)]*\)", " ", raw.split("—")[0]).split()).rstrip(".")
+        if term and (negation_ok or not _NEGATION_WORDS & set(re.findall(r"[a-z]+", term.lower()))):
+            terms.append(term)
+    return terms
+
+
+def _disease_paragraph(rng: random.Random, terms: List[str]) -> str:
+    n_sent = rng.randint(5, 7)
+    return " ".join(
+        rng.choice(_FINDING_SENTENCES).format(
+            term=rng.choice(terms),
+            zone=rng.choice(["upper zone", "mid zone", "lower zone"]),
+            side=rng.choice(["right", "left"]),
+            view=rng.choice(["PA", "AP"]),
+            texture=rng.choice(["patchy", "focal", "diffuse"]),
+        )
+        for _ in range(n_sent)
+    )
+
+
+class FakeAPIError(Exception):
+    """หน้าตาเหมือน google.genai.errors.APIError (มี .code / .status / .message)"""
+
+    def __init__(self, code: int, status: str, message: str = ""):
+        super().__init__(f"{code} {status}. {message}".strip())
+        self.code = code
+        self.status = status
+        self.message = message
+        self.details = {"error": {"code": code, "status": status, "message": message}}
+
+
+class _FakeModels:
+    def __init__(self, owner: "FakeClient"):
+        self._owner = owner
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        latency = self._owner._enter()
+        try:
+            if latency:
+                time.sleep(latency)
+            return self._owner._respond(model, contents, config)
+        finally:
+            self._owner._exit()
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        latency = self._owner._enter()
+        try:
+            resp = self._owner._respond(model, contents, config)
+        except Exception:
+            self._owner._exit()
+            raise
+        chunks = self._owner._chunks(resp)
+        cut = self._owner._stream_cut(len(chunks))
+
+        def gen():
+            try:
+                for k, chunk in enumerate(chunks):
+                    if k == cut:
+                        raise FakeAPIError(503, "UNAVAILABLE", "The model is overloaded.")
+                    if latency:
+                        time.sleep(latency / len(chunks))
+                    yield chunk
+            finally:
+                self._owner._exit()
+
+        return gen()
+
+
+class _FakeAsyncModels:
+    def __init__(self, owner: "FakeClient"):
+        self._owner = owner
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None):
+        latency = self._owner._enter()
+        try:
+            if latency:
+                await asyncio.sleep(latency)
+            return self._owner._respond(model, contents, config)
+        finally:
+            self._owner._exit()
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        latency = self._owner._enter()
+        try:
+            resp = self._owner._respond(model, contents, config)
+        except Exception:
+            self._owner._exit()
+            raise
+        chunks = self._owner._chunks(resp)
+        cut = self._owner._stream_cut(len(chunks))
+
+        async def gen():
+            try:
+                for k, chunk in enumerate(chunks):
+                    if k == cut:
+                        raise FakeAPIError(503, "UNAVAILABLE", "The model is overloaded.")
+                    if latency:
+                        await asyncio.sleep(latency / len(chunks))
+                    yield chunk
+            finally:
+                self._owner._exit()
+
+        return gen()
+
+
+def _system_text(config: Any) -> str:
+    si = getattr(config, "system_instruction", None) if config is not None else None
+    if si is None:
+        return ""
+    if isinstance(si, str):
+        return si
+    if not isinstance(si, (list, tuple)):
+        si = [si]
+    return "\n".join(getattr(p, "text", None) or (p if isinstance(p, str) else "") for p in si)
+
+
+class _FakeCaches:
+    """client.caches แบบ local: เก็บ system instruction + contents ไว้ในหน่วยความจำ"""
+
+    def __init__(self, owner: "FakeClient"):
+        self._owner = owner
+        self._store: dict = {}
+
+    def create(self, model: str, config: Any = None):
+        text = _system_text(config) + "\n" + _contents_text(getattr(config, "contents", None))
+        tokens = len(text) // 4
+        if tokens < self._owner.min_cache_tokens:
+            raise FakeAPIError(400, "INVALID_ARGUMENT",
+                               f"Cached content is too small. total_token_count={tokens}, "
+                               f"min_total_token_count={self._owner.min_cache_tokens}")
+        name = f"cachedContents/fake-{len(self._store) + 1}"
+        cache = SimpleNamespace(name=name, model=model, display_name=getattr(config, "display_name", None),
+                                text=text, usage_metadata=SimpleNamespace(total_token_count=tokens))
+        self._store[name] = cache
+        return cache
+
+    def get(self, name: str):
+        if name not in self._store:
+            raise FakeAPIError(404, "NOT_FOUND", f"CachedContent not found: {name}")
+        return self._store[name]
+
+    def delete(self, name: str):
+        self._store.pop(name, None)
+
+    def list(self):
+        return list(self._store.values())
+
+
+class FakeClient:
+    """
+    latency: วินาทีต่อ call (float) หรือช่วง (min, max) ที่สุ่มแบบ seed ได้
+    seed   : ทำให้ข้อความ/latency ที่สุ่มซ้ำได้
+    rate_limit_rate : ความน่าจะเป็นที่ call จะโดน 429 RESOURCE_EXHAUSTED
+    error_rate      : ความน่าจะเป็นที่ call จะโดน 503 UNAVAILABLE
+    max_items       : ถ้าขอเกินนี้ จะตอบแค่ max_items ข้อความ + ข้อความที่ขาดกลางคัน (finish_reason=MAX_TOKENS)
+    chunk_chars     : ขนาด chunk (ตัวอักษร) ของ generate_content_stream
+    stream_error_rate: ความน่าจะเป็นที่ stream จะขาดกลางคัน (503 หลังส่งไปแล้วครึ่งหนึ่ง)
+    min_cache_tokens: ขนาดขั้นต่ำของ context cache (เล็กกว่านี้ caches.create จะ error แบบ API จริง)
+
+    หลังรันตรวจสอบได้จาก .calls (บันทึก model/prompt ของทุก call) และ .max_in_flight
+    """
+
+    def __init__(self, latency: Any = 0.0, seed: int = 0, rate_limit_rate: float = 0.0,
+                 error_rate: float = 0.0, max_items: Optional[int] = None, chunk_chars: int = 200,
+                 min_cache_tokens: int = 1024, stream_error_rate: float = 0.0):
+        self.latency = latency
+        self.chunk_chars = chunk_chars
+        self.min_cache_tokens = min_cache_tokens
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.max_items = max_items
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._terms: dict = {}
+        self.calls: List[dict] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches(self)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(self))
+
+    def _exit(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def _enter(self) -> float:
+        """นับ call ที่ค้างอยู่ แล้วคืน latency ของ call นี้"""
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if isinstance(self.latency, (tuple, list)):
+                return self._rng.uniform(*self.latency)
+            return float(self.latency or 0.0)
+
+    def _ontology_terms(self, disease: str) -> List[str]:
+        with self._lock:
+            if disease not in self._terms:
+                self._terms[disease] = _ontology_terms(disease)
+            return self._terms[disease]
+
+    def _respond(self, model: str, contents: Any, config: Optional[Any]):
+        prompt = _contents_text(contents)
+        cached_name = getattr(config, "cached_content", None) if config is not None else None
+        cached_text = self.caches.get(cached_name).text if cached_name else ""
+        m = _N_ITEMS_RE.search(prompt)
+        n_items = int(m.group(1)) if m else 1
+        with self._lock:
+            call_idx = len(self.calls)
+            self.calls.append({"model": model, "prompt": prompt, "n_items": n_items})
+            roll = self._rng.random()
+            rng = random.Random(self._rng.random())
+        if roll < self.rate_limit_rate:
+            raise FakeAPIError(429, "RESOURCE_EXHAUSTED", "Quota exceeded. retryDelay: 0s")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise FakeAPIError(503, "UNAVAILABLE", "The model is overloaded.")
+
+        finish_reason = "STOP"
+        d = _DISEASE_RE.search(prompt)
+        terms = self._ontology_terms(d.group(1)) if d else []
+        if terms:
+            paragraphs = [_disease_paragraph(rng, terms) for _ in range(n_items)]
+        else:
+            paragraphs = [_fake_paragraph(rng, call_idx * 1000 + k) for k in range(n_items)]
+        if self.max_items is not None and n_items > self.max_items:
+            cut = paragraphs[self.max_items]
+            paragraphs = paragraphs[: self.max_items] + [cut[: len(cut) // 2]]
+            finish_reason = "MAX_TOKENS"
+        text = "\n\n".join(paragraphs)
+        part = SimpleNamespace(text=text)
+        candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]), finish_reason=finish_reason)
+        cached_tokens = len(cached_text) // 4
+        prompt_tokens = (len(_system_text(config)) + len(prompt)) // 4 + cached_tokens
+        usage = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens or None,
+            candidates_token_count=len(text) // 4,
+            thoughts_token_count=0,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+        return SimpleNamespace(text=text, candidates=[candidate], usage_metadata=usage)
+
+    def _stream_cut(self, n_chunks: int) -> Optional[int]:
+        """index ของ chunk ที่ stream จะขาด (None = ส่งครบ)"""
+        if not self.stream_error_rate or n_chunks < 2:
+            return None
+        with self._lock:
+            roll = self._rng.random()
+        return n_chunks // 2 if roll < self.stream_error_rate else None
+
+    def _chunks(self, resp) -> List[Any]:
+        """แบ่ง response เป็น chunk แบบ stream: ทุก chunk มี text, chunk สุดท้ายมี finish_reason + usage"""
+        text = resp.text
+        size = max(1, self.chunk_chars)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        chunks = []
+        for k, piece in enumerate(pieces):
+            final = k == len(pieces) - 1
+            candidate = SimpleNamespace(
+                content=SimpleNamespace(parts=[SimpleNamespace(text=piece)]),
+                finish_reason=resp.candidates[0].finish_reason if final else None,
+            )
+            chunks.append(SimpleNamespace(
+                text=piece,
+                candidates=[candidate],
+                usage_metadata=resp.usage_metadata if final else None,
+            ))
+        return chunks
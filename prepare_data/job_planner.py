@@ -0,0 +1,249 @@
+"""
+Job planner: สร้างข้อความหลาย class ในรันเดียว ผ่าน worker pool ตัวเดียว
+
+- แต่ละ class มี target ของตัวเอง; งานย่อยคือ (class × batch) ขนาด items_per_call
+- worker ว่างจะหยิบ class ที่ "คืบหน้าน้อยที่สุดตามสัดส่วน" ก่อน → class เล็กไม่ต้องรอคิวหลัง class ใหญ่
+  และทุก class ไปถึง target ใกล้ ๆ กัน
+- call ที่ได้ไม่ครบ → ส่วนที่ขาดกลับเข้าคิวของ class นั้น; class ที่ fail จะหยุดเฉพาะ class นั้น
+- พิมพ์ตาราง throughput ต่อ class ทุก report_every วินาที
+
+CLI:
+    python job_planner.py --all 1000                          → ทุกคีย์ใน ALL_TEMPLATES คลาสละ 1000
+    python job_planner.py --target normal=1000 --target obstructive=400 --stream
+    python job_planner.py --all 1000 --exclude encapsulated_lesions --resume
+"""
+import argparse
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from async_engine import CallJob, CallResult
+from scheduler import GeminiScheduler
+
+
+@dataclass
+class ClassTask:
+    """
+    งานของ class หนึ่ง
+    target       : จำนวนข้อความทั้งหมดที่ต้องมี (รวมที่มีอยู่แล้ว)
+    done_before  : ข้อความที่มีอยู่แล้วก่อนรันนี้ (จาก manifest / CSV)
+    make_job(n)  : สร้าง CallJob ของ n ข้อความ (จอง seq ใหม่ทุกครั้ง)
+    call(job)    : ยิง + บันทึกผล + record manifest แล้วคืน CallResult
+    close()      : ปิดทรัพยากรตอนจบ (เช่น CSV writer)
+    """
+    name: str
+    target: int
+    done_before: int
+    items_per_call: int
+    make_job: Callable[[int], CallJob]
+    call: Callable[[CallJob], Awaitable[CallResult]]
+    close: Optional[Callable[[], None]] = None
+
+    produced: int = 0
+    claimed: int = 0
+    calls: int = 0
+    failed: int = 0
+    empty_streak: int = 0
+    stopped: bool = False
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    results: List[CallResult] = field(default_factory=list)
+
+    @property
+    def done(self) -> int:
+        return self.done_before + self.produced
+
+    @property
+    def free(self) -> int:
+        """ข้อความที่ยังไม่มีใครจอง"""
+        return max(0, self.target - self.done - self.claimed)
+
+    @property
+    def progress(self) -> float:
+        return (self.done + self.claimed) / self.target if self.target else 1.0
+
+    @property
+    def complete(self) -> bool:
+        return self.done >= self.target
+
+
+def pick_task(tasks: List[ClassTask]) -> Optional[ClassTask]:
+    """class ที่คืบหน้าน้อยที่สุด (นับรวมที่กำลังยิงอยู่) ในบรรดา class ที่ยังมีงานว่าง"""
+    ready = [t for t in tasks if not t.stopped and t.free > 0]
+    if not ready:
+        return None
+    return min(ready, key=lambda t: (t.progress, t.target - t.done))
+
+
+def format_table(tasks: List[ClassTask], now: Optional[float] = None) -> str:
+    now = now or time.perf_counter()
+    header = f"{'class':<26}{'done/target':>16}{'in-flight':>11}{'calls':>7}{'fail':>6}{'items/s':>9}{'eta':>8}"
+    lines = [header, "-" * len(header)]
+    tot_done = tot_target = 0
+    tot_rate = 0.0
+    for t in tasks:
+        elapsed = ((t.finished_at or now) - t.started_at) if t.started_at else 0.0
+        rate = t.produced / elapsed if elapsed > 0 else 0.0
+        left = max(0, t.target - t.done)
+        if t.complete:
+            eta = "done"
+        elif t.stopped:
+            eta = "stop"
+        else:
+            eta = f"{left / rate:.0f}s" if rate > 0 else "-"
+        lines.append(f"{t.name:<26}{f'{t.done}/{t.target}':>16}{t.claimed:>11}{t.calls:>7}{t.failed:>6}"
+                     f"{rate:>9.2f}{eta:>8}")
+        tot_done += t.done
+        tot_target += t.target
+        tot_rate += rate
+    lines.append("-" * len(header))
+    lines.append(f"{'total':<26}{f'{tot_done}/{tot_target}':>16}{sum(t.claimed for t in tasks):>11}"
+                 f"{sum(t.calls for t in tasks):>7}{sum(t.failed for t in tasks):>6}{tot_rate:>9.2f}")
+    return "\n".join(lines)
+
+
+async def run_planned(
+    tasks: List[ClassTask],
+    concurrency: int = 8,
+    scheduler: Optional[GeminiScheduler] = None,
+    report_every: Optional[float] = 10.0,
+    max_empty_calls: int = 3,
+) -> Dict[str, List[CallResult]]:
+    """
+    ยิงงานของทุก class ผ่าน worker `concurrency` ตัว (ขนาดต่อ call ตาม scheduler.items_per_call ถ้ามี)
+    คืน dict: ชื่อ class -> list[CallResult] เรียงตาม seq
+    """
+    if scheduler is not None and tasks:
+        scheduler.bind_items_per_call(max(t.items_per_call for t in tasks))
+    changed = asyncio.Condition()
+    t_start = time.perf_counter()
+
+    async def worker():
+        while True:
+            async with changed:
+                task = pick_task(tasks)
+                while task is None:
+                    # ไม่มีงานว่าง แต่ถ้ายังมี call ค้าง ส่วนที่ขาดอาจกลับเข้าคิว → รอ
+                    if not any(t.claimed for t in tasks):
+                        return
+                    await changed.wait()
+                    task = pick_task(tasks)
+                per_call = min(task.items_per_call, scheduler.items_per_call) if scheduler is not None \
+                    else task.items_per_call
+                n = min(per_call, task.free)
+                task.claimed += n
+                if task.started_at is None:
+                    task.started_at = time.perf_counter()
+
+            res = await task.call(task.make_job(n))
+
+            async with changed:
+                task.claimed -= n
+                task.calls += 1
+                task.results.append(res)
+                task.produced += res.n_parsed or 0
+                if not res.ok:
+                    task.failed += 1
+                    task.stopped = True
+                    print(f"[Stopped] {task.name}: call fail → หยุดเฉพาะ class นี้ ({task.done}/{task.target})")
+                else:
+                    task.empty_streak = 0 if res.n_parsed else task.empty_streak + 1
+                    if task.empty_streak >= max_empty_calls:
+                        task.stopped = True
+                        print(f"[Stopped] {task.name}: ได้ 0 ข้อความติดกัน {max_empty_calls} call")
+                    elif scheduler is not None and not task.complete:
+                        scheduler.record_result(res.truncated)
+                if task.complete and task.finished_at is None:
+                    task.finished_at = time.perf_counter()
+                changed.notify_all()
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(report_every)
+            print(f"\n[Planner] {time.perf_counter() - t_start:.0f}s\n{format_table(tasks)}\n")
+
+    rep = asyncio.create_task(reporter()) if report_every else None
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        if rep is not None:
+            rep.cancel()
+        for t in tasks:
+            if t.close is not None:
+                t.close()
+    print(f"\n[Planner] finished in {time.perf_counter() - t_start:.1f}s\n{format_table(tasks)}")
+    return {t.name: sorted(t.results, key=lambda r: r.seq) for t in tasks}
+
+
+def parse_targets(all_target: Optional[int], pairs: List[str], keys: List[str], exclude: List[str]) -> Dict[str, int]:
+    """--all N ให้ทุกคีย์ได้ N แล้ว --target key=N ทับเฉพาะคีย์; --exclude ตัดคีย์ออก"""
+    targets = {k: all_target for k in keys} if all_target else {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        key = key.strip()
+        if key not in keys:
+            raise SystemExit(f"unknown template key: {key!r} (choose from {', '.join(keys)})")
+        targets[key] = int(value)
+    for key in exclude:
+        targets.pop(key, None)
+    if not targets:
+        raise SystemExit("no targets: use --all N and/or --target key=N")
+    return targets
+
+
+if __name__ == "__main__":
+    import call_api_for_disease as disease
+    from prompt_cache import PromptCache
+    from telemetry import CallTelemetry
+
+    keys = list(disease.ALL_TEMPLATES)
+    parser = argparse.ArgumentParser(description="Generate several disease classes through one shared worker pool")
+    parser.add_argument("--all", type=int, default=None, help="target ของทุก class")
+    parser.add_argument("--target", action="append", default=[], metavar="KEY=N", help="target ราย class (ใส่ซ้ำได้)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="KEY")
+    parser.add_argument("--items-per-call", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--out-root", default="disease_output")
+    parser.add_argument("--rpm", type=float, default=10)
+    parser.add_argument("--tpm", type=float, default=250_000)
+    parser.add_argument("--timeout", type=float, default=180)
+    parser.add_argument("--report-every", type=float, default=10)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="เขียนตรงลง <out_root>/csv/<Class>.csv")
+    parser.add_argument("--cache-prefix", action="store_true")
+    parser.add_argument("--compact-schema", action="store_true")
+    parser.add_argument("--telemetry", default=None, metavar="DIR", help="เขียน calls.jsonl + gemini.prom ลงโฟลเดอร์นี้")
+    parser.add_argument("--quality-gate", action="store_true", help="ทิ้งย่อหน้าที่ไม่ผ่าน quality_gate ก่อนเขียน")
+    args = parser.parse_args()
+
+    targets = parse_targets(args.all, args.target, keys, args.exclude)
+    client = disease._make_client(os.environ.get("ENV_API_KEY"))
+    scheduler = GeminiScheduler(rpm=args.rpm, tpm=args.tpm)
+    prompt_cache = PromptCache(disease.MODEL_NAME) if args.cache_prefix else None
+    telemetry = CallTelemetry(os.path.join(args.telemetry, "calls.jsonl"),
+                              prom_path=os.path.join(args.telemetry, "gemini.prom")) if args.telemetry else None
+    tasks = disease.build_class_tasks(
+        client, targets,
+        items_per_call=args.items_per_call,
+        out_root=args.out_root,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        scheduler=scheduler,
+        resume=args.resume,
+        stream=args.stream,
+        prompt_cache=prompt_cache,
+        compact_schema=args.compact_schema,
+        telemetry=telemetry,
+        quality_gate=args.quality_gate,
+    )
+    try:
+        asyncio.run(run_planned(tasks, concurrency=args.concurrency, scheduler=scheduler,
+                                report_every=args.report_every))
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+            telemetry.report()
+        if prompt_cache is not None:
+            prompt_cache.clear(client)
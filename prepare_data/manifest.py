@@ -0,0 +1,119 @@
+"""
+Manifest ของการรัน generate_batch_outputs (ไฟล์ JSONL หนึ่งบรรทัดต่อหนึ่ง call)
+
+แต่ละบรรทัดเก็บ run_id, seq, ไฟล์ผลลัพธ์, พารามิเตอร์ของ call, จำนวนข้อความที่ขอ/ได้จริง,
+token usage และ error (ถ้ามี) → รันซ้ำด้วย resume=True จะยิงเฉพาะส่วนที่ยังขาดจาก total_items
+โดยไม่ต้องไล่ exists() ทีละไฟล์
+"""
+import json
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+LEGACY_RUN_ID = "legacy"
+
+
+class RunManifest:
+    def __init__(self, path, split_items: Optional[Callable[[str], List[str]]] = None):
+        self.path = Path(path)
+        self.split_items = split_items
+        self.records: List[Dict] = []
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.records.append(json.loads(line))
+        self.run_id: Optional[str] = None
+
+    # ----- สถานะ -----
+    def run_ids(self) -> List[str]:
+        seen: Dict[str, None] = {}
+        for r in self.records:
+            seen.setdefault(r["run_id"], None)
+        return list(seen)
+
+    def items_done(self, run_id: Optional[str] = None) -> int:
+        run_id = run_id or self.run_id
+        return sum(
+            int(r.get("n_parsed") or 0)
+            for r in self.records
+            if r["run_id"] == run_id and not r.get("error")
+        )
+
+    def next_seq(self) -> int:
+        return max((int(r["seq"]) for r in self.records), default=0) + 1
+
+    # ----- เริ่มรัน / ต่อรัน -----
+    def adopt_legacy(self, txt_files: Iterable[Path], seq_of: Callable[[Path], Optional[int]]) -> int:
+        """
+        โฟลเดอร์ที่มีไฟล์ .txt จากเวอร์ชันก่อนแต่ยังไม่มี manifest → บันทึกเป็น run 'legacy' หนึ่งครั้ง
+        (นับข้อความด้วย split_items) คืนจำนวนไฟล์ที่รับเข้า
+        """
+        if self.path.exists() or self.split_items is None:
+            return 0
+        adopted = 0
+        for p in sorted(txt_files):
+            seq = seq_of(p)
+            if seq is None:
+                continue
+            n = len(self.split_items(p.read_text(encoding="utf-8")))
+            self._append({
+                "run_id": LEGACY_RUN_ID, "seq": seq, "out_path": p.as_posix(),
+                "n_requested": None, "n_parsed": n, "error": None, "ts": p.stat().st_mtime,
+            })
+            adopted += 1
+        if adopted:
+            print(f"[Manifest] รับไฟล์เดิม {adopted} ไฟล์เข้า {self.path} (run '{LEGACY_RUN_ID}')")
+        return adopted
+
+    def begin(self, resume: bool = False) -> str:
+        """resume=True → ต่อ run ล่าสุดใน manifest; ไม่งั้นเปิด run ใหม่"""
+        ids = self.run_ids()
+        if resume and ids:
+            self.run_id = ids[-1]
+        else:
+            self.run_id = time.strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:6]
+        return self.run_id
+
+    # ----- บันทึกผลต่อ call -----
+    def record(self, result, **params) -> None:
+        """บันทึก CallResult หนึ่งรายการ + พารามิเตอร์ของ call (model, temperature, ...)"""
+        self._append({
+            "run_id": self.run_id,
+            "seq": result.seq,
+            "out_path": Path(result.out_path).as_posix(),
+            "n_requested": result.n_items,
+            "n_parsed": result.n_parsed,
+            "n_rejected": result.n_rejected,
+            "finish_reason": result.finish_reason,
+            "prompt_tokens": result.prompt_tokens,
+            "output_tokens": result.output_tokens,
+            "thinking_tokens": result.thinking_tokens,
+            "cached_tokens": result.cached_tokens,
+            "elapsed": round(result.elapsed, 3),
+            "attempts": result.attempts,
+            "error": result.error,
+            "ts": time.time(),
+            **params,
+        })
+
+    def _append(self, rec: Dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.records.append(rec)
+
+    def summary(self, run_id: Optional[str] = None) -> Dict:
+        run_id = run_id or self.run_id
+        recs = [r for r in self.records if r["run_id"] == run_id]
+        return {
+            "run_id": run_id,
+            "calls": len(recs),
+            "failed": sum(1 for r in recs if r.get("error")),
+            "items": self.items_done(run_id),
+            "prompt_tokens": sum(int(r.get("prompt_tokens") or 0) for r in recs),
+            "output_tokens": sum(int(r.get("output_tokens") or 0) for r in recs),
+            "cached_tokens": sum(int(r.get("cached_tokens") or 0) for r in recs),
+        }
@@ -0,0 +1,404 @@
+"""
+Index ตรวจข้อความเกือบซ้ำ (MinHash + LSH) สำหรับ disease_output/csv/*.csv และ userinput_output/csv/sl*.csv
+
+- ข้อความ → word n-gram shingles → MinHash signature (num_perm ค่า) คำนวณแบบ vectorized ด้วย numpy
+- LSH แบ่ง signature เป็น bands; ข้อความที่ตรงกันอย่างน้อยหนึ่ง band เป็นคู่ผู้สมัคร
+  (สมาชิกของ bucket ถูกต่อเป็นสายตามลำดับที่เพิ่ม ทั้งสายรวมและสายต่อไฟล์ → ไม่ต้องเทียบทุกคู่ใน bucket)
+  แล้วยืนยันด้วย Jaccard โดยประมาณ (สัดส่วนค่า signature ที่เท่ากัน) ≥ threshold → O(N · bands) ไม่ใช่ O(N²)
+- index บันทึกลงโฟลเดอร์ (signatures.npy + docs.npz + sources.json) และเพิ่มแถวใหม่ได้เรื่อย ๆ
+  (แถวที่เคย index แล้วจะถูกข้าม จึงรัน update ซ้ำหลังทุก batch ได้)
+
+CLI:
+    python near_dup.py update --index dedup_index disease_output/csv/*.csv userinput_output/csv/*.csv
+    python near_dup.py report --index dedup_index --threshold 0.8 --examples 3
+    python near_dup.py filter --index dedup_index --out-dir dedup_csv
+    python near_dup.py selftest
+"""
+import argparse
+import csv
+import hashlib
+import json
+import re
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_WORD_RE = re.compile(r"\{clinical_text\}|[a-z0-9]+(?:[-'/][a-z0-9]+)*")
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+_SHIFT = np.uint64(32)
+_SHINGLE_MUL = np.array([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F, 0x165667B1], dtype=np.uint64)
+_CHUNK_SHINGLES = 50_000
+
+
+def _text_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class _UnionFind:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, i: int) -> int:
+        p = self.parent
+        root = i
+        while p[root] != root:
+            root = p[root]
+        while p[i] != root:
+            p[i], i = root, p[i]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # เก็บ id น้อยสุดเป็นตัวแทน → ตัวแทนคือแถวที่ถูก index ก่อน
+            if ra < rb:
+                self.parent[rb] = ra
+            else:
+                self.parent[ra] = rb
+
+
+class NearDupIndex:
+    """
+    num_perm  : ความยาว signature
+    bands     : จำนวน band ของ LSH (rows ต่อ band = num_perm // bands)
+                ค่าเริ่มต้น 128/16 → จับคู่ที่ Jaccard ราว ≥ 0.7 ได้เกือบทั้งหมด แล้วกรองด้วย threshold อีกชั้น
+    ngram     : จำนวนคำต่อ shingle
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 16, ngram: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        if not 1 <= ngram <= len(_SHINGLE_MUL):
+            raise ValueError(f"ngram must be between 1 and {len(_SHINGLE_MUL)}")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ngram = ngram
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing: h_i(x) = (a_i * x + b_i) mod 2^64 >> 32 (ไม่มี modulo → เร็วกว่ามาก)
+        self._a = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self._band_mul = rng.integers(1, 1 << 63, self.rows, dtype=np.uint64) | np.uint64(1)
+
+        self.signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self.text_hashes = np.zeros(0, dtype=np.uint64)
+        self.source_ids = np.zeros(0, dtype=np.int32)
+        self.row_ids = np.zeros(0, dtype=np.int32)
+        self.sources: List[str] = []
+        # band → {key: doc ล่าสุดของ bucket, (source, key): doc ล่าสุดของ bucket ในไฟล์นั้น}
+        self._buckets: List[Dict] = [dict() for _ in range(bands)]
+        self._links: List[Tuple[int, int]] = []                  # (doc, สมาชิกก่อนหน้าใน bucket เดียวกัน)
+        self._seen: set = set()                                                 # (source_id, row, text_hash)
+        self._words: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.text_hashes)
+
+    # ----- signature -----
+    def _word_ids(self, text: str) -> List[int]:
+        cache = self._words
+        words = _WORD_RE.findall(text.lower())
+        for w in words:
+            if w not in cache:
+                cache[w] = zlib.crc32(w.encode("utf-8"))
+        return [cache[w] for w in words]
+
+    def _shingles(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """คืน (hash ของทุก shingle ต่อกัน, จำนวน shingle ต่อข้อความ); ข้อความสั้นกว่า ngram ได้ 1 shingle"""
+        k = self.ngram
+        words = [self._word_ids(t) for t in texts]
+        lengths = np.fromiter((len(w) for w in words), dtype=np.int64, count=len(words))
+        flat = np.fromiter((h for w in words for h in w), dtype=np.uint64, count=int(lengths.sum()))
+        flat = np.concatenate([flat, np.zeros(k, dtype=np.uint64)])
+        ends = np.cumsum(lengths)
+        starts_doc = ends - lengths
+        n_sh = np.maximum(lengths - k + 1, 1)
+        doc_of = np.repeat(np.arange(len(texts)), n_sh)
+        pos = np.arange(int(n_sh.sum())) - np.repeat(np.cumsum(n_sh) - n_sh, n_sh) + starts_doc[doc_of]
+        h = np.zeros(len(pos), dtype=np.uint64)
+        end_of = ends[doc_of]
+        for j in range(k):
+            idx = pos + j
+            word = np.where(idx < end_of, flat[idx], np.uint64(0))
+            h = h * _SHINGLE_MUL[j] + word
+        return (h ^ (h >> np.uint64(32))) & _MAX_HASH, n_sh
+
+    def signatures_for(self, texts: Sequence[str]) -> np.ndarray:
+        """MinHash signature (len(texts), num_perm) ของข้อความชุดหนึ่ง"""
+        out = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        i = 0
+        while i < len(texts):
+            # แบ่งเป็นก้อนตามจำนวน shingle เพื่อคุมหน่วยความจำของเมทริกซ์ (shingles × num_perm)
+            j, total = i, 0
+            while j < len(texts) and (total == 0 or total < _CHUNK_SHINGLES):
+                total += max(1, len(texts[j]) // 6)
+                j += 1
+            sh, n_sh = self._shingles(texts[i:j])
+            # (num_perm, shingles) → reduceat ตามแถวที่ต่อเนื่องในหน่วยความจำ
+            perm = self._a[:, None] * sh[None, :]
+            perm += self._b[:, None]
+            perm >>= _SHIFT
+            offsets = np.cumsum(n_sh) - n_sh
+            out[i:j] = np.minimum.reduceat(perm, offsets, axis=1).T
+            i = j
+        return out
+
+    def _band_keys(self, sigs: np.ndarray) -> np.ndarray:
+        bands = sigs.reshape(len(sigs), self.bands, self.rows).astype(np.uint64)
+        return (bands * self._band_mul).sum(axis=2, dtype=np.uint64)
+
+    # ----- เพิ่มข้อมูล -----
+    def _source_id(self, source: str) -> int:
+        if source not in self.sources:
+            self.sources.append(source)
+        return self.sources.index(source)
+
+    def add_texts(self, texts: Sequence[str], source: str = "", rows: Optional[Sequence[int]] = None) -> int:
+        """เพิ่มข้อความ (ข้ามแถวที่เคย index แล้ว) คืนจำนวนที่เพิ่มจริง"""
+        sid = self._source_id(source)
+        rows = list(rows) if rows is not None else list(range(len(texts)))
+        keep_texts, keep_rows, keep_hashes = [], [], []
+        for text, row in zip(texts, rows):
+            th = _text_hash(text)
+            key = (sid, int(row), th)
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            keep_texts.append(text)
+            keep_rows.append(row)
+            keep_hashes.append(th)
+        if not keep_texts:
+            return 0
+        sigs = self.signatures_for(keep_texts)
+        self._index(sigs, len(self), np.full(len(sigs), sid))
+        self.signatures = np.concatenate([self.signatures, sigs])
+        self.text_hashes = np.concatenate([self.text_hashes, np.array(keep_hashes, dtype=np.uint64)])
+        self.source_ids = np.concatenate([self.source_ids, np.full(len(keep_texts), sid, dtype=np.int32)])
+        self.row_ids = np.concatenate([self.row_ids, np.array(keep_rows, dtype=np.int32)])
+        return len(keep_texts)
+
+    def _index(self, sigs: np.ndarray, first_id: int, sids: np.ndarray) -> None:
+        """
+        ต่อ doc ใหม่กับสมาชิกล่าสุดของแต่ละ bucket (สมาชิกใน bucket จึงเชื่อมเป็นสายต่อกัน) ทั้งของทุกไฟล์
+        และของไฟล์เดียวกัน → scope='file' ที่ทิ้งลิงก์ข้ามไฟล์ยังเหลือสายภายในไฟล์ครบ
+        """
+        keys = self._band_keys(sigs).tolist()
+        sids = sids.tolist()
+        links = self._links
+        for b, bucket in enumerate(self._buckets):
+            for i, row_keys in enumerate(keys):
+                doc, key = first_id + i, row_keys[b]
+                prev = bucket.get(key)
+                if prev is not None:
+                    links.append((doc, prev))
+                bucket[key] = doc
+                prev_same = bucket.get((sids[i], key))
+                if prev_same is not None and prev_same != prev:
+                    links.append((doc, prev_same))
+                bucket[(sids[i], key)] = doc
+
+    def add_csv(self, path, column: str = "text") -> int:
+        path = Path(path)
+        with path.open(newline="", encoding="utf-8") as f:
+            texts = [row[column] for row in csv.DictReader(f)]
+        return self.add_texts(texts, source=path.as_posix())
+
+    # ----- หาคลัสเตอร์ -----
+    def clusters(self, threshold: float = 0.8, scope: str = "file") -> np.ndarray:
+        """
+        คืน array ตัวแทนของแต่ละ doc (doc ที่ไม่ซ้ำใครคือตัวแทนของตัวเอง)
+        scope='file' → นับซ้ำเฉพาะภายในไฟล์เดียวกัน, 'all' → ข้ามไฟล์ได้
+        """
+        n = len(self)
+        uf = _UnionFind(n)
+        if self._links:
+            pairs = np.unique(np.array(self._links, dtype=np.int64), axis=0)
+            a, b = pairs[:, 0], pairs[:, 1]
+            if scope == "file":
+                same = self.source_ids[a] == self.source_ids[b]
+                a, b = a[same], b[same]
+            sim = np.empty(len(a))
+            for s in range(0, len(a), 50_000):
+                sl = slice(s, s + 50_000)
+                sim[sl] = (self.signatures[a[sl]] == self.signatures[b[sl]]).mean(axis=1)
+            for x, y in zip(a[sim >= threshold].tolist(), b[sim >= threshold].tolist()):
+                uf.union(x, y)
+        return np.fromiter((uf.find(i) for i in range(n)), dtype=np.int64, count=n)
+
+    # ----- บันทึก / โหลด -----
+    def save(self, index_dir) -> None:
+        d = Path(index_dir)
+        d.mkdir(parents=True, exist_ok=True)
+        np.save(d / "signatures.npy", self.signatures)
+        np.savez(d / "docs.npz", text_hashes=self.text_hashes, source_ids=self.source_ids, row_ids=self.row_ids)
+        (d / "sources.json").write_text(json.dumps({
+            "num_perm": self.num_perm, "bands": self.bands, "ngram": self.ngram, "seed": self.seed,
+            "sources": self.sources,
+        }, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    @classmethod
+    def load(cls, index_dir) -> "NearDupIndex":
+        d = Path(index_dir)
+        meta = json.loads((d / "sources.json").read_text(encoding="utf-8"))
+        index = cls(meta["num_perm"], meta["bands"], meta["ngram"], meta["seed"])
+        index.sources = meta["sources"]
+        docs = np.load(d / "docs.npz")
+        index.text_hashes = docs["text_hashes"]
+        index.source_ids = docs["source_ids"]
+        index.row_ids = docs["row_ids"]
+        index.signatures = np.load(d / "signatures.npy")
+        index._seen = set(zip(index.source_ids.tolist(), index.row_ids.tolist(), index.text_hashes.tolist()))
+        index._index(index.signatures, 0, index.source_ids)
+        return index
+
+    @classmethod
+    def open(cls, index_dir, **kwargs) -> "NearDupIndex":
+        if (Path(index_dir) / "sources.json").exists():
+            return cls.load(index_dir)
+        return cls(**kwargs)
+
+
+def report(index: NearDupIndex, threshold: float = 0.8, scope: str = "file") -> List[Dict]:
+    """สรุปต่อไฟล์: จำนวนแถว, แถวที่ซ้ำ (ไม่ใช่ตัวแทน), จำนวนคลัสเตอร์ที่มีสมาชิก > 1"""
+    rep = index.clusters(threshold, scope)
+    dup = rep != np.arange(len(index))
+    out = []
+    for sid, source in enumerate(index.sources):
+        mask = index.source_ids == sid
+        reps, counts = np.unique(rep[mask], return_counts=True)
+        out.append({
+            "source": source,
+            "rows": int(mask.sum()),
+            "near_duplicates": int((dup & mask).sum()),
+            "clusters": int((counts > 1).sum()),
+            "largest_cluster": int(counts.max()) if len(counts) else 0,
+        })
+    return out
+
+
+def filter_csvs(index: NearDupIndex, out_dir, threshold: float = 0.8, scope: str = "file",
+                column: str = "text") -> Dict[str, Tuple[int, int]]:
+    """
+    เขียน CSV ใหม่ใน out_dir โดยเก็บเฉพาะตัวแทนของแต่ละคลัสเตอร์ คืน {source: (ก่อน, หลัง)}
+    แถวที่ยังไม่ได้ index (เพิ่มหลัง update ครั้งล่าสุด หรือข้อความในแถวเปลี่ยน) เก็บไว้ทั้งหมดพร้อมเตือน
+    """
+    rep = index.clusters(threshold, scope)
+    keep = rep == np.arange(len(index))
+    out_dir = Path(out_dir)
+    result = {}
+    for sid, source in enumerate(index.sources):
+        mask = index.source_ids == sid
+        # (row, hash ของข้อความ) → เก็บหรือไม่; ข้อความต้องตรงกับตอน index ถึงใช้ผลของ index ได้
+        decided = dict(zip(zip(index.row_ids[mask].tolist(), index.text_hashes[mask].tolist()), keep[mask].tolist()))
+        src = Path(source)
+        with src.open(newline="", encoding="utf-8") as f:
+            texts = [row[column] for row in csv.DictReader(f)]
+        kept, unindexed = [], 0
+        for i, t in enumerate(texts):
+            verdict = decided.get((i, _text_hash(t)))
+            if verdict is None:
+                unindexed += 1
+            if verdict is not False:
+                kept.append(t)
+        if unindexed:
+            print(f"[WARN] {source}: {unindexed} แถวยังไม่ได้ index → เก็บไว้ทั้งหมด (รัน update ก่อน filter)")
+        dst = out_dir / src.parent.parent.name / src.name
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with dst.open("w", newline="", encoding="utf-8") as f:
+            w = csv.writer(f, lineterminator="\n")
+            w.writerow([column])
+            w.writerows([t] for t in kept)
+        result[source] = (len(texts), len(kept))
+        print(f"[Filtered] {dst}  ({len(texts)} -> {len(kept)} rows)")
+    return result
+
+
+def _selftest() -> None:
+    """แถวที่ซ้ำถูกตัด, แถวที่เพิ่มหลัง index ต้องไม่หายจากผล filter, ซ้ำในไฟล์เดียวกันต้องเจอแม้ bucket เริ่มจากไฟล์อื่น"""
+    import tempfile
+
+    base = "the left lower lobe shows patchy opacity with air bronchograms and mild pleural thickening"
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "Test" / "csv" / "Test.csv"
+        src.parent.mkdir(parents=True)
+        rows = [base, base + " noted", "heart size is normal and the mediastinum is midline without shift"]
+        src.write_text("text\n" + "\n".join(rows) + "\n", encoding="utf-8")
+        index = NearDupIndex()
+        index.add_csv(src)
+        with src.open("a", encoding="utf-8") as f:
+            f.write("new row appended after indexing with entirely different wording\n")
+        result = filter_csvs(index, Path(tmp) / "out", threshold=0.5)
+        out = (Path(tmp) / "out" / "Test" / "Test.csv").read_text(encoding="utf-8").splitlines()[1:]
+    assert result[src.as_posix()] == (4, 3), result
+    assert out == [rows[0], rows[2], "new row appended after indexing with entirely different wording"], out
+
+    # ข้อความเดียวกันใน Normal 1 แถว แล้วซ้ำกันเองใน Obstructive 2 แถว → scope='file' ต้องเจอคู่ใน Obstructive
+    index = NearDupIndex()
+    index.add_texts([base], source="Normal.csv")
+    index.add_texts([base, base], source="Obstructive.csv")
+    rep_file = index.clusters(0.8, "file")
+    assert rep_file[1] == rep_file[2] != rep_file[0], rep_file
+    assert len(set(index.clusters(0.8, "all").tolist())) == 1
+    print("[SelfTest] ok: ตัดแถวซ้ำ 1 แถว, แถวที่เพิ่มหลัง index ยังอยู่, แถวซ้ำในไฟล์เดียวกันหลังแถวจากไฟล์อื่นถูกจับ")
+
+
+def _print_examples(index: NearDupIndex, threshold: float, scope: str, n_examples: int) -> None:
+    rep = index.clusters(threshold, scope)
+    reps, counts = np.unique(rep, return_counts=True)
+    order = np.argsort(-counts)[:n_examples]
+    cache: Dict[str, List[str]] = {}
+    for r in reps[order]:
+        members = np.flatnonzero(rep == r)[:3]
+        print(f"\n  cluster of {int((rep == r).sum())} (first {len(members)}):")
+        for m in members:
+            source = index.sources[index.source_ids[m]]
+            if source not in cache:
+                with open(source, newline="", encoding="utf-8") as f:
+                    cache[source] = [row["text"] for row in csv.DictReader(f)]
+            print(f"    [{Path(source).name}:{index.row_ids[m]}] {cache[source][index.row_ids[m]][:140]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MinHash/LSH near-duplicate index for generated CSVs")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_up = sub.add_parser("update", help="เพิ่มแถวใหม่จาก CSV เข้า index")
+    p_up.add_argument("csv", nargs="+")
+    for p in (sub.add_parser("report"), sub.add_parser("filter")):
+        p.add_argument("--threshold", type=float, default=0.8)
+        p.add_argument("--scope", choices=["file", "all"], default="file")
+    sub.choices["report"].add_argument("--examples", type=int, default=0)
+    sub.choices["report"].add_argument("--json", default=None)
+    sub.choices["filter"].add_argument("--out-dir", required=True)
+    for p in sub.choices.values():
+        p.add_argument("--index", default="dedup_index")
+    sub.add_parser("selftest", help="ตรวจ filter บนไฟล์ชั่วคราว")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    if args.cmd == "selftest":
+        _selftest()
+    elif args.cmd == "update":
+        index = NearDupIndex.open(args.index)
+        for path in args.csv:
+            added = index.add_csv(path)
+            print(f"[Index] {path}  (+{added} rows)")
+        index.save(args.index)
+        print(f"[Index] {args.index}: {len(index)} rows  ({time.perf_counter() - t0:.1f}s)")
+    elif args.cmd == "report":
+        index = NearDupIndex.load(args.index)
+        rows = report(index, args.threshold, args.scope)
+        print(f"{'source':<50}{'rows':>8}{'near-dup':>10}{'clusters':>10}{'largest':>9}")
+        for r in rows:
+            print(f"{r['source']:<50}{r['rows']:>8}{r['near_duplicates']:>10}{r['clusters']:>10}{r['largest_cluster']:>9}")
+        if args.examples:
+            _print_examples(index, args.threshold, args.scope, args.examples)
+        if args.json:
+            Path(args.json).write_text(json.dumps(rows, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\n({time.perf_counter() - t0:.1f}s)")
+    else:
+        index = NearDupIndex.load(args.index)
+        filter_csvs(index, args.out_dir, args.threshold, args.scope)
@@ -0,0 +1,247 @@
+"""
+สุ่มคู่ (prompt ของผู้ใช้ × clinical text) แบบ streaming แล้วเขียนเป็น instruction rows ลง shard (JSONL / Parquet)
+
+- prompt: userinput_output/csv/sl1..sl5.csv (มี {clinical_text} อยู่ในข้อความ)
+- clinical text: clinical_texts/by_type/<Class>.csv (คอลัมน์ clinical_text, disease)
+- cross product เต็มมีหลายล้านคู่ → ไม่สร้างจริง: แบ่งเป็น stratum (sl × class) แจก quota ตามน้ำหนัก
+  (largest remainder) แล้วสุ่ม pair id ในแต่ละ stratum แบบไม่ซ้ำด้วย Generator.choice (ใช้หน่วยความจำตาม quota
+  ไม่ใช่ตามขนาด product) จากนั้นสลับลำดับทุก stratum รวมกันด้วย seed เดียว
+- แถวถูกประกอบทีละ chunk ตอนเขียน: {"instruction", "input", "output", "disease", "sl", "prompt_id", "text_id"}
+  (instruction = prompt ที่แทน {clinical_text} แล้ว, output = ชื่อโรค) → seed เดิม = ไฟล์เดิมทุกไบต์
+- index.json เก็บรายชื่อ shard, จำนวนแถวต่อ stratum และพารามิเตอร์ที่ใช้
+
+CLI:
+    python pair_sampler.py --rows 200000 --out pairs_jsonl
+    python pair_sampler.py --rows 1000000 --format parquet --sl-weight sl5=2 --class-weight Normal=0.5
+"""
+import argparse
+import csv
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+PLACEHOLDER = "{clinical_text}"
+PROMPT_DIR = Path("userinput_output/csv")
+CLINICAL_DIR = Path("clinical_texts/by_type")
+INDEX_NAME = "index.json"
+COLUMNS = ["instruction", "input", "output", "disease", "sl", "prompt_id", "text_id"]
+
+
+def _read_column(path: Path, column: str) -> List[str]:
+    with path.open(newline="", encoding="utf-8") as f:
+        return [row[column] for row in csv.DictReader(f) if row.get(column)]
+
+
+def load_prompts(root: Path = PROMPT_DIR) -> Dict[str, List[str]]:
+    """{"sl1": [prompt, ...], ...} เฉพาะแถวที่มี {clinical_text}"""
+    prompts = {}
+    for path in sorted(Path(root).glob("sl*.csv")):
+        rows = [t for t in _read_column(path, "text") if PLACEHOLDER in t]
+        if rows:
+            prompts[path.stem] = rows
+    if not prompts:
+        raise FileNotFoundError(f"ไม่พบ sl*.csv ที่มี {PLACEHOLDER} ใน {root}")
+    return prompts
+
+
+def load_clinical_texts(root: Path = CLINICAL_DIR) -> Dict[str, Tuple[List[str], List[str]]]:
+    """{"Normal": ([clinical_text, ...], [disease, ...]), ...}"""
+    out = {}
+    for path in sorted(Path(root).glob("*.csv")):
+        with path.open(newline="", encoding="utf-8") as f:
+            rows = [(r["clinical_text"], r.get("disease") or path.stem.replace("_", " "))
+                    for r in csv.DictReader(f) if r.get("clinical_text")]
+        if rows:
+            out[path.stem] = ([t for t, _ in rows], [d for _, d in rows])
+    if not out:
+        raise FileNotFoundError(f"ไม่พบ clinical text ใน {root}")
+    return out
+
+
+def allocate(total: int, weights: np.ndarray, caps: np.ndarray) -> np.ndarray:
+    """แบ่ง total ตามน้ำหนัก (largest remainder) โดยไม่เกิน cap ของแต่ละช่อง; ส่วนที่ล้นย้ายไปช่องอื่น"""
+    weights = np.where(caps > 0, np.asarray(weights, dtype=np.float64), 0.0)
+    quota = np.zeros(len(weights), dtype=np.int64)
+    total = min(int(total), int(caps.sum()))
+    while quota.sum() < total:
+        open_ = (quota < caps) & (weights > 0)
+        if not open_.any():
+            break
+        left = total - int(quota.sum())
+        share = np.where(open_, weights, 0.0)
+        share = share / share.sum() * left
+        add = np.floor(share).astype(np.int64)
+        rem = left - int(add.sum())
+        if rem:
+            order = np.argsort(-(share - add), kind="stable")
+            add[order[:rem]] += 1
+        quota = np.minimum(quota + add, caps)
+    return quota
+
+
+@dataclass
+class Stratum:
+    sl: str
+    cls: str
+    n_prompts: int
+    n_texts: int
+    quota: int = 0
+
+    @property
+    def size(self) -> int:
+        return self.n_prompts * self.n_texts
+
+
+class PairSampler:
+    def __init__(self, prompts: Dict[str, List[str]], texts: Dict[str, Tuple[List[str], List[str]]],
+                 sl_weights: Optional[Dict[str, float]] = None, class_weights: Optional[Dict[str, float]] = None,
+                 seed: int = 42):
+        self.prompts = prompts
+        self.texts = texts
+        self.seed = seed
+        self.sl_weights = {sl: float((sl_weights or {}).get(sl, 1.0)) for sl in prompts}
+        self.class_weights = {c: float((class_weights or {}).get(c, 1.0)) for c in texts}
+        unknown = set(sl_weights or {}) - set(prompts) | set(class_weights or {}) - set(texts)
+        if unknown:
+            raise KeyError(f"ไม่รู้จัก sl/class: {sorted(unknown)}")
+        self.strata = [Stratum(sl, c, len(prompts[sl]), len(texts[c][0])) for sl in prompts for c in texts]
+        # ข้อความที่ escape JSON ไว้ล่วงหน้า → JSONL ประกอบแถวด้วยการต่อ string ไม่ต้อง json.dumps ต่อแถว
+        self._json_tables = ({sl: [_json_str(t) for t in ps] for sl, ps in prompts.items()},
+                             {c: ([_json_str(t) for t in ts], [_json_str(d) for d in ds]) for c, (ts, ds) in texts.items()})
+
+    @property
+    def product_size(self) -> int:
+        return sum(s.size for s in self.strata)
+
+    def plan(self, rows: int) -> List[Stratum]:
+        weights = np.array([self.sl_weights[s.sl] * self.class_weights[s.cls] for s in self.strata])
+        caps = np.array([s.size for s in self.strata], dtype=np.int64)
+        for s, q in zip(self.strata, allocate(rows, weights, caps)):
+            s.quota = int(q)
+        return self.strata
+
+    def sample_ids(self, rows: int) -> np.ndarray:
+        """(stratum, prompt_id, text_id) ของทุกแถว เรียงแบบสุ่ม — ขนาด O(rows) ไม่ใช่ O(product)"""
+        self.plan(rows)
+        rng = np.random.default_rng(self.seed)
+        parts = []
+        for k, s in enumerate(self.strata):
+            if not s.quota:
+                continue
+            pair = rng.choice(s.size, size=s.quota, replace=False)
+            parts.append(np.stack([np.full(s.quota, k), pair // s.n_texts, pair % s.n_texts], axis=1))
+        if not parts:
+            return np.empty((0, 3), dtype=np.int64)
+        ids = np.concatenate(parts)
+        return ids[rng.permutation(len(ids))]
+
+    def _rows(self, ids: np.ndarray, json_escaped: bool = False) -> Iterator[Dict]:
+        """
+        ประกอบแถว (dict ตาม COLUMNS) จาก (stratum, prompt_id, text_id) — ทุก output ใช้ตัวนี้ตัวเดียว
+        json_escaped=True: ค่า string เป็นแบบ escape JSON แล้ว (ไม่มีเครื่องหมายคำพูดครอบ)
+        """
+        prompts, all_texts = self._json_tables if json_escaped else (self.prompts, self.texts)
+        meta = [(s.sl, s.cls) for s in self.strata]
+        for k, p, t in ids.tolist():
+            sl, cls = meta[k]
+            texts, diseases = all_texts[cls]
+            yield {"instruction": prompts[sl][p].replace(PLACEHOLDER, texts[t]), "input": "",
+                   "output": diseases[t], "disease": diseases[t], "sl": sl, "prompt_id": p, "text_id": t}
+
+    def iter_rows(self, rows: int) -> Iterator[Dict]:
+        """แถวแบบ dict ทีละแถว (ใช้ต่อกับ datasets.Dataset.from_generator ได้)"""
+        yield from self._rows(self.sample_ids(rows))
+
+    def iter_jsonl_chunks(self, ids: np.ndarray, chunk_rows: int = 10_000) -> Iterator[Tuple[int, str]]:
+        """(จำนวนแถว, ข้อความ JSONL) ทีละ chunk — ได้ผลเท่ากับ json.dumps(row, ensure_ascii=False) ทุกไบต์"""
+        for start in range(0, len(ids), chunk_rows):
+            lines = [f'{{"instruction": "{r["instruction"]}", "input": "", "output": "{r["output"]}", '
+                     f'"disease": "{r["disease"]}", "sl": "{r["sl"]}", "prompt_id": {r["prompt_id"]}, '
+                     f'"text_id": {r["text_id"]}}}\n'
+                     for r in self._rows(ids[start:start + chunk_rows], json_escaped=True)]
+            yield len(lines), "".join(lines)
+
+    def iter_record_batches(self, ids: np.ndarray, chunk_rows: int = 10_000):
+        import pyarrow as pa
+
+        for start in range(0, len(ids), chunk_rows):
+            yield pa.RecordBatch.from_pylist(list(self._rows(ids[start:start + chunk_rows])), schema=_arrow_schema())
+
+    def write_shards(self, rows: int, out_dir: Path, fmt: str = "jsonl", rows_per_shard: int = 100_000,
+                     chunk_rows: int = 10_000) -> Dict:
+        if fmt not in ("jsonl", "parquet"):
+            raise ValueError(f"format ไม่รองรับ: {fmt}")
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        t0 = time.perf_counter()
+        ids = self.sample_ids(rows)
+        chunk_rows = max(1, min(chunk_rows, rows_per_shard))
+        shards = []
+        for shard_no, start in enumerate(range(0, len(ids), rows_per_shard)):
+            part = ids[start:start + rows_per_shard]
+            name = f"pairs-{shard_no:05d}.{fmt}"
+            if fmt == "jsonl":
+                with (out_dir / name).open("w", encoding="utf-8", newline="\n") as f:
+                    for _, text in self.iter_jsonl_chunks(part, chunk_rows):
+                        f.write(text)
+            else:
+                import pyarrow.parquet as pq
+
+                with pq.ParquetWriter(str(out_dir / name), _arrow_schema()) as w:
+                    for batch in self.iter_record_batches(part, chunk_rows):
+                        w.write_batch(batch)
+            shards.append({"file": name, "rows": int(len(part))})
+        elapsed = time.perf_counter() - t0
+        index = {
+            "format": fmt, "rows": int(len(ids)), "seed": self.seed, "product_size": self.product_size,
+            "sl_weights": self.sl_weights, "class_weights": self.class_weights,
+            "strata": [{"sl": s.sl, "class": s.cls, "rows": s.quota, "size": s.size} for s in self.strata],
+            "shards": shards,
+        }
+        (out_dir / INDEX_NAME).write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
+        size_mb = sum((out_dir / s["file"]).stat().st_size for s in shards) / 1e6
+        print(f"[Pairs] {len(ids):,} / {self.product_size:,} pairs → {out_dir} ({len(shards)} shards, {size_mb:.1f} MB) "
+              f"in {elapsed:.1f}s ({len(ids) / max(elapsed, 1e-9):,.0f} rows/s, {size_mb / max(elapsed, 1e-9):.0f} MB/s)")
+        return index
+
+
+def _json_str(s: str) -> str:
+    return json.dumps(s, ensure_ascii=False)[1:-1]
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([(c, pa.int32() if c.endswith("_id") else pa.string()) for c in COLUMNS])
+
+
+def _parse_weights(pairs: Sequence[str]) -> Dict[str, float]:
+    out = {}
+    for item in pairs:
+        key, _, value = item.partition("=")
+        out[key.strip()] = float(value)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream sampled (user prompt × clinical text) instruction rows to shards")
+    parser.add_argument("--rows", type=int, required=True, help="จำนวนแถวที่ต้องการ (ไม่เกินขนาด cross product)")
+    parser.add_argument("--prompts", default=str(PROMPT_DIR))
+    parser.add_argument("--clinical", default=str(CLINICAL_DIR))
+    parser.add_argument("--out", default="pairs_jsonl")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--rows-per-shard", type=int, default=100_000)
+    parser.add_argument("--sl-weight", action="append", default=[], metavar="SL=W", help="เช่น sl5=2 (ค่าเริ่มต้น 1)")
+    parser.add_argument("--class-weight", action="append", default=[], metavar="CLASS=W", help="เช่น Normal=0.5")
+    parser.add_argument("--exclude", action="append", default=[], help="class ที่ไม่เอา (เช่น Encapsulated_Lesions)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    texts = {c: v for c, v in load_clinical_texts(Path(args.clinical)).items() if c not in set(args.exclude)}
+    sampler = PairSampler(load_prompts(Path(args.prompts)), texts, _parse_weights(args.sl_weight),
+                          _parse_weights(args.class_weight), args.seed)
+    sampler.write_shards(args.rows, Path(args.out), args.format, args.rows_per_shard)
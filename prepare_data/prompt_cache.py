@@ -0,0 +1,64 @@
+"""
+Explicit context caching ของ prefix ที่ซ้ำกันทุก call (system instruction + ส่วนกลางของสคีมา)
+
+PromptCache.get() สร้าง cache ผ่าน client.caches.create ครั้งเดียวต่อ (model, prefix) แล้วคืนชื่อ cache
+ให้ใส่ใน GenerateContentConfig(cached_content=...) แทน system_instruction
+ถ้าสร้างไม่ได้ (เช่น prefix สั้นกว่าขั้นต่ำของโมเดล หรือคีย์ไม่รองรับ) จะคืน None → ผู้เรียกส่ง prefix แบบเดิม
+ทดสอบ offline ได้ด้วย FakeClient (fake_genai) ซึ่งมี client.caches แบบ local
+"""
+import hashlib
+from typing import Dict, Optional
+
+from google.genai import types
+
+
+class PromptCache:
+    def __init__(self, model_name: str, ttl: str = "3600s", display_prefix: str = "lung-captioning"):
+        self.model_name = model_name
+        self.ttl = ttl
+        self.display_prefix = display_prefix
+        self._names: Dict[str, Optional[str]] = {}
+
+    @staticmethod
+    def key(model_name: str, system_instruction_text: str, prefix_text: str) -> str:
+        h = hashlib.sha256()
+        for part in (model_name, system_instruction_text, prefix_text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()[:16]
+
+    def get(self, client, system_instruction_text: str, prefix_text: str) -> Optional[str]:
+        """ชื่อ cache ของ (system instruction + prefix) — สร้างใหม่เฉพาะครั้งแรก"""
+        key = self.key(self.model_name, system_instruction_text, prefix_text)
+        if key in self._names:
+            return self._names[key]
+        try:
+            cache = client.caches.create(
+                model=self.model_name,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"{self.display_prefix}-{key}",
+                    system_instruction=system_instruction_text,
+                    contents=[types.Content(role="user", parts=[types.Part.from_text(text=prefix_text)])],
+                    ttl=self.ttl,
+                ),
+            )
+        except Exception as e:
+            print(f"[Cache] ใช้ context cache ไม่ได้ ({type(e).__name__}: {e}) → ส่ง prefix แบบเดิม")
+            self._names[key] = None
+            return None
+        usage = getattr(cache, "usage_metadata", None)
+        tokens = getattr(usage, "total_token_count", None) if usage is not None else None
+        print(f"[Cache] created {cache.name}  ({tokens if tokens is not None else '?'} tokens, ttl {self.ttl})")
+        self._names[key] = cache.name
+        return cache.name
+
+    def clear(self, client) -> None:
+        """ลบ cache ที่สร้างไว้ (ไม่งั้นจะอยู่จนหมด ttl และคิดค่า storage)"""
+        for key, name in list(self._names.items()):
+            if name is None:
+                continue
+            try:
+                client.caches.delete(name=name)
+            except Exception as e:
+                print(f"[Cache] ลบ {name} ไม่ได้ ({type(e).__name__}: {e})")
+            self._names.pop(key, None)
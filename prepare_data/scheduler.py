@@ -0,0 +1,203 @@
+"""
+Scheduler กลางสำหรับ call_api_for_* : คุม quota + retry + ปรับ items_per_call อัตโนมัติ
+
+- TokenBucket คุม requests-per-minute (RPM) และ tokens-per-minute (TPM)
+- error ถูกแยกเป็น rate_limit / transient / fatal; สองแบบแรก retry ด้วย exponential backoff + jitter
+- ถ้า response ถูกตัด (finish_reason = MAX_TOKENS หรือได้ข้อความน้อยกว่าที่ขอ) จะลด items_per_call ลง
+  และค่อย ๆ เพิ่มกลับเมื่อได้ผลครบติดกันหลายครั้ง (AIMD)
+"""
+import asyncio
+import random
+import re
+import time
+from typing import Awaitable, Callable, Optional
+
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+_TRANSIENT_CODES = {408, 500, 502, 503, 504}
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class TokenBucket:
+    """
+    bucket ที่เติมแบบต่อเนื่อง `per_minute` หน่วยต่อนาที จุได้สูงสุด `burst` หน่วย
+    acquire() รอจนมีพอแล้วหักออก; adjust() ใช้ปรับยอดหลังรู้ค่าจริง (ติดลบได้ = เป็นหนี้)
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst if burst is not None else per_minute)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def drain(self) -> None:
+        """ใช้หลังโดน 429: ทิ้งโควตาที่เหลือ ให้ทุก worker ชะลอพร้อมกัน"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+def classify_error(exc: BaseException) -> str:
+    """แยกประเภท error จาก genai (APIError มี .code) / timeout / network"""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return TRANSIENT
+    code = getattr(exc, "code", None)
+    status = str(getattr(exc, "status", "") or "")
+    if code == 429 or status == "RESOURCE_EXHAUSTED":
+        return RATE_LIMIT
+    if code in _TRANSIENT_CODES or status in ("UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED"):
+        return TRANSIENT
+    if code is None and type(exc).__name__ in ("ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "ConnectError"):
+        return TRANSIENT
+    return FATAL
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """อ่าน retryDelay ที่ Gemini แนบมากับ 429 (ถ้ามี)"""
+    details = getattr(exc, "details", None) or getattr(exc, "message", None) or str(exc)
+    m = _RETRY_DELAY_RE.search(str(details))
+    return float(m.group(1)) if m else None
+
+
+def finish_reason_of(resp) -> str:
+    try:
+        reason = resp.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return ""
+    return str(getattr(reason, "name", reason) or "")
+
+
+def usage_total_tokens(resp) -> Optional[int]:
+    usage = getattr(resp, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None) if usage is not None else None
+    return int(total) if total else None
+
+
+class GeminiScheduler:
+    """
+    rpm / tpm        : โควตาต่อนาที (None = ไม่จำกัด)
+    tokens_per_item  : ประมาณ token ขาออกต่อ 1 ข้อความ ใช้จอง TPM ก่อนยิง (แก้ยอดตาม usage จริงทีหลัง)
+    max_retries      : จำนวนครั้ง retry สูงสุดต่อ call สำหรับ rate_limit/transient
+    base_delay/max_delay : ช่วง backoff (วินาที) แบบ full jitter
+    items_per_call   : ค่าเริ่มต้น/เพดาน ของจำนวนข้อความต่อ call; ลดลงเมื่อ response ถูกตัด
+    min_items_per_call, shrink, grow_after : ขั้นต่ำ, ตัวคูณตอนลด, จำนวน call ที่ครบติดกันก่อนเพิ่มกลับ
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        tokens_per_item: int = 200,
+        max_retries: int = 6,
+        base_delay: float = 2.0,
+        max_delay: float = 60.0,
+        items_per_call: Optional[int] = None,
+        min_items_per_call: int = 5,
+        shrink: float = 0.5,
+        grow_after: int = 3,
+        seed: Optional[int] = None,
+    ):
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.tokens_per_item = tokens_per_item
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_items_per_call = items_per_call
+        self.items_per_call = items_per_call
+        self.min_items_per_call = min_items_per_call
+        self.shrink = shrink
+        self.grow_after = grow_after
+        self._clean_streak = 0
+        self._rng = random.Random(seed)
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "truncated": 0, "failed": 0}
+
+    # ----- items_per_call แบบปรับตัวได้ -----
+    def bind_items_per_call(self, items_per_call: int) -> None:
+        """ตั้งเพดานจาก items_per_call ของงาน ถ้ายังไม่ได้กำหนดตอนสร้าง"""
+        if self.max_items_per_call is None:
+            self.max_items_per_call = items_per_call
+            self.items_per_call = items_per_call
+
+    def record_result(self, truncated: bool) -> None:
+        if truncated:
+            self.stats["truncated"] += 1
+            self._clean_streak = 0
+            new = max(self.min_items_per_call, int(self.items_per_call * self.shrink))
+            if new < self.items_per_call:
+                print(f"[Scheduler] response truncated → items_per_call {self.items_per_call} -> {new}")
+            self.items_per_call = new
+            return
+        self._clean_streak += 1
+        if self._clean_streak >= self.grow_after and self.items_per_call < self.max_items_per_call:
+            step = max(1, self.max_items_per_call // 10)
+            self.items_per_call = min(self.max_items_per_call, self.items_per_call + step)
+            self._clean_streak = 0
+
+    def estimate_tokens(self, prompt_chars: int, n_items: int) -> int:
+        return prompt_chars // 4 + n_items * self.tokens_per_item
+
+    def backoff_delay(self, attempt: int) -> float:
+        return self._rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # ----- ยิง call พร้อม pacing + retry -----
+    async def run(self, call_factory: Callable[[], Awaitable], est_tokens: int = 0, timeout: Optional[float] = None):
+        """
+        call_factory: ฟังก์ชันที่สร้าง coroutine ใหม่ทุกครั้งที่เรียก (เพราะ coroutine ใช้ซ้ำไม่ได้)
+        คืน (response, attempts); โยน exception ต่อเมื่อเป็น fatal หรือ retry ครบแล้ว
+        """
+        attempt = 0
+        while True:
+            if self.rpm_bucket is not None:
+                await self.rpm_bucket.acquire(1)
+            if self.tpm_bucket is not None and est_tokens:
+                await self.tpm_bucket.acquire(est_tokens)
+            self.stats["calls"] += 1
+            try:
+                resp = await asyncio.wait_for(call_factory(), timeout=timeout)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == FATAL or attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                delay = self.backoff_delay(attempt)
+                if kind == RATE_LIMIT:
+                    self.stats["rate_limited"] += 1
+                    hinted = retry_after_seconds(e)
+                    if hinted is not None:
+                        delay = max(delay, hinted)
+                    for bucket in (self.rpm_bucket, self.tpm_bucket):
+                        if bucket is not None:
+                            bucket.drain()
+                self.stats["retries"] += 1
+                attempt += 1
+                print(f"[Retry {attempt}/{self.max_retries}] {kind}: {type(e).__name__} → wait {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            actual = usage_total_tokens(resp)
+            if self.tpm_bucket is not None and actual is not None and est_tokens:
+                self.tpm_bucket.adjust(actual - est_tokens)
+            return resp, attempt + 1
@@ -0,0 +1,129 @@
+"""
+แยกย่อหน้าจาก response แบบ streaming แล้วเขียนลง CSV ของ class ทันที (ไม่ผ่านไฟล์ .txt)
+
+- ParagraphSplitter: รับข้อความทีละ chunk แล้วคืนย่อหน้าที่ครบแล้ว (คั่นด้วยบรรทัดว่าง)
+- validate_paragraph: ตรวจย่อหน้าก่อนเขียน (จำนวนประโยค, ไม่มีเลขข้อ/bullet/คำเกริ่น)
+- ClassCsvWriter: append ทีละแถวลง <out_root>/csv/<Class>.csv และหยุดเมื่อครบ target พอดี
+"""
+import csv
+import re
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+
+_BLANK_LINE_RE = re.compile(r"\n[ \t]*\n")
+_SENTENCE_END_RE = re.compile(r"[.!?](?:\s+|$)")
+_LIST_PREFIX_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)]|#+)\s*")
+_PREAMBLE_RE = re.compile(r"^(?:here (?:are|is)|sure[,!]|okay[,!]|certainly)", re.IGNORECASE)
+
+
+class ParagraphSplitter:
+    """
+    feed(chunk) → list ของย่อหน้าที่ปิดแล้ว (เจอบรรทัดว่างตามหลัง)
+    flush()     → ย่อหน้าสุดท้ายที่ค้างอยู่ (อาจถูกตัดถ้า finish_reason = MAX_TOKENS)
+    """
+
+    def __init__(self):
+        self._buf = ""
+
+    def feed(self, chunk: str) -> List[str]:
+        self._buf += chunk.replace("\r\n", "\n")
+        parts = _BLANK_LINE_RE.split(self._buf)
+        self._buf = parts.pop()
+        return [p.strip() for p in parts if p.strip()]
+
+    def flush(self) -> Optional[str]:
+        tail, self._buf = self._buf.strip(), ""
+        return tail or None
+
+
+def count_sentences(text: str) -> int:
+    return len(_SENTENCE_END_RE.findall(text.strip()))
+
+
+def validate_paragraph(text: str, min_sentences: int = 5, max_sentences: int = 7) -> bool:
+    """ย่อหน้าเดียว, min..max ประโยค, ไม่ขึ้นต้นด้วยเลขข้อ/bullet/คำเกริ่นของโมเดล"""
+    if not text or "\n" in text.strip():
+        return False
+    if _LIST_PREFIX_RE.match(text) or _PREAMBLE_RE.match(text):
+        return False
+    return min_sentences <= count_sentences(text) <= max_sentences
+
+
+class ClassCsvWriter:
+    """
+    CSV หนึ่งไฟล์ต่อ class (คอลัมน์เดียว `text` แบบเดียวกับ disease_output/csv/*.csv)
+    นับแถวเดิมตอนเปิด → รันต่อได้ และเขียนไม่เกิน target แถว
+    แถวที่ซ้ำกับที่มีอยู่แล้วในไฟล์จะถูกข้าม
+    """
+
+    def __init__(self, path, target: int, column: str = "text",
+                 validate: Optional[Callable[[str], bool]] = validate_paragraph):
+        self.path = Path(path)
+        self.target = target
+        self.column = column
+        self.validate = validate
+        self.rejected = 0
+        self.duplicates = 0
+        self._seen: Set[str] = set()
+        self.count = 0
+        if self.path.exists():
+            with self.path.open(newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    if row:
+                        self._seen.add(row[0])
+                        self.count += 1
+            if self.count > target:
+                print(f"[CSV] {self.path} มี {self.count} แถว เกิน target {target} อยู่แล้ว (ไม่เขียนเพิ่ม)")
+        self._f = None
+        self._w = None
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.target - self.count)
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.target
+
+    def _open(self) -> None:
+        if self._f is not None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = not self.path.exists() or self.path.stat().st_size == 0
+        self._f = self.path.open("a", newline="", encoding="utf-8")
+        self._w = csv.writer(self._f, lineterminator="\n")
+        if new_file:
+            self._w.writerow([self.column])
+
+    def append(self, text: str) -> bool:
+        """เขียน 1 แถวถ้าผ่าน validate, ไม่ซ้ำ และยังไม่ครบ target; คืน True ถ้าเขียนจริง"""
+        if self.full:
+            return False
+        if self.validate is not None and not self.validate(text):
+            self.rejected += 1
+            return False
+        if text in self._seen:
+            self.duplicates += 1
+            return False
+        self._open()
+        self._w.writerow([text])
+        self._seen.add(text)
+        self.count += 1
+        return True
+
+    def flush(self) -> None:
+        if self._f is not None:
+            self._f.flush()
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = self._w = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,277 @@
+"""
+Telemetry ต่อ call ของ generator (token / เวลา / จำนวนข้อความ / finish reason) → histogram + ค่าใช้จ่าย
+
+- CallTelemetry.record(result, **params): ใช้ CallResult ตัวเดียวกับที่ manifest บันทึก (usage_metadata ถูกอ่านไว้แล้ว)
+  เขียน JSON หนึ่งบรรทัดต่อ call ลง jsonl_path (เปิดไฟล์ค้างไว้ ไม่เปิด/ปิดทุก call) และเก็บค่าดิบไว้ใน list
+  → ต้นทุนต่อ call ระดับไมโครวินาที เทียบกับ call ที่ใช้หลายวินาที
+- แยกกลุ่มตาม disease_name / sentences_long ที่ส่งมากับ params (แบบเดียวกับ call_params ของ manifest)
+- summary(): p50/p95/p99 ของเวลาต่อ call และ token (prompt / output / thinking), ข้อความที่ขอ/ได้/ถูก gate ตัด,
+  finish reason, ค่าใช้จ่ายรวม และค่าใช้จ่ายต่อ 1000 caption (จาก PRICES ต่อ 1M token)
+- write_prometheus(path): textfile สำหรับ node_exporter (เขียนไฟล์ชั่วคราวแล้ว rename ทีเดียว)
+  เขียนซ้ำเองทุก prom_every วินาทีระหว่างรัน และตอน close()
+
+ใช้:
+    telemetry = CallTelemetry("telemetry/calls.jsonl", prom_path="telemetry/gemini.prom")
+    generate_batch_outputs(..., telemetry=telemetry)
+    telemetry.close(); telemetry.report()
+
+CLI (สรุปจาก JSONL ของ telemetry หรือ manifest.jsonl เดิมก็ได้ — ฟิลด์เดียวกัน):
+    python telemetry.py telemetry/calls.jsonl --prom gemini.prom
+    python telemetry.py disease_output/*/manifest.jsonl --json summary.json
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# USD ต่อ 1M token (ราคา paid tier ของ Gemini API; thinking คิดราคาเดียวกับ output) — แก้ได้ตามราคาปัจจุบัน
+PRICES = {
+    "gemini-2.5-flash": {"input": 0.30, "cached": 0.03, "output": 2.50},
+    "gemini-2.5-flash-lite": {"input": 0.10, "cached": 0.01, "output": 0.40},
+    "gemini-2.5-pro": {"input": 1.25, "cached": 0.125, "output": 10.00},
+}
+QUANTILES = (50, 95, 99)
+TOKEN_KINDS = ("prompt_tokens", "output_tokens", "thinking_tokens", "cached_tokens")
+
+
+def call_cost(rec: Dict, prices: Optional[Dict[str, float]]) -> float:
+    """ค่าใช้จ่าย (USD) ของ call หนึ่งรายการ; ส่วนที่มาจาก context cache คิดราคา cached"""
+    if not prices:
+        return 0.0
+    cached = rec.get("cached_tokens") or 0
+    uncached = max(0, (rec.get("prompt_tokens") or 0) - cached)
+    out = (rec.get("output_tokens") or 0) + (rec.get("thinking_tokens") or 0)
+    return (uncached * prices["input"] + cached * prices["cached"] + out * prices["output"]) / 1e6
+
+
+def group_of(rec: Dict) -> str:
+    if rec.get("disease_name"):
+        return str(rec["disease_name"])
+    if rec.get("sentences_long") is not None:
+        return f"sl{rec['sentences_long']}"
+    return "all"
+
+
+def _quantiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {f"p{q}": None for q in QUANTILES}
+    qs = np.percentile(np.asarray(values, dtype=np.float64), QUANTILES)
+    return {f"p{q}": round(float(v), 4) for q, v in zip(QUANTILES, qs)}
+
+
+class _Group:
+    def __init__(self):
+        self.calls = 0
+        self.failed = 0
+        self.truncated = 0
+        self.requested = 0
+        self.parsed = 0
+        self.rejected = 0
+        self.cost = 0.0
+        self.finish: Dict[str, int] = {}
+        self.elapsed: List[float] = []
+        self.tokens: Dict[str, List[int]] = {k: [] for k in TOKEN_KINDS}
+
+    def add(self, rec: Dict, cost: float) -> None:
+        self.calls += 1
+        if rec.get("error"):
+            self.failed += 1
+            return
+        self.elapsed.append(float(rec.get("elapsed") or 0.0))
+        self.requested += int(rec.get("n_requested") or 0)
+        self.parsed += int(rec.get("n_parsed") or 0)
+        self.rejected += int(rec.get("n_rejected") or 0)
+        reason = rec.get("finish_reason") or "UNKNOWN"
+        self.finish[reason] = self.finish.get(reason, 0) + 1
+        if reason == "MAX_TOKENS":
+            self.truncated += 1
+        for k in TOKEN_KINDS:
+            if rec.get(k) is not None:
+                self.tokens[k].append(int(rec[k]))
+        self.cost += cost
+
+    def summary(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "failed": self.failed,
+            "truncated": self.truncated,
+            "items_requested": self.requested,
+            "items_parsed": self.parsed,
+            "items_rejected": self.rejected,
+            "finish_reasons": dict(self.finish),
+            "latency_s": _quantiles(self.elapsed),
+            "tokens": {k: {"total": int(sum(v)), **_quantiles(v)} for k, v in self.tokens.items()},
+            "cost_usd": round(self.cost, 6),
+            "cost_per_1000_captions_usd": round(self.cost / self.parsed * 1000, 4) if self.parsed else None,
+        }
+
+
+class CallTelemetry:
+    def __init__(self, jsonl_path: Optional[Path] = None, prom_path: Optional[Path] = None,
+                 prices: Dict[str, Dict[str, float]] = PRICES, prom_every: float = 30.0):
+        self.jsonl_path = Path(jsonl_path) if jsonl_path else None
+        self.prom_path = Path(prom_path) if prom_path else None
+        self.prices = prices
+        self.prom_every = prom_every
+        self.groups: Dict[str, _Group] = {}
+        self._f = None
+        self._last_prom = time.monotonic()
+
+    def record(self, result, **params) -> Dict:
+        """บันทึก CallResult หนึ่งรายการ (params เหมือนที่ส่งให้ RunManifest.record)"""
+        rec = {
+            "ts": round(time.time(), 3),
+            "seq": result.seq,
+            "n_requested": result.n_items,
+            "n_parsed": result.n_parsed,
+            "n_rejected": getattr(result, "n_rejected", 0),
+            "finish_reason": result.finish_reason,
+            "elapsed": round(result.elapsed, 4),
+            "attempts": result.attempts,
+            "prompt_tokens": result.prompt_tokens,
+            "output_tokens": result.output_tokens,
+            "thinking_tokens": result.thinking_tokens,
+            "cached_tokens": result.cached_tokens,
+            "error": result.error,
+            **params,
+        }
+        self.add(rec)
+        if self.jsonl_path is not None:
+            if self._f is None:
+                self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+                self._f = self.jsonl_path.open("a", encoding="utf-8")
+            self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        if self.prom_path is not None and time.monotonic() - self._last_prom >= self.prom_every:
+            self.write_prometheus(self.prom_path)
+        return rec
+
+    def add(self, rec: Dict) -> None:
+        """รวม record (dict แบบเดียวกับบรรทัดใน JSONL / manifest) เข้า histogram ของกลุ่ม"""
+        group = self.groups.get(group_of(rec))
+        if group is None:
+            group = self.groups[group_of(rec)] = _Group()
+        group.add(rec, call_cost(rec, self.prices.get(rec.get("model") or "")))
+
+    @classmethod
+    def from_jsonl(cls, paths: Iterable[Path], **kwargs) -> "CallTelemetry":
+        telemetry = cls(**kwargs)
+        for path in paths:
+            with Path(path).open(encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        rec = json.loads(line)
+                        if rec.get("n_requested") is not None:      # ข้าม record 'legacy' ของ manifest
+                            telemetry.add(rec)
+        return telemetry
+
+    def flush(self) -> None:
+        if self._f is not None:
+            self._f.flush()
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self.prom_path is not None:
+            self.write_prometheus(self.prom_path)
+
+    # ---------- สรุป ----------
+
+    def summary(self) -> Dict[str, Dict]:
+        total = _Group()
+        for g in self.groups.values():
+            total.calls += g.calls
+            total.failed += g.failed
+            total.truncated += g.truncated
+            total.requested += g.requested
+            total.parsed += g.parsed
+            total.rejected += g.rejected
+            total.cost += g.cost
+            total.elapsed += g.elapsed
+            for k in TOKEN_KINDS:
+                total.tokens[k] += g.tokens[k]
+            for reason, n in g.finish.items():
+                total.finish[reason] = total.finish.get(reason, 0) + n
+        out = {name: g.summary() for name, g in sorted(self.groups.items())}
+        out["_total"] = total.summary()
+        return out
+
+    def report(self) -> Dict[str, Dict]:
+        summary = self.summary()
+        print(f"{'group':<26s} {'calls':>6s} {'items':>11s} {'trunc':>6s} {'p50 s':>7s} {'p95 s':>7s} {'p99 s':>7s} "
+              f"{'out tok p50':>11s} {'USD/1k':>8s}")
+        for name, s in summary.items():
+            lat = s["latency_s"]
+            per_k = s["cost_per_1000_captions_usd"]
+            print(f"{name:<26s} {s['calls']:>6d} {s['items_parsed']:>5d}/{s['items_requested']:<5d} "
+                  f"{s['truncated']:>6d} {lat['p50'] or 0:>7.2f} {lat['p95'] or 0:>7.2f} {lat['p99'] or 0:>7.2f} "
+                  f"{s['tokens']['output_tokens']['p50'] or 0:>11.0f} {per_k if per_k is not None else '-':>8}")
+        return summary
+
+    # ---------- Prometheus textfile ----------
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        summary = {name: s for name, s in self.summary().items() if name != "_total"}
+        metric("gemini_calls_total", "counter", "Generator calls by finish reason (failed = error after retries)")
+        for name, s in summary.items():
+            for reason, n in s["finish_reasons"].items():
+                lines.append(f'gemini_calls_total{{group="{name}",finish_reason="{reason}"}} {n}')
+            lines.append(f'gemini_calls_total{{group="{name}",finish_reason="failed"}} {s["failed"]}')
+        metric("gemini_items_total", "counter", "Items requested / parsed / rejected by the quality gate")
+        for name, s in summary.items():
+            for kind in ("requested", "parsed", "rejected"):
+                lines.append(f'gemini_items_total{{group="{name}",kind="{kind}"}} {s["items_" + kind]}')
+        metric("gemini_tokens_total", "counter", "Tokens from usage_metadata")
+        for name, s in summary.items():
+            for kind in TOKEN_KINDS:
+                lines.append(f'gemini_tokens_total{{group="{name}",kind="{kind[:-7]}"}} {s["tokens"][kind]["total"]}')
+        metric("gemini_call_seconds", "summary", "Wall time per call including retries")
+        for name, g in sorted(self.groups.items()):
+            for q, v in _quantiles(g.elapsed).items():
+                if v is not None:
+                    lines.append(f'gemini_call_seconds{{group="{name}",quantile="{int(q[1:]) / 100}"}} {v}')
+            lines.append(f'gemini_call_seconds_sum{{group="{name}"}} {sum(g.elapsed):.4f}')
+            lines.append(f'gemini_call_seconds_count{{group="{name}"}} {len(g.elapsed)}')
+        metric("gemini_cost_usd_total", "counter", "Estimated cost from PRICES")
+        for name, s in summary.items():
+            lines.append(f'gemini_cost_usd_total{{group="{name}"}} {s["cost_usd"]}')
+        metric("gemini_cost_per_1000_captions_usd", "gauge", "Estimated cost per 1000 parsed captions")
+        for name, s in summary.items():
+            if s["cost_per_1000_captions_usd"] is not None:
+                lines.append(f'gemini_cost_per_1000_captions_usd{{group="{name}"}} {s["cost_per_1000_captions_usd"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(self.prometheus(), encoding="utf-8")
+        os.replace(tmp, path)
+        self._last_prom = time.monotonic()
+        return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize per-call generator telemetry (JSONL or manifest)")
+    parser.add_argument("jsonl", nargs="+")
+    parser.add_argument("--prom", default=None, help="เขียน Prometheus textfile")
+    parser.add_argument("--json", default=None, help="เขียน summary เป็น JSON")
+    args = parser.parse_args()
+
+    telemetry = CallTelemetry.from_jsonl(args.jsonl)
+    summary = telemetry.report()
+    if args.prom:
+        print(f"[Saved] {telemetry.write_prometheus(args.prom)}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[Saved] {args.json}")
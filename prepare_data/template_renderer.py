@@ -0,0 +1,274 @@
+"""
+Render ข้อความ caption จาก disease_template แบบ local (ไม่เรียก LLM)
+
+ใช้ TEMPLATE_VARIATIONS + ONTO_* + CONFIDENCE_PHRASES ตาม RENDERING_RULES:
+- typical_finding / location_note ที่มี {laterality} {lobe} {zone} {view} {size} ถูกขยายล่วงหน้าทุกแบบที่ถูกต้อง
+  (middle lobe ใช้กับ right เท่านั้น, bilateral ไม่จับคู่กับ lobe เดี่ยว)
+- synonym1 / synonym2 ต่างกันเสมอ
+- template ที่ ontology ไม่มีฟิลด์ตาม requires จะไม่ถูกเลือก; ไม่มี subtypes → ใช้ group แทน
+- ตัวพิมพ์ใหญ่ต้นประโยค, ตัดจุดซ้ำ, ช่องว่างซ้ำ และปิดท้ายด้วยจุดเสมอ
+
+สุ่มด้วย numpy Generator (seed เดียวกัน → ผลเหมือนเดิมทุกครั้ง) และ render ทีละกลุ่ม template
+ด้วย str.format แบบ map จึงได้หลายแสนข้อความต่อวินาที; LLM ใช้เฉพาะงาน paraphrase
+"""
+import argparse
+import csv
+import itertools
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from string import Formatter
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from disease_template import (
+    CONFIDENCE_PHRASES,
+    ONTO_1_NORMAL,
+    ONTO_2_IP,
+    ONTO_3_HDENS,
+    ONTO_4_LDENS,
+    ONTO_5_OBS,
+    ONTO_6_DEGEN_INF,
+    ONTO_7_ENCAP,
+    ONTO_8_MEDIA,
+    ONTO_9_CHEST,
+    TEMPLATE_VARIATIONS,
+)
+
+# คีย์เดียวกับ ALL_TEMPLATES
+ONTOLOGIES = {
+    "normal": ONTO_1_NORMAL,
+    "inflammatory_pneumonia": ONTO_2_IP,
+    "higher_density": ONTO_3_HDENS,
+    "lower_density": ONTO_4_LDENS,
+    "obstructive": ONTO_5_OBS,
+    "degenerative_infectious": ONTO_6_DEGEN_INF,
+    "encapsulated_lesions": ONTO_7_ENCAP,
+    "mediastinal_changes": ONTO_8_MEDIA,
+    "chest_changes": ONTO_9_CHEST,
+}
+
+# ค่าของ placeholder ซ้อน (ตาม PLACEHOLDERS_BLOCK; view/size ไม่มีใน schema จึงกำหนดที่นี่)
+NESTED_VALUES = {
+    "laterality": ["right", "left", "bilateral"],
+    "lobe": ["upper lobe", "middle lobe", "lower lobe"],
+    "zone": ["upper zone", "mid zone", "lower zone"],
+    "view": ["PA", "AP"],
+    "size": ["8 mm", "12 mm", "1.5 cm", "2 cm", "3 cm", "4.5 cm"],
+}
+DEFAULT_CONFIDENCE_PHRASE = "Findings are compatible with"
+
+# ฟิลด์ของ template → คีย์ใน ontology
+_FIELD_SOURCE = {
+    "subtype": "subtypes",
+    "synonym": "synonyms",
+    "synonym1": "synonyms",
+    "synonym2": "synonyms",
+    "typical_finding": "typical_findings",
+    "location_note": "location_notes",
+}
+_SENTENCE_START_RE = re.compile(r"(^|[.!?]\s+)$")
+_MULTI_SPACE_RE = re.compile(r" {2,}")
+
+
+def _valid_combo(values: Dict[str, str]) -> bool:
+    lobe = values.get("lobe")
+    lat = values.get("laterality")
+    if lobe == "middle lobe" and lat not in (None, "right"):
+        return False
+    if lobe is not None and lat == "bilateral":
+        return False
+    return True
+
+
+def expand_nested(text: str) -> List[str]:
+    """ขยาย {laterality} {lobe} {zone} {view} {size} ทุกแบบที่ผ่านกฎ (ไม่มี placeholder → คืนตัวเดิม)"""
+    names = [f for _, f, _, _ in Formatter().parse(text) if f]
+    names = list(dict.fromkeys(n for n in names if n in NESTED_VALUES))
+    if not names:
+        return [text]
+    out = []
+    for combo in itertools.product(*(NESTED_VALUES[n] for n in names)):
+        values = dict(zip(names, combo))
+        if _valid_combo(values):
+            out.append(text.format(**values))
+    return out
+
+
+def _strip_period(s: str) -> str:
+    return s.rstrip().rstrip(".")
+
+
+def _lower_first(s: str) -> str:
+    # คงตัวพิมพ์ใหญ่ของตัวย่อ (CXR, PTX, RML ...)
+    if len(s) > 1 and s[1].isupper():
+        return s
+    return s[:1].lower() + s[1:]
+
+
+def _upper_first(s: str) -> str:
+    return s[:1].upper() + s[1:]
+
+
+@dataclass
+class _CompiledTemplate:
+    id: str
+    fmt: str                    # positional format string
+    slots: List[str]            # ชื่อฟิลด์ตามลำดับ positional
+    starts: List[bool]          # slot อยู่ต้นประโยคหรือไม่
+    confidence_override: Optional[str]
+
+
+def _compile(tpl: dict) -> _CompiledTemplate:
+    parts, slots, starts = [], [], []
+    prefix = ""
+    for literal, field, _, _ in Formatter().parse(tpl["template"]):
+        literal = literal.replace("{", "{{").replace("}", "}}")
+        parts.append(literal)
+        prefix += literal
+        if field is None:
+            continue
+        starts.append(bool(_SENTENCE_START_RE.search(prefix)))
+        parts.append("{%d}" % len(slots))
+        slots.append(field)
+        prefix += "x"
+    # ค่าที่เติมถูกตัดจุดท้าย/ช่องว่างซ้ำไว้แล้ว → จัดรูป template ครั้งเดียวพอ ไม่ต้องทำทีละข้อความ
+    return _CompiledTemplate(tpl["id"], _finish_sentence("".join(parts)), slots, starts,
+                             tpl.get("override_confidence_phrase"))
+
+
+class TemplateRenderer:
+    """
+    renderer ของ ontology หนึ่งตัว; เตรียมตารางค่าทุกฟิลด์ (ตัวพิมพ์ต้นประโยค / กลางประโยค) ไว้ครั้งเดียว
+    render(n, seed) → list[str] จำนวน n ข้อความ
+    """
+
+    def __init__(self, ontology: dict, templates: Sequence[dict] = TEMPLATE_VARIATIONS,
+                 confidence_phrases: Sequence[str] = CONFIDENCE_PHRASES):
+        self.ontology = ontology
+        group = ontology["group"]
+        subtypes = ontology.get("subtypes") or [group]
+        raw = {
+            "group": [group],
+            "subtype": subtypes,
+            "synonym": ontology.get("synonyms") or [],
+            "confidence_phrase": list(confidence_phrases) or [DEFAULT_CONFIDENCE_PHRASE],
+        }
+        # typical_finding / location_note: เลือกรายการก่อน แล้วค่อยเลือกแบบที่ขยายแล้ว (ไม่ถ่วงน้ำหนักตามจำนวนแบบ)
+        self._nested: Dict[str, tuple] = {}
+        for field in ("typical_finding", "location_note"):
+            items = ontology.get(_FIELD_SOURCE[field]) or []
+            expanded = [expand_nested(_strip_period(t)) for t in items]
+            flat = [e for group_ in expanded for e in group_]
+            offsets = np.cumsum([0] + [len(g) for g in expanded[:-1]]) if expanded else np.zeros(0, int)
+            self._nested[field] = (offsets.astype(np.int64), np.array([len(g) for g in expanded], np.int64))
+            raw[field] = flat
+
+        # ตารางค่า: [ต้นประโยค, กลางประโยค]
+        self._tables: Dict[str, tuple] = {}
+        for field, values in raw.items():
+            values = [_MULTI_SPACE_RE.sub(" ", _strip_period(v) if field != "group" else v) for v in values]
+            mid_lower = field in ("typical_finding", "confidence_phrase", "location_note")
+            mid = [_lower_first(v) if mid_lower else v for v in values]
+            self._tables[field] = (
+                np.array([_upper_first(v) for v in values], dtype=object),
+                np.array(mid, dtype=object),
+            )
+
+        self.templates = [_compile(t) for t in templates if self._supports(t)]
+        if not self.templates:
+            raise ValueError(f"no template in TEMPLATE_VARIATIONS can be rendered for {ontology.get('id')}")
+
+    def _supports(self, tpl: dict) -> bool:
+        for field in tpl.get("requires", []):
+            src = "synonym" if field in ("synonym1", "synonym2") else field
+            if src in ("group", "confidence_phrase", "subtype"):
+                continue
+            if not self.ontology.get(_FIELD_SOURCE[src]):
+                return False
+        if {"synonym1", "synonym2"} <= set(tpl.get("requires", [])):
+            return len(set(self.ontology.get("synonyms") or [])) >= 2
+        return True
+
+    def _draw(self, field: str, n: int, rng: np.random.Generator) -> np.ndarray:
+        if field in self._nested:
+            offsets, counts = self._nested[field]
+            item = rng.integers(0, len(counts), n)
+            return offsets[item] + (rng.random(n) * counts[item]).astype(np.int64)
+        return rng.integers(0, len(self._tables[field][0]), n)
+
+    def render(self, n: int, seed: Optional[int] = None) -> List[str]:
+        rng = np.random.default_rng(seed)
+        which = rng.integers(0, len(self.templates), n)
+        out = np.empty(n, dtype=object)
+        for t_idx, tpl in enumerate(self.templates):
+            rows = np.flatnonzero(which == t_idx)
+            k = len(rows)
+            if k == 0:
+                continue
+            drawn: Dict[str, np.ndarray] = {}
+            if "synonym1" in tpl.slots or "synonym2" in tpl.slots:
+                n_syn = len(self._tables["synonym"][0])
+                s1 = rng.integers(0, n_syn, k)
+                drawn["synonym1"] = s1
+                drawn["synonym2"] = (s1 + rng.integers(1, n_syn, k)) % n_syn   # ต่างจาก synonym1 เสมอ
+            columns = []
+            for field, at_start in zip(tpl.slots, tpl.starts):
+                src = "synonym" if field in ("synonym1", "synonym2") else field
+                start_tbl, mid_tbl = self._tables[src]
+                table = start_tbl if at_start else mid_tbl
+                if field == "confidence_phrase" and tpl.confidence_override:
+                    value = tpl.confidence_override if at_start else _lower_first(tpl.confidence_override)
+                    columns.append(itertools.repeat(value, k))
+                    continue
+                if field not in drawn:
+                    drawn[field] = self._draw(src, k, rng)
+                columns.append(table[drawn[field]].tolist())
+            out[rows] = list(map(tpl.fmt.format, *columns))
+        return out.tolist()
+
+    def render_captions(self, n: int, templates_per_caption: int = 1, seed: Optional[int] = None) -> List[str]:
+        """caption ละ templates_per_caption ประโยคที่ render แยกกันแล้วนำมาต่อกัน"""
+        flat = self.render(n * templates_per_caption, seed=seed)
+        if templates_per_caption == 1:
+            return flat
+        return [" ".join(flat[i:i + templates_per_caption]) for i in range(0, len(flat), templates_per_caption)]
+
+
+def _finish_sentence(s: str) -> str:
+    s = _MULTI_SPACE_RE.sub(" ", s).replace("..", ".").strip()
+    return s if s.endswith((".", "!", "?")) else s + "."
+
+
+def render_to_csv(template_key: str, n: int, out_path, seed: Optional[int] = None,
+                  templates_per_caption: int = 1, column: str = "text") -> int:
+    """render n captions แล้วเขียน CSV คอลัมน์เดียวแบบเดียวกับ disease_output/csv/*.csv"""
+    captions = TemplateRenderer(ONTOLOGIES[template_key]).render_captions(n, templates_per_caption, seed)
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with out_path.open("w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f, lineterminator="\n")
+        w.writerow([column])
+        w.writerows([c] for c in captions)
+    return len(captions)
+
+
+if __name__ == "__main__":
+    # ตัวอย่าง: python template_renderer.py --template obstructive -n 100000 --seed 0 --out rendered/Obstructive.csv
+    parser = argparse.ArgumentParser(description="Render captions from disease_template without calling the API")
+    parser.add_argument("--template", default="obstructive", choices=sorted(ONTOLOGIES))
+    parser.add_argument("-n", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-caption", type=int, default=1, help="จำนวน template ต่อ caption")
+    parser.add_argument("--out", default=None, help="ไฟล์ CSV ปลายทาง (ไม่ใส่ = พิมพ์ออกจอ)")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    if args.out:
+        count = render_to_csv(args.template, args.n, args.out, args.seed, args.per_caption)
+        print(f"[Rendered] {args.out}  ({count} rows, {time.perf_counter() - t0:.2f}s)")
+    else:
+        for line in TemplateRenderer(ONTOLOGIES[args.template]).render_captions(args.n, args.per_caption, args.seed):
+            print(line)
@@ -0,0 +1,217 @@
+"""
+จัด batch ตามความยาว token ของ conversation สำหรับ SFT (ลด padding โดยไม่ต้องเพิ่ม batch size / VRAM)
+
+- TokenLengthCache: tokenize ส่วนข้อความ (instruction + "Class: ...\\nExplanation: ...") ครั้งเดียว
+  แล้วเก็บความยาวเป็น .npy ตาม hash ของ (tokenizer, ข้อความทั้งหมด) → รันรอบถัดไปไม่ต้อง tokenize ใหม่
+  image_tokens = จำนวน token ของภาพต่อแถว (รูปหลังบาลานซ์ขนาดเท่ากัน → ค่าคงที่)
+- LengthGroupedSampler: สุ่ม index แล้วแบ่งเป็นก้อนใหญ่ (bucket_batches × batch_size) เรียงตามความยาวในก้อน
+  ตัดเป็น batch แล้วสลับลำดับ batch → แต่ละ batch มีความยาวใกล้กัน แต่ยังสุ่มทุก epoch
+  ใช้กับ SFTTrainer ผ่าน use_length_grouped_sampler(trainer, lengths)
+- pack_first_fit: รวมหลาย segment ลงลำดับเดียว (สำหรับ SFT แบบข้อความล้วน; collator ของ VLM ใช้ไม่ได้)
+- padding_report: เทียบสัดส่วน padding แบบสุ่มเดิม / แบบ bucket / แบบ pack
+
+CLI:
+    python seq_packing.py --shards lung8_image_text_shards --tokenizer unsloth/Qwen2.5-VL-3B-Instruct --batch-size 2
+"""
+import argparse
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+ANSWER_TEMPLATE = "Class: {cls}\nExplanation: {text}"
+
+
+def conversation_text(row: Dict) -> str:
+    """ส่วนข้อความทั้งหมดของ conversation (ข้ามภาพ)"""
+    parts = []
+    for turn in row.get("messages") or []:
+        for c in turn.get("content") or []:
+            if isinstance(c, dict) and c.get("type") == "text":
+                parts.append(c.get("text") or "")
+    return "\n".join(parts)
+
+
+class TokenLengthCache:
+    def __init__(self, tokenizer, cache_dir: Path = Path(".length_cache"), image_tokens: int = 0,
+                 batch_size: int = 1000):
+        self.tokenizer = getattr(tokenizer, "tokenizer", tokenizer)
+        self.cache_dir = Path(cache_dir)
+        self.image_tokens = image_tokens
+        self.batch_size = batch_size
+
+    def key(self, texts: Sequence[str]) -> str:
+        h = hashlib.sha256()
+        h.update(str(getattr(self.tokenizer, "name_or_path", type(self.tokenizer).__name__)).encode("utf-8"))
+        h.update(str(len(self.tokenizer)).encode("utf-8"))
+        for t in texts:
+            h.update(t.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()[:16]
+
+    def lengths(self, texts: Sequence[str]) -> np.ndarray:
+        """ความยาว token ของแต่ละข้อความ + image_tokens (โหลดจาก cache ถ้าเคยคำนวณแล้ว)"""
+        texts = list(texts)
+        path = self.cache_dir / f"lengths-{self.key(texts)}.npy"
+        if path.exists():
+            text_lengths = np.load(path)
+            print(f"[Lengths] cache hit {path} ({len(text_lengths)} rows)")
+        else:
+            text_lengths = np.empty(len(texts), dtype=np.int32)
+            for start in range(0, len(texts), self.batch_size):
+                enc = self.tokenizer(texts[start:start + self.batch_size], add_special_tokens=False)["input_ids"]
+                text_lengths[start:start + len(enc)] = [len(ids) for ids in enc]
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            np.save(path, text_lengths)
+            print(f"[Lengths] tokenized {len(texts)} rows → {path}")
+        return text_lengths + self.image_tokens
+
+    def for_conversations(self, rows: Sequence[Dict]) -> np.ndarray:
+        return self.lengths([conversation_text(r) for r in rows])
+
+
+# ---------- bucketing ----------
+
+def length_grouped_order(lengths: Sequence[int], batch_size: int, bucket_batches: int = 50,
+                         seed: int = 0) -> np.ndarray:
+    """ลำดับ index ที่ทุก batch_size ตัวติดกันมีความยาวใกล้กัน (สุ่มตาม seed)"""
+    lengths = np.asarray(lengths)
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(len(lengths))
+    mega = max(1, batch_size * bucket_batches)
+    batches: List[np.ndarray] = []
+    for start in range(0, len(perm), mega):
+        chunk = perm[start:start + mega]
+        chunk = chunk[np.argsort(-lengths[chunk], kind="stable")]
+        batches.extend(chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size))
+    if len(batches) > 1:
+        # batch ที่ยาวที่สุดขึ้นก่อน → ถ้า OOM จะรู้ตั้งแต่ step แรก; ที่เหลือสุ่ม
+        longest = int(np.argmax([lengths[b].max() for b in batches]))
+        batches[0], batches[longest] = batches[longest], batches[0]
+        rest = rng.permutation(len(batches) - 1) + 1
+        batches = [batches[0]] + [batches[i] for i in rest]
+    return np.concatenate(batches) if batches else perm
+
+
+class LengthGroupedSampler:
+    """
+    Sampler แบบ index (ใช้เป็น sampler ของ DataLoader ได้) — epoch ใหม่ได้ลำดับใหม่ผ่าน set_epoch()
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_batches: int = 50, seed: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __iter__(self) -> Iterator[int]:
+        order = length_grouped_order(self.lengths, self.batch_size, self.bucket_batches, self.seed + self.epoch)
+        self.epoch += 1
+        return iter(order.tolist())
+
+
+def use_length_grouped_sampler(trainer, lengths: Sequence[int], bucket_batches: int = 50,
+                               seed: Optional[int] = None) -> LengthGroupedSampler:
+    """
+    ให้ Trainer/SFTTrainer สุ่ม train set ด้วย LengthGroupedSampler
+    (group_by_length เดิมของ Trainer หา length จาก input_ids ซึ่ง conversation ดิบไม่มี)
+    """
+    args = trainer.args
+    sampler = LengthGroupedSampler(lengths, args.per_device_train_batch_size * max(1, args.world_size),
+                                   bucket_batches, args.seed if seed is None else seed)
+    trainer._get_train_sampler = lambda *a, **k: sampler
+    return sampler
+
+
+# ---------- packing (ข้อความล้วน) ----------
+
+def pack_first_fit(lengths: Sequence[int], max_tokens: int) -> List[List[int]]:
+    """first-fit decreasing: รวม index ลงลำดับละไม่เกิน max_tokens (แถวที่ยาวเกินอยู่ลำดับเดี่ยว)"""
+    lengths = np.asarray(lengths)
+    bins: List[List[int]] = []
+    room: List[int] = []
+    for i in np.argsort(-lengths, kind="stable"):
+        n = int(lengths[i])
+        for b, free in enumerate(room):
+            if n <= free:
+                bins[b].append(int(i))
+                room[b] -= n
+                break
+        else:
+            bins.append([int(i)])
+            room.append(max(0, max_tokens - n))
+    return bins
+
+
+# ---------- report ----------
+
+def padding_ratio(lengths: Sequence[int], order: Sequence[int], batch_size: int) -> float:
+    """สัดส่วน token ที่เป็น padding เมื่อ pad ทุก batch ให้ยาวเท่าแถวที่ยาวที่สุด"""
+    lengths = np.asarray(lengths)
+    order = np.asarray(order)
+    real = padded = 0
+    for start in range(0, len(order), batch_size):
+        b = lengths[order[start:start + batch_size]]
+        real += int(b.sum())
+        padded += int(b.max()) * len(b)
+    return 1 - real / padded if padded else 0.0
+
+
+def padding_report(lengths: Sequence[int], batch_size: int, bucket_batches: int = 50, seed: int = 0,
+                   pack_tokens: Optional[int] = None) -> Dict[str, float]:
+    lengths = np.asarray(lengths)
+    random_order = np.random.default_rng(seed).permutation(len(lengths))
+    grouped = length_grouped_order(lengths, batch_size, bucket_batches, seed)
+    report = {
+        "rows": int(len(lengths)),
+        "mean_tokens": float(lengths.mean()) if len(lengths) else 0.0,
+        "max_tokens": int(lengths.max()) if len(lengths) else 0,
+        "padding_random": padding_ratio(lengths, random_order, batch_size),
+        "padding_bucketed": padding_ratio(lengths, grouped, batch_size),
+    }
+    print(f"[Padding] {report['rows']} rows, mean {report['mean_tokens']:.1f} / max {report['max_tokens']} tokens, "
+          f"batch {batch_size}")
+    print(f"  สุ่มแบบเดิม     : padding {report['padding_random']:.1%}")
+    print(f"  bucket ตามความยาว: padding {report['padding_bucketed']:.1%}")
+    if pack_tokens:
+        bins = pack_first_fit(lengths, pack_tokens)
+        used = np.array([lengths[b].sum() for b in bins])
+        report["packed_sequences"] = len(bins)
+        report["padding_packed"] = float(1 - used.sum() / (len(bins) * max(pack_tokens, int(used.max()))))
+        print(f"  pack ≤{pack_tokens} tokens : {len(bins)} ลำดับ, padding {report['padding_packed']:.1%}")
+    return report
+
+
+def shard_texts(ds) -> List[str]:
+    """ข้อความของ conversation จาก LazyConversationDataset (ใช้คอลัมน์ตรง ๆ ไม่ decode รูป)"""
+    from dataset_builder import instruction
+
+    return [instruction + "\n" + ANSWER_TEMPLATE.format(cls=c, text=t) for t, c in zip(ds.texts, ds.classes)]
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    from dataset_builder import LazyConversationDataset, shards_root
+
+    parser = argparse.ArgumentParser(description="Token-length bucketing report for the SFT conversations")
+    parser.add_argument("--shards", default=str(shards_root))
+    parser.add_argument("--tokenizer", required=True, help="ชื่อ/พาธ tokenizer ของโมเดลที่จะเทรน")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--bucket-batches", type=int, default=50)
+    parser.add_argument("--image-tokens", type=int, default=0)
+    parser.add_argument("--pack-tokens", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    ds = LazyConversationDataset.open(args.shards)
+    cache = TokenLengthCache(AutoTokenizer.from_pretrained(args.tokenizer), image_tokens=args.image_tokens)
+    padding_report(cache.lengths(shard_texts(ds)), args.batch_size, args.bucket_batches, args.seed, args.pack_tokens)